@@ -0,0 +1,309 @@
+import io
+import os
+import sys
+import math
+import shutil
+import hashlib
+import tempfile
+import threading
+import subprocess
+from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from media_handles import MediaHandle
+
+# 附件类型
+MEDIA_KINDS = {
+    ".png": "image", ".jpg": "image", ".jpeg": "image", ".bmp": "image", ".gif": "image", ".webp": "image",
+    ".wav": "audio", ".mp3": "audio",
+    ".mp4": "video", ".avi": "video", ".mov": "video", ".mkv": "video",
+}
+
+# 默认配置
+DEFAULT_ATTACHMENT_CONFIG = {
+    # 一轮对话中所有附件编码后的总大小(字节)，超出时尽量缩小图片和视频；None表示不限制
+    "max_total_bytes": None,
+    # 并行处理附件的线程数
+    "workers": 4,
+    # 缩小图片时的JPEG质量
+    "jpeg_quality": 85,
+}
+
+# 计算摘要时每次读取的字节数
+CHUNK_SIZE = 1024 * 1024
+
+
+class AttachmentError(Exception):
+    """附件类型不支持，或文件无法读取"""
+
+
+class DigestCache:
+    """文件摘要的LRU缓存，重新选择同一文件时无需再次读取"""
+
+    def __init__(self, max_items=64):
+        self.max_items = max_items
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            digest = self.items.get(key)
+            if digest is not None:
+                self.items.move_to_end(key)
+            return digest
+
+    def put(self, key, digest):
+        with self.lock:
+            self.items[key] = digest
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+
+
+# (路径, 大小, 修改时间) -> sha256
+digest_cache = DigestCache()
+
+
+def media_kind(path):
+    """按扩展名判断附件类型，不支持时返回None"""
+    return MEDIA_KINDS.get(Path(path).suffix.lower())
+
+
+def media_subtype(path, kind):
+    """data URI中使用的格式，如png、jpeg、mp4"""
+    subtype = Path(path).suffix.lower().lstrip(".")
+    if kind == "image" and subtype == "jpg":
+        return "jpeg"
+    return subtype or {"image": "png", "video": "mp4", "audio": "wav"}[kind]
+
+
+def encoded_size(raw_size):
+    return (raw_size + 2) // 3 * 4
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return str(path), stat.st_size, stat.st_mtime_ns
+
+
+def file_sha256(path, total=None, progress=None, cancelled=None):
+    """分块读取文件计算sha256；cancelled()返回True时中止并返回None"""
+    digest = hashlib.sha256()
+    done = 0
+    with open(path, "rb") as source:
+        while True:
+            if cancelled and cancelled():
+                return None
+            data = source.read(CHUNK_SIZE)
+            if not data:
+                break
+            digest.update(data)
+            done += len(data)
+            if progress and total:
+                progress(done, total)
+    return digest.hexdigest()
+
+
+def downscale_image(path, target_bytes, quality=85):
+    """用PIL把图片缩小并转为JPEG，直到不超过target_bytes；没有安装PIL时返回None"""
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    with Image.open(path) as image:
+        image.load()
+        if image.mode in ("RGBA", "LA", "P"):
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            rgba = image.convert("RGBA")
+            background.paste(rgba, mask=rgba.split()[-1])
+            image = background
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+        current = os.path.getsize(path)
+        width, height = image.size
+        data = None
+        for _ in range(6):
+            # 文件大小大致与像素数成正比
+            factor = min(1.0, math.sqrt(target_bytes / max(1, current)) * 0.9)
+            width, height = max(16, int(width * factor)), max(16, int(height * factor))
+            buffer = io.BytesIO()
+            image.resize((width, height), Image.LANCZOS).save(buffer, "JPEG", quality=quality, optimize=True)
+            data = buffer.getvalue()
+            if len(data) <= target_bytes:
+                break
+            current = len(data)
+        return data
+
+
+def video_duration(path):
+    """用ffprobe读取视频时长(秒)，失败返回None"""
+    if not shutil.which("ffprobe"):
+        return None
+    try:
+        result = subprocess.run(
+            ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", str(path)],
+            capture_output=True, text=True, timeout=30, check=True)
+        return float(result.stdout.strip())
+    except (subprocess.SubprocessError, ValueError):
+        return None
+
+
+def downscale_video(path, target_bytes):
+    """用ffmpeg按目标码率重新编码为较低分辨率的MP4；没有ffmpeg时返回None"""
+    if not shutil.which("ffmpeg"):
+        return None
+    duration = video_duration(path) or 60.0
+    audio_bitrate = 48_000
+    video_bitrate = max(100_000, int(target_bytes * 8 * 0.9 / duration) - audio_bitrate)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        output = Path(temp_dir) / "downscaled.mp4"
+        command = [
+            "ffmpeg", "-v", "error", "-y", "-i", str(path),
+            "-vf", "scale='min(iw,854)':-2",
+            "-c:v", "libx264", "-preset", "veryfast",
+            "-b:v", str(video_bitrate), "-maxrate", str(video_bitrate), "-bufsize", str(video_bitrate * 2),
+            "-c:a", "aac", "-b:a", str(audio_bitrate),
+            "-movflags", "+faststart", str(output),
+        ]
+        try:
+            subprocess.run(command, capture_output=True, timeout=600, check=True)
+        except subprocess.SubprocessError as e:
+            print(f"[ffmpeg压缩视频失败: {e}]")
+            return None
+        return output.read_bytes()
+
+
+def can_downscale(kind):
+    """该类型的附件在当前环境下能否缩小"""
+    if kind == "image":
+        try:
+            import PIL  # noqa: F401
+            return True
+        except ImportError:
+            return False
+    if kind == "video":
+        return shutil.which("ffmpeg") is not None
+    return False
+
+
+def prepare_attachment(path, target_bytes=None, config=None, progress=None, cancelled=None):
+    """准备一个附件；target_bytes不为None且文件更大时先缩小，返回附件字典（取消时返回None）
+
+    附件字典包含kind、path、subtype、size（原始字节数）、sha256、downscaled，以及
+    media（MediaHandle）。附件不预先编码，发送请求时才由句柄生成base64。
+    """
+    config = dict(DEFAULT_ATTACHMENT_CONFIG, **(config or {}))
+    kind = media_kind(path)
+    if kind is None:
+        raise AttachmentError(f"不支持的附件类型: {path}")
+    try:
+        signature = file_signature(path)
+    except OSError as e:
+        raise AttachmentError(f"无法读取附件: {path} ({e})")
+    if target_bytes is not None and signature[1] <= target_bytes:
+        target_bytes = None
+
+    data = None
+    if target_bytes is not None:
+        if kind == "image":
+            data = downscale_image(path, target_bytes, config["jpeg_quality"])
+        elif kind == "video":
+            data = downscale_video(path, target_bytes)
+    if cancelled and cancelled():
+        return None
+    if data is not None and len(data) >= signature[1]:
+        # 缩小后没有变小（如已经压缩过的JPEG），发送原文件
+        data = None
+
+    if data is not None:
+        subtype = "jpeg" if kind == "image" else "mp4"
+        media = MediaHandle.from_bytes(kind, data, subtype, hashlib.sha256(data).hexdigest())
+        if progress:
+            progress(signature[1], signature[1])
+    else:
+        subtype = media_subtype(path, kind)
+        digest = digest_cache.get(signature)
+        if digest is None:
+            digest = file_sha256(path, signature[1], progress, cancelled)
+            if digest is None:
+                return None
+            digest_cache.put(signature, digest)
+        elif progress:
+            progress(signature[1], signature[1])
+        media = MediaHandle.from_file(kind, path, subtype, digest)
+
+    return {
+        "kind": kind,
+        "path": str(path),
+        "subtype": subtype,
+        "size": media.size,
+        "sha256": media.sha256,
+        "media": media,
+        "downscaled": data is not None,
+    }
+
+
+def plan_targets(paths, max_total_bytes):
+    """按总大小上限为每个附件分配目标大小（原始字节数），不需要缩小的为None
+
+    max_total_bytes为None时不限制。不能缩小的附件（音频，或缺少PIL/ffmpeg）按原大小计入，
+    剩余额度按比例分给可以缩小的附件；没有剩余额度时不缩小，附件按原样发送。
+    """
+    if max_total_bytes is None:
+        return [None] * len(paths)
+    sizes = [os.path.getsize(path) for path in paths]
+    if sum(encoded_size(size) for size in sizes) <= max_total_bytes:
+        return [None] * len(paths)
+    flexible = [can_downscale(media_kind(path)) for path in paths]
+    fixed_total = sum(encoded_size(size) for size, ok in zip(sizes, flexible) if not ok)
+    flexible_total = sum(size for size, ok in zip(sizes, flexible) if ok)
+    remaining = max_total_bytes - fixed_total
+    if remaining <= 0 or flexible_total == 0:
+        return [None] * len(paths)
+    # 额度是编码后的大小，换算回原始字节数
+    scale = remaining * 3 / 4 / flexible_total
+    return [int(size * scale) if ok else None for size, ok in zip(sizes, flexible)]
+
+
+def prepare_attachments(paths, config=None, progress=None, cancelled=None):
+    """并行准备多个附件，总大小超出上限时尽量缩小图片和视频；返回附件字典列表（取消时返回None）
+
+    无法缩小到上限以内时附件照常发送（只打印提示），由接口决定是否接受。
+    progress(已完成字节数, 总字节数)汇总所有附件的进度。
+    """
+    config = dict(DEFAULT_ATTACHMENT_CONFIG, **(config or {}))
+    paths = [str(path) for path in paths]
+    if not paths:
+        return []
+    for path in paths:
+        if media_kind(path) is None:
+            raise AttachmentError(f"不支持的附件类型: {path}")
+        if not os.path.isfile(path):
+            raise AttachmentError(f"文件不存在: {path}")
+    targets = plan_targets(paths, config["max_total_bytes"])
+
+    lock = threading.Lock()
+    done = [0] * len(paths)
+    totals = [os.path.getsize(path) for path in paths]
+
+    def report(index):
+        def update(current, total):
+            with lock:
+                done[index] = current * totals[index] // max(1, total)
+                if progress:
+                    progress(sum(done), sum(totals))
+        return update
+
+    with ThreadPoolExecutor(max_workers=max(1, min(config["workers"], len(paths)))) as executor:
+        futures = [executor.submit(prepare_attachment, path, target, config, report(index), cancelled)
+                   for index, (path, target) in enumerate(zip(paths, targets))]
+        attachments = [future.result() for future in futures]
+    if any(attachment is None for attachment in attachments):
+        return None
+
+    total = sum(len(attachment["media"]) for attachment in attachments)
+    if config["max_total_bytes"] is not None and total > config["max_total_bytes"]:
+        print(f"[警告] 附件编码后共{total / 1048576:.1f}MB，超出设定的{config['max_total_bytes'] / 1048576:.1f}MB，"
+              f"无法再缩小（可安装Pillow和ffmpeg），按原样发送", file=sys.stderr)
+    return attachments
@@ -0,0 +1,326 @@
+import sys
+import time
+import threading
+from pathlib import Path
+
+# 默认配置
+DEFAULT_DEVICE_CONFIG = {
+    # 输入/输出设备序号，None表示系统默认设备
+    "input_device": None,
+    "output_device": None,
+    # 等待其他线程释放设备的最长时间(秒)，None表示一直等待
+    "acquire_timeout": None,
+    # 每次占用设备前检查声卡是否有变化（仅Linux，读取/proc/asound/cards）
+    "hotplug_check": True,
+}
+
+# Linux下的声卡列表，插拔USB声卡/耳机时内容会变化
+ASOUND_CARDS = Path("/proc/asound/cards")
+
+
+class DeviceBusy(Exception):
+    """设备被其他线程占用，且在超时前没有释放"""
+
+
+class StreamLease:
+    """占用中的音频流，用完后调用release()（或使用with语句）归还给设备管理器"""
+
+    def __init__(self, manager, direction, stream, sampwidth):
+        self.manager = manager
+        self.direction = direction
+        self.stream = stream
+        self.sampwidth = sampwidth
+        # 读写出错（如设备被拔出）后标记为损坏，归还时关闭
+        self.broken = False
+        self.released = False
+
+    def read(self, frames):
+        try:
+            return self.stream.read(frames, exception_on_overflow=False)
+        except OSError:
+            self.broken = True
+            raise
+
+    def write(self, pcm):
+        try:
+            self.stream.write(pcm)
+        except OSError:
+            self.broken = True
+            raise
+
+    def release(self, discard=False):
+        """归还音频流；discard为True时关闭流，丢弃尚未播放的数据"""
+        if not self.released:
+            self.released = True
+            self.manager._release(self, discard or self.broken)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.release()
+
+
+class AudioDeviceManager:
+    """进程级的音频设备管理器
+
+    PortAudio只初始化一次，输入和输出流打开后保留复用（输入流在归还时暂停，
+    输出流保持运行），每个方向同一时间只允许一个线程占用。
+    打开或读写失败、或检测到声卡变化时重新初始化PortAudio以识别新插入的设备；
+    重新初始化会关闭所有流，有流被占用时推迟到所有流都归还之后。
+    """
+
+    def __init__(self, config=None):
+        import pyaudio
+        self.pyaudio = pyaudio
+        self.config = dict(DEFAULT_DEVICE_CONFIG)
+        self.config.update(config or {})
+        self.lock = threading.RLock()
+        self.pa = None
+        # 方向 -> (格式, 流)
+        self.streams = {}
+        self.leases = {"input": threading.Lock(), "output": threading.Lock()}
+        self.card_signature = None
+        # 因有流被占用而推迟的重新初始化的原因
+        self.pending_reinit = None
+        self.initializations = 0
+        self.streams_opened = 0
+
+    def _initialize(self):
+        if self.pa is None:
+            self.pa = self.pyaudio.PyAudio()
+            self.card_signature = self._read_card_signature()
+            self.initializations += 1
+
+    def _read_card_signature(self):
+        if not self.config.get("hotplug_check"):
+            return None
+        try:
+            return ASOUND_CARDS.read_text()
+        except OSError:
+            return None
+
+    def _terminate(self):
+        for _, stream in self.streams.values():
+            try:
+                stream.close()
+            except Exception:
+                pass
+        self.streams.clear()
+        if self.pa is not None:
+            self.pa.terminate()
+            self.pa = None
+
+    def _reinitialize(self, reason):
+        print(f"[重新初始化音频设备: {reason}]", file=sys.stderr)
+        self.pending_reinit = None
+        self._terminate()
+        self._initialize()
+
+    def _others_busy(self, direction):
+        """除direction（调用方自己占用的方向）外是否还有流被占用"""
+        return any(lock.locked() for other, lock in self.leases.items() if other != direction)
+
+    def _check_hotplug(self, direction):
+        """声卡列表有变化时重新初始化；另一个方向的流正被占用时推迟到它归还"""
+        if self.pa is None or self.card_signature is None:
+            return
+        if self.pending_reinit is None and self._read_card_signature() == self.card_signature:
+            return
+        if self._others_busy(direction):
+            self.pending_reinit = self.pending_reinit or "声卡列表发生变化"
+            return
+        self._reinitialize(self.pending_reinit or "声卡列表发生变化")
+
+    def _open(self, direction, audio_format):
+        rate, channels, sampwidth, frames_per_buffer = audio_format
+        kwargs = {
+            "format": self.pa.get_format_from_width(sampwidth),
+            "channels": channels,
+            "rate": rate,
+            direction: True,
+        }
+        device = self.config.get(f"{direction}_device")
+        if device is not None:
+            kwargs[f"{direction}_device_index"] = device
+        if frames_per_buffer:
+            kwargs["frames_per_buffer"] = frames_per_buffer
+        stream = self.pa.open(**kwargs)
+        self.streams_opened += 1
+        return stream
+
+    def _stream(self, direction, audio_format):
+        """返回已打开的流，格式不同或尚未打开时（重新）打开"""
+        with self.lock:
+            self._initialize()
+            self._check_hotplug(direction)
+            cached = self.streams.get(direction)
+            if cached and cached[0] == audio_format:
+                return cached[1]
+            if cached:
+                self.streams.pop(direction)[1].close()
+            try:
+                stream = self._open(direction, audio_format)
+            except OSError as e:
+                # 设备可能已被拔出或更换，重新枚举设备后重试一次；另一个方向的流正被占用时
+                # 不能关闭它，等它归还后再重新初始化
+                if self._others_busy(direction):
+                    self.pending_reinit = str(e)
+                    raise
+                self._reinitialize(e)
+                stream = self._open(direction, audio_format)
+            self.streams[direction] = (audio_format, stream)
+            return stream
+
+    def _acquire(self, direction, audio_format, timeout):
+        if timeout is None:
+            timeout = self.config.get("acquire_timeout")
+        lease_lock = self.leases[direction]
+        if not lease_lock.acquire(timeout=-1 if timeout is None else timeout):
+            raise DeviceBusy(f"音频{'输入' if direction == 'input' else '输出'}设备正被占用")
+        try:
+            stream = self._stream(direction, audio_format)
+            if not stream.is_active():
+                stream.start_stream()
+        except Exception:
+            lease_lock.release()
+            raise
+        return StreamLease(self, direction, stream, audio_format[2])
+
+    def acquire_input(self, rate=16000, channels=1, frames_per_buffer=1024, sampwidth=2, timeout=None):
+        """占用输入设备，返回StreamLease"""
+        return self._acquire("input", (rate, channels, sampwidth, frames_per_buffer), timeout)
+
+    def acquire_output(self, rate=24000, channels=1, sampwidth=2, timeout=None):
+        """占用输出设备，返回StreamLease"""
+        return self._acquire("output", (rate, channels, sampwidth, None), timeout)
+
+    def _release(self, lease, discard):
+        with self.lock:
+            cached = self.streams.get(lease.direction)
+            owned = cached is not None and cached[1] is lease.stream
+            try:
+                if discard:
+                    if owned:
+                        del self.streams[lease.direction]
+                    lease.stream.close()
+                elif lease.direction == "input" and owned:
+                    # 暂停输入流，避免空闲时缓冲区溢出；下次开始录音时不会读到旧数据
+                    lease.stream.stop_stream()
+            except Exception as e:
+                print(f"[释放音频流时出错: {e}]", file=sys.stderr)
+            finally:
+                self.leases[lease.direction].release()
+            # 推迟的重新初始化在所有流都归还后进行
+            if self.pending_reinit is not None and not self._others_busy(None):
+                try:
+                    self._reinitialize(self.pending_reinit)
+                except Exception as e:
+                    print(f"[重新初始化音频设备时出错: {e}]", file=sys.stderr)
+
+    def prewarm(self, input_format=(16000, 1, 1024), output_format=(24000, 1)):
+        """预先初始化PortAudio并打开输入、输出流，缩短第一次录音和播放的等待时间"""
+        with self.lock:
+            self._initialize()
+            if input_format and "input" not in self.streams:
+                rate, channels, frames_per_buffer = input_format
+                try:
+                    stream = self._stream("input", (rate, channels, 2, frames_per_buffer))
+                    stream.stop_stream()
+                except OSError as e:
+                    print(f"[无法打开输入设备: {e}]", file=sys.stderr)
+            if output_format and "output" not in self.streams:
+                rate, channels = output_format
+                try:
+                    self._stream("output", (rate, channels, 2, None))
+                except OSError as e:
+                    print(f"[无法打开输出设备: {e}]", file=sys.stderr)
+
+    def native_output_rate(self):
+        """输出设备的原生采样率，无法获取时返回None"""
+        with self.lock:
+            try:
+                self._initialize()
+                device = self.config.get("output_device")
+                if device is None:
+                    info = self.pa.get_default_output_device_info()
+                else:
+                    info = self.pa.get_device_info_by_index(device)
+                return int(info["defaultSampleRate"])
+            except (OSError, IOError, KeyError):
+                return None
+
+    def refresh(self):
+        """重新枚举设备（如插入新耳机后），只在没有流被占用时执行，返回是否已刷新"""
+        acquired = []
+        try:
+            for lock in self.leases.values():
+                if not lock.acquire(blocking=False):
+                    return False
+                acquired.append(lock)
+            with self.lock:
+                self._reinitialize("手动刷新")
+            return True
+        finally:
+            for lock in acquired:
+                lock.release()
+
+    def close(self):
+        with self.lock:
+            self._terminate()
+
+    def metrics(self):
+        with self.lock:
+            return {
+                "initializations": self.initializations,
+                "streams_opened": self.streams_opened,
+                "open_streams": sorted(self.streams),
+                "busy": [direction for direction, lock in self.leases.items() if lock.locked()],
+            }
+
+
+# 进程内共享的设备管理器
+_device_manager = None
+_device_manager_lock = threading.Lock()
+
+
+def get_device_manager(config=None):
+    """获取进程内共享的设备管理器，首次调用时按config创建"""
+    global _device_manager
+    with _device_manager_lock:
+        if _device_manager is None:
+            _device_manager = AudioDeviceManager(config)
+        return _device_manager
+
+
+def measure_startup(rate=16000, chunk=1024, rounds=5):
+    """比较每次新建PyAudio和复用设备管理器时，开始录音到读到第一块数据的耗时"""
+    import pyaudio
+    fresh = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        p = pyaudio.PyAudio()
+        stream = p.open(format=pyaudio.paInt16, channels=1, rate=rate, input=True, frames_per_buffer=chunk)
+        stream.read(chunk, exception_on_overflow=False)
+        fresh.append(time.perf_counter() - start)
+        stream.close()
+        p.terminate()
+
+    manager = AudioDeviceManager()
+    manager.prewarm(output_format=None)
+    warm = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        with manager.acquire_input(rate, 1, chunk) as lease:
+            lease.read(chunk)
+        warm.append(time.perf_counter() - start)
+    manager.close()
+
+    # 读取一块数据本身需要chunk/rate秒，差值即初始化和打开设备的开销
+    print(f"每次新建PyAudio: 平均 {sum(fresh) / rounds * 1000:.1f} 毫秒")
+    print(f"复用设备管理器:  平均 {sum(warm) / rounds * 1000:.1f} 毫秒"
+          f"（其中读取一块数据约 {chunk / rate * 1000:.1f} 毫秒）")
+
+
+if __name__ == "__main__":
+    measure_startup()
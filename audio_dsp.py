@@ -0,0 +1,204 @@
+import sys
+import math
+import time
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# 默认配置
+DEFAULT_DSP_CONFIG = {
+    "enabled": True,
+    # 重采样到声卡的原生采样率
+    "resample": True,
+    # 每个相位的滤波器抽头数，越大抗混叠越好、CPU开销越高
+    "taps_per_phase": 16,
+    # 响度归一化
+    "normalize": True,
+    "target_dbfs": -20.0,
+    "max_gain_db": 12.0,
+    # 响度估计的时间常数(秒)
+    "loudness_window": 0.5,
+    # 裁掉回复开头的静音
+    "trim_silence": True,
+    "silence_dbfs": -50.0,
+    # 最多裁掉的时长(秒)，保留的起音前余量(毫秒)
+    "max_trim_seconds": 1.5,
+    "trim_padding_ms": 20,
+}
+
+INT16_SCALE = 32768.0
+
+
+def dbfs_to_amplitude(dbfs):
+    return 10 ** (dbfs / 20.0)
+
+
+class PolyphaseResampler:
+    """分块流式多相重采样器（有理数比例out_rate/in_rate），块与块之间保留滤波器状态"""
+
+    def __init__(self, in_rate, out_rate, taps_per_phase=16):
+        divisor = math.gcd(in_rate, out_rate)
+        self.up = out_rate // divisor
+        self.down = in_rate // divisor
+        self.in_rate = in_rate
+        self.out_rate = out_rate
+        self.taps = taps_per_phase
+
+        # Kaiser窗sinc低通原型滤波器，截止频率取输入、输出奈奎斯特频率中较低者
+        length = self.taps * self.up
+        cutoff = 0.5 / max(self.up, self.down) * 0.95
+        n = np.arange(length) - (length - 1) / 2.0
+        prototype = 2 * cutoff * np.sinc(2 * cutoff * n) * np.kaiser(length, 8.0)
+        prototype *= self.up / prototype.sum()
+        # 第p个相位使用prototype[p], prototype[p+up], ...，按输入窗口的顺序反转
+        self.phases = prototype.reshape(self.taps, self.up).T[:, ::-1].astype(np.float32).copy()
+
+        self.history = np.zeros(self.taps - 1, dtype=np.float32)
+        # 下一个输出样本在上采样网格中的位置（相对当前块的第一个输入样本）
+        self.position = 0
+
+    def process(self, samples):
+        """输入float32样本，返回重采样后的float32样本"""
+        count = len(samples)
+        if count == 0:
+            return samples
+        buffer = np.concatenate((self.history, samples))
+        limit = count * self.up
+        if self.position >= limit:
+            outputs = np.empty(0, dtype=np.float32)
+        else:
+            positions = np.arange(self.position, limit, self.down)
+            indices = positions // self.up
+            windows = sliding_window_view(buffer, self.taps)[indices]
+            outputs = np.einsum("ij,ij->i", windows, self.phases[positions % self.up])
+            self.position = int(positions[-1]) + self.down
+        self.position -= limit
+        self.history = buffer[-(self.taps - 1):] if self.taps > 1 else self.history
+        return outputs
+
+
+class LoudnessNormalizer:
+    """有状态的响度归一化：按指数滑动平均估计RMS响度，增益在块内线性过渡，避免突变"""
+
+    def __init__(self, samplerate, target_dbfs=-20.0, max_gain_db=12.0, window=0.5, gate_dbfs=-50.0):
+        self.samplerate = samplerate
+        self.target = dbfs_to_amplitude(target_dbfs)
+        self.max_gain = dbfs_to_amplitude(max_gain_db)
+        self.window = window
+        self.gate = dbfs_to_amplitude(gate_dbfs)
+        # 均方值的估计，None表示还没有有效的语音
+        self.mean_square = None
+        self.gain = 1.0
+
+    def process(self, samples):
+        if len(samples) == 0:
+            return samples
+        mean_square = float(np.dot(samples, samples)) / len(samples)
+        # 低于门限的静音块不更新响度估计，避免停顿时增益被不断抬高
+        if mean_square > self.gate ** 2:
+            if self.mean_square is None:
+                self.mean_square = mean_square
+            else:
+                alpha = 1.0 - math.exp(-len(samples) / (self.samplerate * self.window))
+                self.mean_square += alpha * (mean_square - self.mean_square)
+        target_gain = self.gain
+        if self.mean_square:
+            target_gain = min(self.max_gain, self.target / math.sqrt(self.mean_square))
+        ramp = np.linspace(self.gain, target_gain, len(samples), dtype=np.float32)
+        self.gain = target_gain
+        return samples * ramp
+
+
+class SilenceTrimmer:
+    """裁掉回复开头的静音，检测到第一个有声样本后直接放行"""
+
+    def __init__(self, samplerate, threshold_dbfs=-50.0, max_trim_seconds=1.5, padding_ms=20):
+        self.threshold = dbfs_to_amplitude(threshold_dbfs)
+        self.max_trim = int(samplerate * max_trim_seconds)
+        self.padding = int(samplerate * padding_ms / 1000)
+        self.trimmed = 0
+        self.active = True
+        # 保留最近的静音样本，作为起音前的余量
+        self.tail = np.zeros(0, dtype=np.float32)
+
+    def process(self, samples):
+        if not self.active:
+            return samples
+        loud = np.flatnonzero(np.abs(samples) > self.threshold)
+        if len(loud) == 0 and self.trimmed + len(samples) < self.max_trim:
+            self.trimmed += len(samples)
+            if self.padding:
+                self.tail = np.concatenate((self.tail, samples))[-self.padding:]
+            return samples[:0]
+        self.active = False
+        # 找到有声样本，或已达到最多裁掉的时长
+        onset = int(loud[0]) if len(loud) else max(0, self.max_trim - self.trimmed)
+        start = onset - self.padding
+        if start >= 0:
+            self.trimmed += start
+            return samples[start:]
+        # 起音点离块开头太近时，从上一块保留的静音中补足余量
+        self.trimmed -= min(-start, len(self.tail))
+        return np.concatenate((self.tail[start:], samples))
+
+
+class OutputDsp:
+    """输出音频的流式处理链：裁掉开头静音 → 响度归一化 → 重采样
+
+    process()输入、输出都是16位单声道PCM字节；每段回复使用一个新的实例。
+    """
+
+    def __init__(self, in_rate=24000, out_rate=None, config=None):
+        self.config = dict(DEFAULT_DSP_CONFIG)
+        self.config.update(config or {})
+        self.in_rate = in_rate
+        self.out_rate = out_rate if out_rate and self.config.get("resample") else in_rate
+        self.trimmer = None
+        self.normalizer = None
+        self.resampler = None
+        if self.config.get("trim_silence"):
+            self.trimmer = SilenceTrimmer(in_rate, self.config["silence_dbfs"],
+                                          self.config["max_trim_seconds"], self.config["trim_padding_ms"])
+        if self.config.get("normalize"):
+            self.normalizer = LoudnessNormalizer(in_rate, self.config["target_dbfs"], self.config["max_gain_db"],
+                                                 self.config["loudness_window"], self.config["silence_dbfs"])
+        if self.out_rate != in_rate:
+            self.resampler = PolyphaseResampler(in_rate, self.out_rate, self.config["taps_per_phase"])
+
+    def process(self, pcm):
+        samples = np.frombuffer(pcm, dtype=np.int16, count=len(pcm) // 2).astype(np.float32)
+        samples *= 1.0 / INT16_SCALE
+        if self.trimmer:
+            samples = self.trimmer.process(samples)
+        if self.normalizer:
+            samples = self.normalizer.process(samples)
+        if self.resampler:
+            samples = self.resampler.process(samples)
+        if len(samples) == 0:
+            return b""
+        samples *= INT16_SCALE
+        np.clip(samples, -INT16_SCALE, INT16_SCALE - 1, out=samples)
+        return samples.astype(np.int16).tobytes()
+
+
+def benchmark(chunk_ms=(20, 100), out_rates=(24000, 44100, 48000), seconds=10):
+    """测量每个数据块的CPU耗时（24kHz输入）"""
+    in_rate = 24000
+    rng = np.random.default_rng(0)
+    signal = (np.sin(2 * np.pi * 220 * np.arange(in_rate * seconds) / in_rate) * 8000
+              + rng.normal(0, 500, in_rate * seconds)).astype(np.int16)
+    print(f"{'块长':>6} {'输出采样率':>10} {'每块CPU':>10} {'实时倍数':>8}")
+    for ms in chunk_ms:
+        chunk = in_rate * ms // 1000
+        chunks = [signal[i:i + chunk].tobytes() for i in range(0, len(signal), chunk)]
+        for out_rate in out_rates:
+            dsp = OutputDsp(in_rate, out_rate)
+            start = time.process_time()
+            for data in chunks:
+                dsp.process(data)
+            elapsed = time.process_time() - start
+            print(f"{ms:>4}ms {out_rate:>10} {elapsed / len(chunks) * 1e6:>8.0f}µs {seconds / elapsed:>7.0f}x")
+
+
+if __name__ == "__main__":
+    benchmark(seconds=int(sys.argv[1]) if len(sys.argv) > 1 else 10)
@@ -0,0 +1,354 @@
+import sys
+import time
+import wave
+import queue
+import threading
+from pathlib import Path
+
+# 默认配置：auto依次尝试pyaudio、sounddevice，都不可用时使用null
+DEFAULT_PLAYBACK_CONFIG = {
+    "backend": "auto",
+    # file后端保存播放内容的目录
+    "file_dir": "audio_playback",
+    # 每次写入声卡的帧数，越小停止播放越及时
+    "block_frames": 1024,
+}
+
+# 播放队列中的回调项（见PlaybackService.call_when_done）
+CALLBACK = "callback"
+
+
+class PlaybackBackend:
+    """播放设备接口"""
+
+    name = "backend"
+
+    def open(self, samplerate, channels, sampwidth):
+        """按音频格式准备设备，格式不变时可以复用已打开的设备"""
+
+    def write(self, pcm):
+        """写入一块PCM数据（阻塞到设备接收为止）"""
+        raise NotImplementedError
+
+    def finish(self):
+        """一段音频播放完毕"""
+
+    def abort(self):
+        """丢弃设备中尚未播放的数据"""
+
+    def native_rate(self):
+        """设备的原生采样率，None表示不需要重采样"""
+        return None
+
+    def close(self):
+        pass
+
+
+class PyAudioBackend(PlaybackBackend):
+    """通过PyAudio（PortAudio）播放，输出流由进程共享的设备管理器提供"""
+
+    name = "pyaudio"
+
+    def __init__(self, manager=None):
+        if manager is None:
+            from audio_devices import get_device_manager
+            manager = get_device_manager()
+        self.manager = manager
+        self.lease = None
+        self.format = None
+
+    def open(self, samplerate, channels, sampwidth):
+        if self.lease is not None and self.format == (samplerate, channels, sampwidth):
+            return
+        self.finish()
+        self.lease = self.manager.acquire_output(samplerate, channels, sampwidth)
+        self.format = (samplerate, channels, sampwidth)
+
+    def write(self, pcm):
+        if not memoryview(pcm).readonly:
+            # PyAudio只接受只读缓冲区
+            pcm = bytes(pcm)
+        self.lease.write(pcm)
+
+    def native_rate(self):
+        return self.manager.native_output_rate()
+
+    def finish(self):
+        # 一段音频播完后归还输出流（流保持打开，下次占用时无需重新打开）
+        if self.lease is not None:
+            self.lease.release()
+            self.lease = None
+            self.format = None
+
+    def abort(self):
+        if self.lease is not None:
+            # 关闭输出流，丢弃缓冲区中尚未播放的数据
+            self.lease.release(discard=True)
+            self.lease = None
+            self.format = None
+
+    def close(self):
+        self.finish()
+
+
+class SoundDeviceBackend(PlaybackBackend):
+    """通过sounddevice（PortAudio）播放"""
+
+    name = "sounddevice"
+
+    def __init__(self):
+        import sounddevice
+        self.sd = sounddevice
+        self.stream = None
+        self.format = None
+
+    def open(self, samplerate, channels, sampwidth):
+        if self.stream is not None and self.format == (samplerate, channels, sampwidth):
+            return
+        self.abort()
+        dtype = {1: "uint8", 2: "int16", 4: "int32"}[sampwidth]
+        self.stream = self.sd.RawOutputStream(samplerate=samplerate, channels=channels, dtype=dtype)
+        self.stream.start()
+        self.format = (samplerate, channels, sampwidth)
+
+    def write(self, pcm):
+        self.stream.write(pcm)
+
+    def native_rate(self):
+        try:
+            return int(self.sd.query_devices(kind="output")["default_samplerate"])
+        except Exception:
+            return None
+
+    def abort(self):
+        if self.stream is not None:
+            self.stream.abort()
+            self.stream.close()
+            self.stream = None
+            self.format = None
+
+    def close(self):
+        self.abort()
+
+
+class NullBackend(PlaybackBackend):
+    """不输出声音，只统计播放的数据；realtime为True时按音频时长等待，模拟真实设备"""
+
+    name = "null"
+
+    def __init__(self, realtime=False):
+        self.realtime = realtime
+        self.bytes_played = 0
+        self.items_played = 0
+        self.bytes_per_second = None
+
+    def open(self, samplerate, channels, sampwidth):
+        self.bytes_per_second = samplerate * channels * sampwidth
+
+    def write(self, pcm):
+        self.bytes_played += len(pcm)
+        if self.realtime:
+            time.sleep(len(pcm) / self.bytes_per_second)
+
+    def finish(self):
+        self.items_played += 1
+
+
+class FileBackend(PlaybackBackend):
+    """把每段播放的音频写入目录中的WAV文件，用于无声卡环境下检查播放内容"""
+
+    name = "file"
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.count = 0
+        self.file = None
+        self.paths = []
+
+    def open(self, samplerate, channels, sampwidth):
+        if self.file is not None:
+            return
+        self.count += 1
+        path = self.directory / f"playback_{int(time.time())}_{self.count:04d}.wav"
+        self.file = wave.open(str(path), "wb")
+        self.file.setnchannels(channels)
+        self.file.setsampwidth(sampwidth)
+        self.file.setframerate(samplerate)
+        self.paths.append(path)
+
+    def write(self, pcm):
+        self.file.writeframesraw(pcm)
+
+    def finish(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def abort(self):
+        self.finish()
+
+    def close(self):
+        self.finish()
+
+
+def create_backend(config=None):
+    """按配置创建播放后端"""
+    config = dict(DEFAULT_PLAYBACK_CONFIG, **(config or {}))
+    backend = config.get("backend", "auto")
+    if backend == "null":
+        return NullBackend()
+    if backend == "file":
+        return FileBackend(config.get("file_dir"))
+    candidates = {"pyaudio": PyAudioBackend, "sounddevice": SoundDeviceBackend}
+    names = list(candidates) if backend == "auto" else [backend]
+    for name in names:
+        if name not in candidates:
+            raise ValueError(f"未知的播放后端: {name}")
+        try:
+            return candidates[name]()
+        except Exception as e:
+            print(f"[播放后端{name}不可用: {e}]", file=sys.stderr)
+    print("[没有可用的声卡，语音回复将不会播放]", file=sys.stderr)
+    return NullBackend()
+
+
+class PlaybackService:
+    """进程内的后台播放服务
+
+    play_file()和play_pcm()只把音频放入播放队列就返回，由后台线程依次播放；
+    stop()清空队列并中断正在播放的音频。数据按block_frames分块写入设备，
+    每块之间检查是否已停止。dsp_factory(输入采样率, 设备原生采样率)返回
+    音频文件播放时使用的处理链（见audio_dsp.OutputDsp），返回None表示不处理。
+    """
+
+    def __init__(self, backend=None, block_frames=1024, dsp_factory=None):
+        self.backend = backend or create_backend()
+        self.block_frames = block_frames
+        self.dsp_factory = dsp_factory
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        # 每次stop()后加一，旧的播放任务随之作废
+        self.generation = 0
+        self.current = None
+        self.thread = threading.Thread(target=self._run, name="audio-playback", daemon=True)
+        self.thread.start()
+
+    def play_file(self, path):
+        """播放WAV文件（不阻塞）"""
+        self.queue.put((self.generation, Path(path), None))
+
+    def play_pcm(self, pcm, samplerate=24000, channels=1, sampwidth=2):
+        """播放PCM数据（不阻塞）；连续的数据块会无间隙地接着播放"""
+        self.queue.put((self.generation, pcm, (samplerate, channels, sampwidth)))
+
+    def call_when_done(self, callback):
+        """队列中已有的音频播完后（在播放线程中）调用callback(True)；被stop()清除时调用callback(False)"""
+        self.queue.put((self.generation, callback, CALLBACK))
+
+    def stop(self):
+        """停止播放并清空播放队列"""
+        with self.lock:
+            self.generation += 1
+        try:
+            while True:
+                item = self.queue.get_nowait()
+                if item is not None and item[2] is CALLBACK:
+                    self._call(item[1], False)
+                self.queue.task_done()
+        except queue.Empty:
+            pass
+
+    @property
+    def is_playing(self):
+        return self.queue.unfinished_tasks > 0
+
+    def wait(self, timeout=None):
+        """等待播放队列中的音频全部播完，超时返回False"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.is_playing:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def shutdown(self):
+        """停止播放并关闭设备"""
+        self.stop()
+        self.queue.put(None)
+        self.thread.join(timeout=2)
+        self.backend.close()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    break
+                generation, source, audio_format = item
+                if audio_format is CALLBACK:
+                    self._call(source, generation == self.generation)
+                    continue
+                if generation != self.generation:
+                    continue
+                self.current = source
+                try:
+                    if audio_format is None:
+                        self._play_file(generation, source)
+                    else:
+                        self._play_pcm(generation, source, audio_format)
+                except Exception as e:
+                    print(f"\n[播放音频时出错: {e}]")
+                    self.backend.abort()
+                finally:
+                    self.current = None
+            finally:
+                self.queue.task_done()
+
+    def _call(self, callback, finished):
+        try:
+            callback(finished)
+        except Exception as e:
+            print(f"\n[播放回调出错: {e}]", file=sys.stderr)
+
+    def _stopped(self, generation):
+        if generation != self.generation:
+            self.backend.abort()
+            return True
+        return False
+
+    def _play_file(self, generation, path):
+        with wave.open(str(path), "rb") as wav_file:
+            rate, channels, sampwidth = wav_file.getframerate(), wav_file.getnchannels(), wav_file.getsampwidth()
+            dsp = None
+            if self.dsp_factory and channels == 1 and sampwidth == 2:
+                dsp = self.dsp_factory(rate, self.backend.native_rate())
+            self.backend.open(dsp.out_rate if dsp else rate, channels, sampwidth)
+            while not self._stopped(generation):
+                data = wav_file.readframes(self.block_frames)
+                if not data:
+                    break
+                if dsp:
+                    data = dsp.process(data)
+                if data:
+                    self.backend.write(data)
+        self.backend.finish()
+
+    def _play_pcm(self, generation, pcm, audio_format):
+        samplerate, channels, sampwidth = audio_format
+        self.backend.open(samplerate, channels, sampwidth)
+        view = memoryview(pcm)
+        block_bytes = self.block_frames * channels * sampwidth
+        for offset in range(0, len(view), block_bytes):
+            if self._stopped(generation):
+                return
+            self.backend.write(view[offset:offset + block_bytes])
+        # 后面紧跟着同一段流的数据块时不结束，避免文件后端把一段回复拆成多个文件
+        if not self._pcm_follows():
+            self.backend.finish()
+
+    def _pcm_follows(self):
+        """队列中的下一项是否为PCM数据块（回调项不算）"""
+        with self.queue.mutex:
+            following = self.queue.queue[0] if self.queue.queue else None
+        return following is not None and following[2] is not None and following[2] is not CALLBACK
@@ -0,0 +1,363 @@
+import sys
+import time
+import wave
+import queue
+import base64
+import struct
+import binascii
+import tempfile
+import threading
+import tracemalloc
+
+# 模型语音回复的音频格式：24kHz、16位、单声道PCM
+SAMPLE_RATE = 24000
+SAMPLE_WIDTH = 2
+CHANNELS = 1
+
+
+def decode_pcm(audio_string):
+    """把base64音频数据解码为PCM
+
+    binascii直接读取ASCII字符串的内部存储，每个数据块只分配一次PCM大小的缓冲区；
+    返回的bytes在扬声器、文件等输出之间共享，不再经过NumPy转换和复制。
+    """
+    return binascii.a2b_base64(audio_string)
+
+
+class AudioSink:
+    """输出接口：接收解码后的PCM数据块和回复文字"""
+
+    name = "sink"
+    # 队列满时暂存到临时文件、不丢数据（True），还是丢弃数据块（False）
+    lossless = True
+    # 队列长度（数据块数），None表示使用分发器的默认值
+    queue_size = None
+
+    def write(self, pcm):
+        pass
+
+    def write_text(self, text):
+        pass
+
+    def close(self):
+        pass
+
+
+class SpeakerSink(AudioSink):
+    """扬声器输出，play(pcm, samplerate)为写入声卡的函数；dsp为可选的处理链（见audio_dsp.OutputDsp）
+
+    模型生成音频比实时播放快，队列要能容纳整段回复，否则多出的部分暂存到临时文件。
+    """
+
+    name = "speaker"
+    queue_size = 4096
+
+    def __init__(self, play, dsp=None, samplerate=SAMPLE_RATE):
+        self.play = play
+        self.dsp = dsp
+        self.samplerate = dsp.out_rate if dsp else samplerate
+
+    def write(self, pcm):
+        if self.dsp:
+            pcm = self.dsp.process(pcm)
+        if pcm:
+            self.play(pcm, self.samplerate)
+
+
+class WavFileSink(AudioSink):
+    """写入WAV文件"""
+
+    name = "wav"
+
+    def __init__(self, path, samplerate=SAMPLE_RATE):
+        self.path = path
+        self.file = wave.open(str(path), "wb")
+        self.file.setnchannels(CHANNELS)
+        self.file.setsampwidth(SAMPLE_WIDTH)
+        self.file.setframerate(samplerate)
+
+    def write(self, pcm):
+        self.file.writeframesraw(pcm)
+
+    def close(self):
+        # close()时会回填WAV头中的数据长度
+        self.file.close()
+
+
+class FlacFileSink(AudioSink):
+    """写入FLAC文件（需要soundfile）"""
+
+    name = "flac"
+
+    def __init__(self, path, samplerate=SAMPLE_RATE):
+        import numpy as np
+        import soundfile as sf
+        self.np = np
+        self.path = path
+        self.file = sf.SoundFile(str(path), mode="w", samplerate=samplerate,
+                                 channels=CHANNELS, subtype="PCM_16", format="FLAC")
+
+    def write(self, pcm):
+        self.file.write(self.np.frombuffer(pcm, dtype=self.np.int16))
+
+    def close(self):
+        self.file.close()
+
+
+class TextFileSink(AudioSink):
+    """把回复文字写入文本文件"""
+
+    name = "text"
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "w", encoding="utf-8")
+
+    def write_text(self, text):
+        self.file.write(text)
+
+    def close(self):
+        self.file.close()
+
+
+class SocketSink(AudioSink):
+    """通过套接字发送原始PCM数据，对方接收太慢时丢弃数据块"""
+
+    name = "socket"
+    lossless = False
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def write(self, pcm):
+        self.sock.sendall(pcm)
+
+
+class BufferSink(AudioSink):
+    """保存在内存中"""
+
+    name = "buffer"
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.text = []
+
+    def write(self, pcm):
+        self.buffer += pcm
+
+    def write_text(self, text):
+        self.text.append(text)
+
+    def getvalue(self):
+        return bytes(self.buffer)
+
+    def gettext(self):
+        return "".join(self.text)
+
+
+# 暂存到临时文件的记录：类型(1字节) + 长度(4字节) + 数据
+_SPILL_HEADER = struct.Struct("!cI")
+_SPILL_KINDS = {"audio": b"a", "text": b"t", None: b"c"}
+_SPILL_NAMES = {value: key for key, value in _SPILL_KINDS.items()}
+
+
+class QueuedSink:
+    """为单个输出配一个有界队列和写入线程，慢的输出不会阻塞音频流
+
+    队列满时丢弃该输出的数据块并计数；lossless=True时改为按顺序暂存到临时文件，
+    由写入线程读回，只有这个输出落后，写入方和其他输出都不等待，内存占用仍然有界。
+    """
+
+    def __init__(self, sink, queue_size=256, lossless=False):
+        self.sink = sink
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lossless = lossless
+        self.dropped = 0
+        self.spilled = 0
+        self.error = None
+        # 临时文件中尚未读回的记录（有记录时新数据也写入文件，保证顺序）
+        self.spill_lock = threading.Lock()
+        self.spill_file = None
+        self.spill_read_at = 0
+        self.spill_write_at = 0
+        self.spill_pending = 0
+        self.thread = threading.Thread(target=self._run, name=f"audio-sink-{sink.name}", daemon=True)
+        self.thread.start()
+
+    def _spill(self, item):
+        kind, data = item if item is not None else (None, b"")
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile(prefix="audio-sink-")
+        self.spill_file.seek(self.spill_write_at)
+        self.spill_file.write(_SPILL_HEADER.pack(_SPILL_KINDS[kind], len(data)))
+        self.spill_file.write(data)
+        self.spill_write_at = self.spill_file.tell()
+        self.spill_pending += 1
+        self.spilled += 1
+
+    def _unspill(self):
+        self.spill_file.seek(self.spill_read_at)
+        kind, size = _SPILL_HEADER.unpack(self.spill_file.read(_SPILL_HEADER.size))
+        data = self.spill_file.read(size)
+        self.spill_read_at = self.spill_file.tell()
+        self.spill_pending -= 1
+        if self.spill_pending == 0:
+            # 读完后从头复用文件
+            self.spill_read_at = self.spill_write_at = 0
+            self.spill_file.truncate(0)
+        kind = _SPILL_NAMES[kind]
+        if kind is None:
+            return None
+        return kind, data.decode("utf-8") if kind == "text" else data
+
+    def _next(self):
+        # 队列中的数据都比临时文件中的早，队列取空后再读临时文件
+        with self.spill_lock:
+            if self.spill_pending and self.queue.empty():
+                return self._unspill()
+        return self.queue.get()
+
+    def _run(self):
+        while True:
+            item = self._next()
+            if item is None:
+                break
+            if self.error is not None:
+                continue
+            kind, data = item
+            try:
+                if kind == "audio":
+                    self.sink.write(data)
+                else:
+                    self.sink.write_text(data)
+            except Exception as e:
+                self.error = e
+                print(f"\n[音频输出({self.sink.name})出错: {e}]")
+        try:
+            self.sink.close()
+        except Exception as e:
+            print(f"\n[关闭音频输出({self.sink.name})时出错: {e}]")
+        if self.spill_file is not None:
+            self.spill_file.close()
+
+    def put(self, item):
+        if self.lossless:
+            with self.spill_lock:
+                if not self.spill_pending:
+                    try:
+                        self.queue.put_nowait(item)
+                        return
+                    except queue.Full:
+                        pass
+                self._spill(item)
+            return
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        if self.lossless:
+            self.put(None)
+        else:
+            self.queue.put(None)
+        self.thread.join()
+
+
+class AudioTee:
+    """把每个音频数据块只解码一次，分发给多个输出（扬声器、文件、套接字、内存等），
+    每个输出有自己的有界队列和线程"""
+
+    def __init__(self, sinks=None, queue_size=256):
+        self.queue_size = queue_size
+        self.outputs = []
+        self.bytes_written = 0
+        for sink in sinks or []:
+            self.add(sink)
+
+    def add(self, sink, lossless=None):
+        """添加输出；lossless默认取sink.lossless"""
+        if lossless is None:
+            lossless = sink.lossless
+        self.outputs.append(QueuedSink(sink, sink.queue_size or self.queue_size, lossless))
+        return sink
+
+    def write(self, pcm):
+        """分发一块PCM数据"""
+        if not pcm:
+            return
+        self.bytes_written += len(pcm)
+        for output in self.outputs:
+            output.put(("audio", pcm))
+
+    def write_text(self, text):
+        """分发一段回复文字"""
+        if not text:
+            return
+        for output in self.outputs:
+            output.put(("text", text))
+
+    def write_base64(self, audio_string):
+        """解码一块base64音频数据并分发"""
+        self.write(decode_pcm(audio_string))
+
+    def close(self):
+        """等待所有输出写完并关闭"""
+        for output in self.outputs:
+            output.close()
+
+    def stats(self):
+        return {
+            "bytes": self.bytes_written,
+            "dropped": {output.sink.name: output.dropped for output in self.outputs},
+            "spilled": {output.sink.name: output.spilled for output in self.outputs},
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+
+
+def _legacy_decode(audio_string):
+    """原来的做法：b64decode（先编码成bytes再解码）后经NumPy转换，再tobytes()复制一次"""
+    pcm = base64.b64decode(audio_string)
+    try:
+        import numpy as np
+    except ImportError:
+        return bytes(pcm)
+    return np.frombuffer(pcm, dtype=np.int16).tobytes()
+
+
+def benchmark_decode(seconds=60, chunk_ms=100):
+    """用tracemalloc测量每秒音频的内存分配量，比较原来的解码方式和decode_pcm
+
+    每个数据块内的临时对象会立即释放，这里按每块的峰值增量累计。
+    """
+    chunk_bytes = SAMPLE_RATE * SAMPLE_WIDTH * chunk_ms // 1000
+    chunk = base64.b64encode((bytes(range(256)) * (chunk_bytes // 256 + 1))[:chunk_bytes]).decode("ascii")
+    chunks = [chunk] * (seconds * 1000 // chunk_ms)
+    for name, decode in (("b64decode+NumPy", _legacy_decode), ("decode_pcm", decode_pcm)):
+        decode(chunk)
+        tracemalloc.start()
+        allocated = 0
+        start = time.perf_counter()
+        for data in chunks:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            pcm = memoryview(decode(data))
+            allocated += tracemalloc.get_traced_memory()[1] - before
+            pcm.release()
+            del pcm
+        elapsed = time.perf_counter() - start
+        tracemalloc.stop()
+        print(f"{name:>16}: 每秒音频分配 {allocated / seconds / 1024:8.1f} KB "
+              f"(PCM {SAMPLE_RATE * SAMPLE_WIDTH / 1024:.1f} KB)，"
+              f"解码耗时 {elapsed / seconds * 1000:.3f} 毫秒/秒音频")
+
+
+if __name__ == "__main__":
+    benchmark_decode(int(sys.argv[1]) if len(sys.argv) > 1 else 60)
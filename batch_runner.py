@@ -0,0 +1,252 @@
+import os
+import sys
+import csv
+import json
+import time
+import hashlib
+import argparse
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import qwen_chat
+
+# 清单中每一轮可用的字段
+MANIFEST_FIELDS = ["id", "prompt", "image", "audio", "video", "model", "modalities"]
+
+# 没有填写提示词时使用的默认提示词
+DEFAULT_PROMPTS = {
+    "audio": "我刚才说的是什么？请回答我的问题或请求。",
+    "image": "请描述这张图片的内容。",
+    "video": "概述这个视频的内容。",
+}
+
+
+def parse_modalities(value):
+    """解析输出模态，支持列表或以逗号/竖线/空格分隔的字符串"""
+    if not value:
+        return ["text"]
+    if isinstance(value, list):
+        modalities = value
+    else:
+        modalities = str(value).replace("|", ",").replace(" ", ",").split(",")
+    modalities = [m.strip() for m in modalities if m.strip()]
+    if "text" not in modalities:
+        modalities.insert(0, "text")
+    return modalities
+
+
+def safe_filename(turn_id, max_length=80):
+    """把清单中的id转换为安全的文件名部分：只保留字母、数字、"-"和"_"，
+    不能包含路径分隔符或".."；有字符被替换时附加原id的摘要，避免不同id得到相同的文件名"""
+    safe = "".join(c if c.isalnum() or c in "-_" else "_" for c in turn_id)[:max_length]
+    if safe != turn_id:
+        safe += "_" + hashlib.sha256(turn_id.encode("utf-8")).hexdigest()[:8]
+    return safe
+
+
+def load_manifest(manifest_path):
+    """读取JSONL或CSV格式的清单，返回每一轮的参数列表"""
+    manifest_path = Path(manifest_path)
+    turns = []
+    if manifest_path.suffix.lower() == ".csv":
+        with open(manifest_path, "r", encoding="utf-8-sig", newline="") as file:
+            for row in csv.DictReader(file):
+                turns.append({key: (row.get(key) or "").strip() or None for key in MANIFEST_FIELDS})
+    else:
+        with open(manifest_path, "r", encoding="utf-8") as file:
+            for line_number, line in enumerate(file, 1):
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                try:
+                    turns.append(json.loads(line))
+                except json.JSONDecodeError as e:
+                    print(f"[清单第{line_number}行格式错误，已跳过: {e}]")
+
+    # 没有id的轮次按序号编号，用于断点续跑
+    for index, turn in enumerate(turns):
+        if not turn.get("id"):
+            turn["id"] = str(index)
+        turn["id"] = str(turn["id"])
+    return turns
+
+
+def load_checkpoint(output_path):
+    """从已有的输出文件中找出已成功完成的轮次"""
+    done = set()
+    if not Path(output_path).exists():
+        return done
+    with open(output_path, "r", encoding="utf-8") as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # 崩溃时可能写了半行，忽略即可
+                continue
+            if not record.get("error"):
+                done.add(str(record.get("id")))
+    return done
+
+
+def build_turn_message(turn, base_dir):
+    """按清单中的一轮构建用户消息"""
+    def resolve(path):
+        return Path(path) if os.path.isabs(path) else Path(base_dir) / path
+
+    # 每种媒体可以是一个路径，也可以是路径列表（同一轮中的多张图片等）
+    paths = []
+    media_kind = None
+    for kind in ("audio", "image", "video"):
+        value = turn.get(kind)
+        if not value:
+            continue
+        media_kind = media_kind or kind
+        paths.extend(resolve(path) for path in (value if isinstance(value, list) else [value]))
+    attachments = qwen_chat.prepare_attachments(paths)
+
+    text = turn.get("prompt") or DEFAULT_PROMPTS.get(media_kind, "")
+    return qwen_chat.build_user_message(text, attachments=attachments)
+
+
+def run_turn(turn, base_dir, default_model, audio_dir):
+    """执行一轮对话，返回输出记录"""
+    record = {"id": turn["id"], "model": turn.get("model") or default_model}
+    start_time = time.time()
+    try:
+        modalities = parse_modalities(turn.get("modalities"))
+        completion_args = {
+            "model": record["model"],
+            "messages": [build_turn_message(turn, base_dir)],
+            "modalities": modalities,
+            "stream": True,
+            "stream_options": {"include_usage": True},
+        }
+        use_audio = "audio" in modalities
+        if use_audio:
+            completion_args["audio"] = {"voice": "Cherry", "format": "wav"}
+
+        full_response = ""
+        transcript = ""
+        first_token_latency = None
+        audio_path = None
+        audio_tee = None
+        if use_audio:
+            # 音频边接收边解码写入文件，不在内存中拼接base64字符串
+            audio_path = Path(audio_dir or qwen_chat.output_dir) / f"batch_{safe_filename(turn['id'])}.wav"
+            audio_tee = qwen_chat.create_audio_tee(audio_path)
+        try:
+            for chunk in qwen_chat.stream_completion(completion_args, session_id="batch", priority="batch"):
+                if first_token_latency is None:
+                    first_token_latency = time.time() - start_time
+                if chunk.choices:
+                    delta = chunk.choices[0].delta
+                    if delta.content:
+                        full_response += delta.content
+                    audio = getattr(delta, "audio", None)
+                    if use_audio and isinstance(audio, dict):
+                        if audio.get("data"):
+                            audio_tee.write_base64(audio["data"])
+                        transcript += audio.get("transcript", "")
+                elif getattr(chunk, "usage", None):
+                    record["usage"] = {
+                        "prompt_tokens": chunk.usage.prompt_tokens,
+                        "completion_tokens": chunk.usage.completion_tokens,
+                    }
+        finally:
+            if audio_tee:
+                audio_path = qwen_chat.finish_audio_tee(audio_tee, audio_path)
+
+        record["text"] = full_response or transcript
+        if audio_path:
+            record["audio_path"] = str(audio_path)
+        record["first_token_latency"] = first_token_latency
+    except Exception as e:
+        record["error"] = str(e)
+    record["latency"] = time.time() - start_time
+    return record
+
+
+def percentile(values, percent):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+def print_summary(records, skipped, elapsed):
+    """输出吞吐量和延迟汇总"""
+    succeeded = [r for r in records if not r.get("error")]
+    latencies = [r["latency"] for r in succeeded]
+    first_tokens = [r["first_token_latency"] for r in succeeded if r.get("first_token_latency") is not None]
+    tokens = sum(r.get("usage", {}).get("completion_tokens", 0) for r in succeeded)
+
+    def fmt(value):
+        return f"{value:.2f}秒" if value is not None else "-"
+
+    print("\n========== 批处理汇总 ==========")
+    print(f"完成: {len(succeeded)}  失败: {len(records) - len(succeeded)}  跳过(已完成): {skipped}")
+    print(f"总耗时: {elapsed:.1f}秒  吞吐量: {len(succeeded) / elapsed if elapsed > 0 else 0:.2f}轮/秒"
+          f"  输出tokens: {tokens} ({tokens / elapsed if elapsed > 0 else 0:.1f}/秒)")
+    print(f"首字延迟 p50: {fmt(percentile(first_tokens, 50))}  p95: {fmt(percentile(first_tokens, 95))}")
+    print(f"总延迟   p50: {fmt(percentile(latencies, 50))}  p95: {fmt(percentile(latencies, 95))}"
+          f"  最大: {fmt(max(latencies) if latencies else None)}")
+
+
+def run_batch(manifest_path, output_path, concurrency=4, model=None, audio_dir=None):
+    """并发执行清单中的所有轮次，结果逐条追加写入输出文件；返回失败的轮次数"""
+    turns = load_manifest(manifest_path)
+    done = load_checkpoint(output_path)
+    pending = [turn for turn in turns if turn["id"] not in done]
+    skipped = len(turns) - len(pending)
+    print(f"[清单共{len(turns)}轮，已完成{skipped}轮，本次执行{len(pending)}轮，并发数{concurrency}]")
+
+    if audio_dir:
+        Path(audio_dir).mkdir(parents=True, exist_ok=True)
+    default_model = model or qwen_chat.get_selected_model()
+    base_dir = Path(manifest_path).resolve().parent
+
+    # 初始化密钥池（没有密钥时会请求输入）
+    qwen_chat.get_key_pool()
+
+    records = []
+    write_lock = threading.Lock()
+    start_time = time.time()
+    with open(output_path, "a", encoding="utf-8") as output_file, \
+            ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(run_turn, turn, base_dir, default_model, audio_dir) for turn in pending]
+        try:
+            for index, future in enumerate(as_completed(futures), 1):
+                record = future.result()
+                records.append(record)
+                # 每条结果立即落盘，崩溃后可从输出文件继续
+                with write_lock:
+                    output_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    output_file.flush()
+                status = f"失败: {record['error']}" if record.get("error") else f"{record['latency']:.1f}秒"
+                print(f"[{index}/{len(pending)}] {record['id']} {status}")
+        except KeyboardInterrupt:
+            print("\n[已中断，正在取消未开始的轮次，下次运行将从断点继续]")
+            for future in futures:
+                future.cancel()
+
+    print_summary(records, skipped, time.time() - start_time)
+    return sum(1 for r in records if r.get("error"))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="按清单批量执行Qwen Omni对话")
+    parser.add_argument("manifest", help="清单文件(.jsonl或.csv)，字段: " + ", ".join(MANIFEST_FIELDS))
+    parser.add_argument("-o", "--output", help="输出JSONL文件，同时作为断点文件 (默认: <清单名>.results.jsonl)")
+    parser.add_argument("-c", "--concurrency", type=int, default=4, help="并发数 (默认: 4)")
+    parser.add_argument("-m", "--model", help="默认模型 (默认: 配置文件中选择的模型)")
+    parser.add_argument("--audio-dir", help="语音回复保存目录 (默认: audio_output)")
+    args = parser.parse_args(argv)
+
+    output_path = args.output or str(Path(args.manifest).with_suffix(".results.jsonl"))
+    failed = run_batch(args.manifest, output_path, max(1, args.concurrency), args.model, args.audio_dir)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
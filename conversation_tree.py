@@ -0,0 +1,188 @@
+import threading
+
+from message_model import ROLE_USER, ROLE_ASSISTANT
+
+
+class Turn:
+    """对话树中的一个节点，保存一条消息
+
+    节点的消息和父节点创建后不再修改（只会增加子节点），各分支共用相同的前缀节点。
+    request为该用户消息实际发送时的完整内容（含媒体句柄），重新生成回复时再次发送，
+    没有时发送message；message是写入对话记录的内容（只保留文字）。
+    """
+
+    __slots__ = ("message", "request", "parent", "children", "depth", "active")
+
+    def __init__(self, message, parent=None, request=None):
+        self.message = message
+        self.request = request
+        self.parent = parent
+        self.children = []
+        self.depth = parent.depth + 1 if parent is not None else 0
+        # 最近一次访问的子节点，切换分支时沿它回到该分支的最新位置
+        self.active = None
+
+    @property
+    def role(self):
+        return self.message.role if self.message is not None else None
+
+    def __repr__(self):
+        return f"Turn({self.depth}, {self.message!r})"
+
+
+class ConversationTree:
+    """树形的对话记录：重试和编辑生成新的分支，各分支共用公共前缀
+
+    head指向当前分支的最后一条消息。分叉、重新生成、编辑和切换分支只移动head或
+    增加一个节点，不复制消息列表；内存只与分叉后新增的消息数量成正比。
+    """
+
+    def __init__(self, root=None, head=None, lock=None):
+        self.root = root or Turn(None)
+        self.head = head or self.root
+        # 同一棵树的多个游标（见fork）共用一把锁
+        self.lock = lock or threading.Lock()
+        # 保留了内存中媒体数据（录音、压缩后的图片等）的用户消息节点，只保留最近一条
+        self.memory_turn = None
+
+    def __len__(self):
+        return self.head.depth
+
+    def history(self, turn=None):
+        """从根到turn（默认head）的消息列表，用作请求的messages"""
+        turn = turn or self.head
+        messages = [None] * turn.depth
+        while turn.parent is not None:
+            messages[turn.depth - 1] = turn.message
+            turn = turn.parent
+        return messages
+
+    def add(self, parent, message, request=None):
+        """在parent下增加一个子节点（不移动head），返回新节点"""
+        turn = Turn(message, parent, request)
+        with self.lock:
+            parent.children.append(turn)
+            parent.active = turn
+        return turn
+
+    def append(self, message, request=None):
+        """在当前分支末尾增加一条消息并移动head"""
+        self.head = self.add(self.head, message, request)
+        return self.head
+
+    def commit(self, parent, user_message, reply, user_turn=None):
+        """记录一轮对话：用户消息只保留文字，完整内容留作重新生成时发送，head移到回复
+
+        只引用文件的媒体句柄总是保留；媒体数据在内存中时只保留最近一轮的，
+        更早的用户消息重新生成时只发送文字，对话越长内存占用也不会随之增长。
+        user_turn不为None时（重新生成）回复作为该用户消息下的新分支。
+        """
+        if user_turn is None:
+            request = user_message if user_message.has_media else None
+            user_turn = self.add(parent, user_message.text_only(), request)
+            if request is not None and not request.file_backed:
+                self._keep_in_memory(user_turn)
+        self.head = self.add(user_turn, reply)
+        return self.head
+
+    def _keep_in_memory(self, user_turn):
+        with self.lock:
+            previous, self.memory_turn = self.memory_turn, user_turn
+            if previous is not None and previous is not user_turn:
+                previous.request = None
+
+    def switch(self, turn):
+        """切换到任意节点，沿途记录所选的分支"""
+        with self.lock:
+            self.head = turn
+            while turn.parent is not None:
+                turn.parent.active = turn
+                turn = turn.parent
+
+    def fork(self, turn=None):
+        """从turn（默认head）分叉出新的游标，与当前游标共用节点，之后各自增加消息"""
+        return ConversationTree(self.root, turn or self.head, self.lock)
+
+    def last_user_turn(self):
+        """当前分支最后一条用户消息，没有时返回None"""
+        turn = self.head
+        while turn.parent is not None and turn.role != ROLE_USER:
+            turn = turn.parent
+        return turn if turn.role == ROLE_USER else None
+
+    def regenerate(self):
+        """准备重新生成最后一条回复，返回对应的用户消息节点（没有时返回None）
+
+        调用方发送history(user_turn.parent) + [request_for(user_turn)]，新回复用
+        commit(..., user_turn=user_turn)记录为原回复的兄弟分支；请求失败时head不变。
+        """
+        return self.last_user_turn()
+
+    def edit_last(self):
+        """准备编辑最后一条用户消息：head移到它之前，返回原来的用户消息节点（没有时返回None）
+
+        之后发送的消息成为原消息的兄弟分支，原来的分支仍然保留，可以切换回去。
+        """
+        user_turn = self.last_user_turn()
+        if user_turn is not None:
+            self.head = user_turn.parent
+        return user_turn
+
+    def request_for(self, user_turn):
+        """重新发送该用户消息时使用的完整内容"""
+        return user_turn.request or user_turn.message
+
+    def siblings(self, turn=None):
+        """turn（默认head）及其兄弟分支，和turn在其中的位置"""
+        turn = turn or self.head
+        if turn.parent is None:
+            return [turn], 0
+        with self.lock:
+            siblings = list(turn.parent.children)
+        return siblings, siblings.index(turn)
+
+    def branch_point(self):
+        """当前分支上离head最近、有多个分支可选的节点，没有时返回None"""
+        turn = self.head
+        while turn.parent is not None:
+            if len(turn.parent.children) > 1:
+                return turn
+            turn = turn.parent
+        return None
+
+    def switch_branch(self, offset=1):
+        """在最近的分叉处切换到前一个（offset=-1）或后一个兄弟分支，并回到该分支的最新位置
+
+        返回(位置, 分支数)，没有可切换的分支时返回None。
+        """
+        turn = self.branch_point()
+        if turn is None:
+            return None
+        siblings, index = self.siblings(turn)
+        index = (index + offset) % len(siblings)
+        target = siblings[index]
+        with self.lock:
+            # 分叉处以上的节点已经指向当前分支，只需更新分叉处
+            turn.parent.active = target
+            while target.active is not None:
+                target = target.active
+            self.head = target
+        return index, len(siblings)
+
+    def clear(self):
+        """开始新的对话（原来的对话树不再被引用后释放）"""
+        with self.lock:
+            self.root = Turn(None)
+            self.head = self.root
+            self.memory_turn = None
+
+
+def format_history(messages):
+    """把消息列表格式化为界面和命令行显示的文字"""
+    lines = []
+    for message in messages:
+        if message.role == ROLE_USER:
+            lines.append(f"你: {message.text}\n")
+        elif message.role == ROLE_ASSISTANT:
+            lines.append(f"助手: {message.text}\n")
+    return "".join(lines)
@@ -0,0 +1,623 @@
+import io
+import sys
+import json
+import math
+import time
+import wave
+import base64
+import argparse
+import threading
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+
+import qwen_chat
+import streaming_body
+from audio_sinks import AudioTee, SpeakerSink, SAMPLE_RATE as REPLY_RATE
+from media_handles import MediaHandle
+from message_model import Message
+from conversation_tree import ConversationTree
+from tracing import TurnTrace, TraceExporter, traced, load_traces, describe_trace
+
+# 默认配置
+DEFAULT_DUPLEX_CONFIG = {
+    # 麦克风采样率和每帧时长(毫秒)
+    "rate": 16000,
+    "frame_ms": 30,
+    # 音量高于噪声底的多少倍算作说话，以及最低音量（16位PCM的RMS）
+    "speech_ratio": 3.0,
+    "min_rms": 300,
+    # 连续说话多久才算开始一句话（过滤咳嗽、敲击等短促噪声）
+    "start_ms": 120,
+    # 静音多久算一句话结束；越短回复越快，但句中停顿可能被切断
+    "end_silence_ms": 600,
+    # 句首保留的说话前音频，避免切掉第一个字
+    "pre_roll_ms": 300,
+    # 有效语音短于该时长的片段丢弃
+    "min_utterance_ms": 300,
+    # 一句话的最长时长(秒)，超过时直接发送
+    "max_utterance_s": 30,
+    # 播放回复时扬声器的声音会被麦克风录到：阈值再乘以该倍数，且需要持续更久才算打断
+    "barge_in_ratio": 2.0,
+    "barge_in_ms": 250,
+    # 打断后等待上一轮请求结束的最长时间(秒)
+    "cancel_timeout": 2.0,
+    "voice": "Cherry",
+}
+
+# 会话状态
+LISTENING = "listening"    # 等待用户说话
+THINKING = "thinking"      # 已发送一句话，等待回复
+RESPONDING = "responding"  # 正在播放回复（仍在监听，用户开口即打断）
+
+STATE_LABELS = {LISTENING: "聆听中", THINKING: "思考中", RESPONDING: "回复中"}
+
+VOICE_PROMPT = "我刚才说的是什么？请回答我的问题或请求。"
+
+
+def wav_bytes(pcm, rate, channels=1, sampwidth=2):
+    """把PCM数据封装为内存中的WAV文件"""
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav_file:
+        wav_file.setnchannels(channels)
+        wav_file.setsampwidth(sampwidth)
+        wav_file.setframerate(rate)
+        wav_file.writeframes(pcm)
+    return buffer.getvalue()
+
+
+class EnergyVAD:
+    """基于音量的语音检测：跟踪环境噪声底，音量明显高于噪声底的帧判为语音"""
+
+    def __init__(self, config=None):
+        config = dict(DEFAULT_DUPLEX_CONFIG, **(config or {}))
+        self.ratio = config["speech_ratio"]
+        self.min_rms = config["min_rms"]
+        self.noise_floor = None
+
+    @staticmethod
+    def rms(frame):
+        samples = np.frombuffer(frame, dtype="<i2").astype(np.float32)
+        if not len(samples):
+            return 0.0
+        return float(np.sqrt(np.mean(samples * samples)))
+
+    def threshold(self, scale=1.0):
+        return max(self.min_rms, (self.noise_floor or 0.0) * self.ratio) * scale
+
+    def is_speech(self, frame, scale=1.0):
+        """判断一帧是否为语音；scale>1时提高阈值（播放回复时），此时不更新噪声底"""
+        level = self.rms(frame)
+        speech = level > self.threshold(scale)
+        if not speech and scale == 1.0:
+            self.noise_floor = level if self.noise_floor is None else self.noise_floor * 0.95 + level * 0.05
+        return speech
+
+
+class UtteranceSegmenter:
+    """把麦克风的音频帧切分为一句句话
+
+    feed()在检测到开始说话时返回("start", None)，一句话结束时返回("end", pcm)，
+    片段太短时返回("discard", None)，其余情况返回None。
+    """
+
+    def __init__(self, vad, config=None):
+        config = dict(DEFAULT_DUPLEX_CONFIG, **(config or {}))
+        frame_ms = self.frame_ms = config["frame_ms"]
+        self.vad = vad
+        self.barge_in_ratio = config["barge_in_ratio"]
+        self.start_frames = max(1, math.ceil(config["start_ms"] / frame_ms))
+        self.barge_in_frames = max(1, math.ceil(config["barge_in_ms"] / frame_ms))
+        self.end_frames = max(1, math.ceil(config["end_silence_ms"] / frame_ms))
+        self.min_speech_frames = max(1, math.ceil(config["min_utterance_ms"] / frame_ms))
+        self.max_frames = int(config["max_utterance_s"] * 1000 / frame_ms)
+        self.pre_roll = deque(maxlen=max(1, math.ceil(config["pre_roll_ms"] / frame_ms)) + self.barge_in_frames)
+        self.frames = []
+        self.in_speech = False
+        self.speech_run = 0
+        self.speech_frames = 0
+        self.silence_run = 0
+        # 开始说话（连续语音的第一帧）和最后一个语音帧的时间，即用户开始和停止说话的时刻
+        self.speech_started_at = None
+        self.last_speech_at = None
+
+    def feed(self, frame, playing=False):
+        speech = self.vad.is_speech(frame, self.barge_in_ratio if playing else 1.0)
+        if not self.in_speech:
+            self.pre_roll.append(frame)
+            if not speech:
+                self.speech_run = 0
+                return None
+            self.speech_run += 1
+            if self.speech_run < (self.barge_in_frames if playing else self.start_frames):
+                return None
+            self.in_speech = True
+            self.frames = list(self.pre_roll)
+            self.pre_roll.clear()
+            self.speech_frames = self.speech_run
+            self.silence_run = 0
+            self.last_speech_at = time.monotonic()
+            self.speech_started_at = self.last_speech_at - (self.speech_run - 1) * self.frame_ms / 1000
+            return "start", None
+
+        self.frames.append(frame)
+        if speech:
+            self.speech_frames += 1
+            self.silence_run = 0
+            self.last_speech_at = time.monotonic()
+        else:
+            self.silence_run += 1
+        if self.silence_run < self.end_frames and len(self.frames) < self.max_frames:
+            return None
+
+        # 去掉末尾的静音（保留约100毫秒）
+        keep = len(self.frames) - max(0, self.silence_run - 3)
+        pcm = b"".join(self.frames[:keep])
+        enough = self.speech_frames >= self.min_speech_frames
+        self.reset()
+        return ("end", pcm) if enough else ("discard", None)
+
+    def reset(self):
+        self.frames = []
+        self.in_speech = False
+        self.speech_run = 0
+        self.speech_frames = 0
+        self.silence_run = 0
+
+
+class DeviceMic:
+    """麦克风输入（使用进程共享的音频设备）"""
+
+    def __init__(self, rate, frame_samples):
+        self.frame_samples = frame_samples
+        self.lease = qwen_chat.get_audio_devices().acquire_input(rate, 1, frame_samples, 2)
+
+    def read(self):
+        return self.lease.read(self.frame_samples)
+
+    def close(self):
+        self.lease.release()
+
+
+class FileMic:
+    """从WAV文件读取音频的模拟麦克风，用于测试和复现问题
+
+    realtime为True时按音频时长逐帧返回，与真实麦克风的节奏一致；文件读完后再返回
+    tail_silence秒静音，最后返回None。文件需为16位单声道，采样率与配置一致。
+    """
+
+    def __init__(self, path, rate, frame_samples, realtime=True, tail_silence=2.0):
+        self.wav = wave.open(str(path), "rb")
+        if (self.wav.getnchannels(), self.wav.getsampwidth(), self.wav.getframerate()) != (1, 2, rate):
+            self.wav.close()
+            raise ValueError(f"{path}需为{rate}Hz、16位、单声道的WAV文件")
+        self.frame_samples = frame_samples
+        self.frame_seconds = frame_samples / rate
+        self.realtime = realtime
+        self.tail_frames = int(tail_silence / self.frame_seconds)
+        self.count = 0
+        self.start = None
+
+    def read(self):
+        if self.start is None:
+            self.start = time.monotonic()
+        if self.realtime:
+            delay = self.start + self.count * self.frame_seconds - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        self.count += 1
+        data = self.wav.readframes(self.frame_samples)
+        if data:
+            return data.ljust(self.frame_samples * 2, b"\0")
+        if self.tail_frames > 0:
+            self.tail_frames -= 1
+            return bytes(self.frame_samples * 2)
+        return None
+
+    def close(self):
+        self.wav.close()
+
+
+class _Reply:
+    """一轮进行中的回复，各阶段的时间记录在trace中（tracing.TurnTrace）"""
+
+    def __init__(self, pcm, speech_start_at, last_speech_at, previous, trace):
+        self.pcm = pcm
+        self.previous = previous
+        # 打断时取消：正在等待首个数据的请求也立即断开
+        self.cancel = streaming_body.CancelToken()
+        self.done = False
+        self.thread = None
+        self.trace = trace
+        trace.mark("record_start", speech_start_at)
+        trace.mark("record_end", last_speech_at)
+        trace.mark("vad_end")
+        self.interrupted = False
+
+    def mark(self, name):
+        self.trace.mark(name)
+
+    def timings(self):
+        """各阶段相对用户停止说话的耗时(毫秒)"""
+        return self.trace.offsets("record_end")
+
+
+class DuplexSession:
+    """全双工语音对话：麦克风一直打开，按语音检测切分句子，每句话结束立即发送，
+    边播放回复边继续监听，用户开口即打断（停止播放并取消进行中的请求）
+
+    麦克风帧由run()所在线程逐帧处理，每轮回复在单独的线程中请求和播放：
+    录音、发送、接收和播放互相重叠。complete(completion_args, trace, cancel)返回流式数据块的迭代器，
+    cancel（streaming_body.CancelToken）被取消后数据流应立即结束，
+    默认经由qwen_chat.stream_completion（模型路由、限流、密钥池等照常生效）。
+    每轮从开始说话到回复播完的各阶段记录为一条跟踪记录（见tracing），由exporter导出。
+    """
+
+    def __init__(self, complete=None, playback=None, conversation=None, config=None, model=None, on_event=None,
+                 exporter=None):
+        self.config = dict(DEFAULT_DUPLEX_CONFIG, **(config or {}))
+        self.complete = complete or (lambda args, trace, cancel: qwen_chat.stream_completion(
+            args, session_id="duplex", priority="voice", trace=trace, cancel=cancel))
+        self.exporter = exporter or qwen_chat.get_trace_exporter()
+        self.playback = playback or qwen_chat.get_playback_service()
+        self.conversation = conversation or ConversationTree()
+        self.model = model or qwen_chat.get_selected_model()
+        self.on_event = on_event or print_event
+        self.vad = EnergyVAD(self.config)
+        self.segmenter = UtteranceSegmenter(self.vad, self.config)
+        self.frame_samples = self.config["rate"] * self.config["frame_ms"] // 1000
+        self.state = LISTENING
+        self.current = None
+        self.lock = threading.Lock()
+        self.stopped = False
+        # 每轮的耗时记录
+        self.turns = []
+
+    def set_state(self, state):
+        if state != self.state:
+            self.state = state
+            self.on_event("state", state=state)
+
+    def run(self, mic):
+        """处理麦克风帧直到mic.read()返回None或调用stop()，之后等最后一轮回复播完"""
+        self.on_event("state", state=self.state)
+        try:
+            while not self.stopped:
+                frame = mic.read()
+                if frame is None:
+                    break
+                self.process_frame(frame)
+        finally:
+            mic.close()
+        reply = self.current
+        if reply is not None and reply.thread is not None:
+            reply.thread.join()
+        self.playback.wait()
+        self.set_state(LISTENING)
+
+    def stop(self):
+        self.stopped = True
+
+    def process_frame(self, frame):
+        playing = self.playback.is_playing
+        reply = self.current
+        if self.state == RESPONDING and reply is not None and reply.done and not playing:
+            self.set_state(LISTENING)
+        result = self.segmenter.feed(frame, playing)
+        if result is None:
+            return
+        event, pcm = result
+        if event == "start":
+            if self.state != LISTENING:
+                self.barge_in()
+            self.on_event("speech_start")
+        elif event == "end":
+            self.dispatch(pcm, self.segmenter.speech_started_at, self.segmenter.last_speech_at)
+        else:
+            self.on_event("speech_discarded")
+
+    def barge_in(self):
+        """用户在回复过程中开口：取消进行中的请求，停止播放"""
+        with self.lock:
+            reply = self.current
+            if reply is None or reply.interrupted:
+                return
+            reply.interrupted = True
+            reply.trace.set("chat.interrupted", True)
+        # 在锁外取消：断开连接的回调不应持有会话锁
+        reply.cancel.cancel()
+        self.playback.stop()
+        self.on_event("barge_in")
+        self.set_state(LISTENING)
+
+    def dispatch(self, pcm, speech_started_at, last_speech_at):
+        """一句话结束：立即在新线程中发送，麦克风继续监听"""
+        trace = TurnTrace("duplex.turn", self.exporter, {"session.id": "duplex"})
+        with self.lock:
+            reply = _Reply(pcm, speech_started_at, last_speech_at, self.current, trace)
+            self.current = reply
+        self.on_event("speech_end", seconds=len(pcm) / 2 / self.config["rate"])
+        self.set_state(THINKING)
+        reply.thread = threading.Thread(target=self._respond, args=(reply,), name="duplex-reply", daemon=True)
+        reply.thread.start()
+
+    def _respond(self, reply):
+        # 等被打断的上一轮把已生成的内容写入对话记录，新的一轮接在它后面
+        previous = reply.previous
+        reply.previous = None
+        if previous is not None and previous.thread is not None:
+            previous.thread.join(self.config["cancel_timeout"])
+
+        media = MediaHandle.from_bytes("audio", wav_bytes(reply.pcm, self.config["rate"]), "wav")
+        reply.trace.set("chat.record_seconds", round(len(reply.pcm) / 2 / self.config["rate"], 2))
+        reply.pcm = None
+        user_message = qwen_chat.build_user_message(VOICE_PROMPT, base64_audio=media)
+        reply.mark("encoded")
+        parent = self.conversation.head
+        completion_args = {
+            "model": self.model,
+            "messages": self.conversation.history(parent) + [user_message],
+            "modalities": ["text", "audio"],
+            "audio": {"voice": self.config["voice"], "format": "wav"},
+            "stream": True,
+            "stream_options": {"include_usage": True},
+        }
+
+        started = []
+
+        def play(pcm, samplerate):
+            # 打断后队列中剩余的数据块不再播放
+            if reply.cancel.cancelled:
+                return
+            if not started:
+                # 排在前面的音频播完时，这一轮开始播放
+                started.append(True)
+                self.playback.call_when_done(lambda finished: finished and reply.mark("playback_start"))
+            self.playback.play_pcm(pcm, samplerate)
+
+        dsp = qwen_chat.make_output_dsp(REPLY_RATE, self.playback.backend.native_rate())
+        tee = AudioTee([SpeakerSink(play, dsp)])
+        text = ""
+        transcript = ""
+        try:
+            completion = self.complete(completion_args, reply.trace, reply.cancel)
+            try:
+                for chunk in completion:
+                    if reply.cancel.cancelled:
+                        break
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta
+                    if delta.content:
+                        text += delta.content
+                        self.on_event("text", delta=delta.content)
+                    audio = getattr(delta, "audio", None)
+                    if isinstance(audio, dict):
+                        if audio.get("transcript"):
+                            transcript += audio["transcript"]
+                            self.on_event("text", delta=audio["transcript"])
+                        if audio.get("data"):
+                            with self.lock:
+                                if self.current is reply and self.state == THINKING:
+                                    self.set_state(RESPONDING)
+                            tee.write_base64(audio["data"])
+            finally:
+                # 打断时关闭数据流，释放连接和密钥
+                close = getattr(completion, "close", None)
+                if close:
+                    close()
+        except Exception as e:
+            reply.trace.fail(e)
+            self.on_event("error", message=str(e))
+        finally:
+            tee.close()
+            # 回复播完（或被打断）后写入跟踪记录
+            self.playback.call_when_done(lambda finished: reply.trace.end_playback(finished and not reply.interrupted))
+
+        # 被打断时只记录已生成的部分；还没有回复就被打断的一句话不写入对话记录。
+        # 写入后录音由对话记录持有（只保留最近一轮），否则立即释放
+        reply_text = text or transcript
+        if reply_text:
+            self.conversation.commit(parent, user_message, Message.assistant(reply_text))
+        else:
+            media.release()
+        reply.done = True
+        self.turns.append(reply)
+        self.on_event("turn", timings=reply.timings(), interrupted=reply.interrupted)
+        with self.lock:
+            if self.current is reply and self.state == THINKING:
+                # 没有语音回复（出错或只有文字）
+                self.set_state(LISTENING)
+
+    def summary(self):
+        """各轮从停止说话到开始播放回复的耗时统计(毫秒)"""
+        turnaround = sorted(turn.timings()["playback_start"] for turn in self.turns
+                            if "playback_start" in turn.trace.marks)
+        if not turnaround:
+            return {"turns": len(self.turns)}
+        return {
+            "turns": len(self.turns),
+            "interrupted": sum(turn.interrupted for turn in self.turns),
+            "turnaround_median_ms": turnaround[len(turnaround) // 2],
+            "turnaround_max_ms": turnaround[-1],
+        }
+
+
+def print_event(kind, **fields):
+    """默认的事件输出：状态变化和回复文字打印到终端"""
+    if kind == "state":
+        print(f"\n[{STATE_LABELS[fields['state']]}]", flush=True)
+    elif kind == "text":
+        print(fields["delta"], end="", flush=True)
+    elif kind == "barge_in":
+        print("\n[已打断回复]", flush=True)
+    elif kind == "speech_end":
+        print(f"[检测到{fields['seconds']:.1f}秒语音，发送中]", flush=True)
+    elif kind == "turn":
+        timings = fields["timings"]
+        parts = [f"{name}={timings[name]}ms" for name in
+                 ("vad_end", "send", "first_byte", "first_text", "playback_start") if name in timings]
+        print(f"\n[耗时(自停止说话起): {', '.join(parts)}]", flush=True)
+    elif kind == "error":
+        print(f"\n[请求出错: {fields['message']}]", flush=True)
+
+
+def run_duplex(mic_file=None, model=None, config=None):
+    """命令行的全双工语音模式；mic_file为WAV文件时用它代替麦克风"""
+    config = dict(DEFAULT_DUPLEX_CONFIG, **(config or qwen_chat.load_config().get("duplex") or {}))
+    frame_samples = config["rate"] * config["frame_ms"] // 1000
+    if mic_file:
+        mic = FileMic(mic_file, config["rate"], frame_samples)
+    elif qwen_chat.PYAUDIO_AVAILABLE:
+        mic = DeviceMic(config["rate"], frame_samples)
+    else:
+        print("[错误] 无法录音: PyAudio未安装，可用--mic-file指定WAV文件", file=sys.stderr)
+        return 3
+    session = DuplexSession(config=config, model=model)
+    print("全双工语音模式：直接说话即可，回复播放时开口会打断回复，按Ctrl+C结束。建议使用耳机，避免回复声被当作说话。")
+    try:
+        session.run(mic)
+    except KeyboardInterrupt:
+        session.stop()
+        session.playback.stop()
+    print(f"\n[统计: {session.summary()}]")
+    return 0
+
+
+class MockCompletionServer:
+    """本地模拟的流式补全接口，用于在没有网络和密钥时测试全双工模式
+
+    收到请求后等待first_byte_delay秒，再以SSE返回文字和reply_seconds秒的语音（正弦波），
+    语音按generate_speed倍实时速度生成。客户端断开连接（被打断）时停止发送。
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, first_byte_delay=0.3, reply_seconds=2.0, generate_speed=4.0):
+        self.first_byte_delay = first_byte_delay
+        self.reply_seconds = reply_seconds
+        self.generate_speed = generate_speed
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                server.requests.append(json.loads(self._read_body()))
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                try:
+                    for event in server.events():
+                        self.wfile.write(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+                        self.wfile.flush()
+                    self.wfile.write(b"data: [DONE]\n\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def _read_body(self):
+                if self.headers.get("Transfer-Encoding", "").lower() != "chunked":
+                    return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                parts = []
+                while True:
+                    size = int(self.rfile.readline().split(b";")[0], 16)
+                    if size == 0:
+                        self.rfile.readline()
+                        return b"".join(parts)
+                    parts.append(self.rfile.read(size))
+                    self.rfile.readline()
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="mock-completion", daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def events(self):
+        time.sleep(self.first_byte_delay)
+        chunk_seconds = 0.1
+        samples = int(REPLY_RATE * chunk_seconds)
+        words = ["好的，", "我听到了", "你的问题。"]
+        for index in range(int(self.reply_seconds / chunk_seconds)):
+            t = (np.arange(samples) + index * samples) / REPLY_RATE
+            pcm = (np.sin(2 * np.pi * 440 * t) * 3000).astype("<i2").tobytes()
+            audio = {"data": base64.b64encode(pcm).decode("ascii")}
+            if index < len(words):
+                audio["transcript"] = words[index]
+            yield {"choices": [{"index": 0, "delta": {"audio": audio}}]}
+            time.sleep(chunk_seconds / self.generate_speed)
+        yield {"choices": [], "usage": {"prompt_tokens": 100, "completion_tokens": 20}}
+
+
+def write_test_speech(path, rate=16000, utterances=((1.5, 3.0), (1.2, 1.0), (1.0, 4.0))):
+    """生成模拟说话的WAV文件：每项为(说话秒数, 之后的静音秒数)，说话部分为带噪声的调制音
+
+    第二句话之后的静音比回复短，用来测试打断。
+    """
+    rng = np.random.default_rng(0)
+    pieces = [rng.normal(0, 60, int(rate * 0.5))]
+    for speech_seconds, silence_seconds in utterances:
+        t = np.arange(int(rate * speech_seconds)) / rate
+        envelope = 0.6 + 0.4 * np.sin(2 * np.pi * 3 * t)
+        pieces.append(np.sin(2 * np.pi * 220 * t) * 6000 * envelope + rng.normal(0, 60, len(t)))
+        pieces.append(rng.normal(0, 60, int(rate * silence_seconds)))
+    pcm = np.clip(np.concatenate(pieces), -32768, 32767).astype("<i2").tobytes()
+    with open(path, "wb") as output:
+        output.write(wav_bytes(pcm, rate))
+    return path
+
+
+def demo(mic_file=None, first_byte_delay=0.3):
+    """离线演示：模拟麦克风 + 本地模拟接口 + 按实时速度“播放”的空播放设备，输出各轮耗时"""
+    import tempfile
+    from audio_playback import PlaybackService, NullBackend
+
+    def complete(args, trace, cancel):
+        trace.set_request(args)
+        trace.mark("send")
+        return traced(streaming_body.create_chat_completion(server.url, "mock", args, cancel=cancel), trace)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if mic_file is None:
+            mic_file = write_test_speech(f"{temp_dir}/speech.wav")
+        server = MockCompletionServer(first_byte_delay=first_byte_delay).start()
+        playback = PlaybackService(NullBackend(realtime=True))
+        config = dict(DEFAULT_DUPLEX_CONFIG)
+        exporter = TraceExporter({"path": f"{temp_dir}/traces.jsonl"})
+        session = DuplexSession(complete=complete, playback=playback, config=config, model="mock", exporter=exporter)
+        mic = FileMic(mic_file, config["rate"], config["rate"] * config["frame_ms"] // 1000)
+        try:
+            session.run(mic)
+        finally:
+            playback.shutdown()
+            server.stop()
+        print(f"\n请求数: {len(server.requests)}，对话记录: {len(session.conversation)}条")
+        print(f"统计: {session.summary()}")
+        print("各轮跟踪记录:")
+        for spans in load_traces(exporter.path):
+            print(describe_trace(spans))
+        return session
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="全双工语音对话")
+    parser.add_argument("--mic-file", help="用WAV文件（16kHz、16位、单声道）代替麦克风")
+    parser.add_argument("--mock", action="store_true", help="使用本地模拟接口和空播放设备离线演示")
+    parser.add_argument("-m", "--model", help="使用的模型")
+    args = parser.parse_args()
+    if args.mock:
+        demo(args.mic_file)
+    else:
+        sys.exit(run_duplex(args.mic_file, args.model))
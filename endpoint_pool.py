@@ -0,0 +1,163 @@
+import time
+import threading
+import urllib.request
+import urllib.error
+
+# 默认接口地址池配置
+DEFAULT_ENDPOINT_POOL_CONFIG = {
+    "health_check_interval": 30.0,  # 健康检查间隔(秒)，0表示只依据真实请求的结果
+    "probe_timeout": 5.0,           # 健康检查超时(秒)
+    "alpha": 0.3,                   # 首字节延迟EWMA平滑系数
+    "failure_threshold": 2,         # 连续失败多少次后标记为不健康
+    "unhealthy_cooldown": 30.0,     # 不健康的接口多久后重新尝试(秒)
+    "max_failover": 2,              # 单次请求最多切换几个接口
+}
+
+
+class EndpointState:
+    """单个接口地址的健康状态和延迟统计"""
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.ewma_latency = None
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+        self.last_probe = None
+
+    def healthy(self, now):
+        return self.unhealthy_until <= now
+
+    def as_dict(self, now):
+        return {
+            "url": self.url,
+            "healthy": self.healthy(now),
+            "ewma_latency": self.ewma_latency,
+            "requests": self.requests,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "last_probe": self.last_probe,
+        }
+
+
+class EndpointPool:
+    """OpenAI兼容接口地址池：持续跟踪各地址的健康状况和首字节延迟，
+    把请求路由到最快的健康地址，失败时按顺序切换"""
+
+    def __init__(self, urls, config=None):
+        self.config = dict(DEFAULT_ENDPOINT_POOL_CONFIG)
+        self.config.update(config or {})
+        self.endpoints = [EndpointState(url) for url in urls]
+        if not self.endpoints:
+            raise ValueError("至少需要配置一个接口地址")
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.health_thread = None
+
+    def _sort_key(self, state, now):
+        # 健康的排前面；没有延迟数据的按配置顺序优先尝试
+        latency = state.ewma_latency if state.ewma_latency is not None else -1.0
+        return (not state.healthy(now), latency if state.healthy(now) else state.unhealthy_until)
+
+    def ordered(self):
+        """按优先级返回接口地址：最快的健康地址在前，不健康的地址在最后"""
+        now = time.monotonic()
+        with self.lock:
+            ranked = sorted(self.endpoints, key=lambda state: self._sort_key(state, now))
+            return [state.url for state in ranked]
+
+    def select(self):
+        """返回当前最优的接口地址"""
+        return self.ordered()[0]
+
+    def failover_order(self):
+        """单次请求依次尝试的接口地址"""
+        return self.ordered()[:self.config["max_failover"] + 1]
+
+    def _get(self, url):
+        for state in self.endpoints:
+            if state.url == url.rstrip("/"):
+                return state
+        return None
+
+    def record_latency(self, url, latency, probe=False):
+        """记录一次成功请求（或健康检查）的首字节延迟"""
+        with self.lock:
+            state = self._get(url)
+            if state is None:
+                return
+            if not probe:
+                state.requests += 1
+            state.consecutive_failures = 0
+            state.unhealthy_until = 0.0
+            if state.ewma_latency is None:
+                state.ewma_latency = latency
+            else:
+                state.ewma_latency += self.config["alpha"] * (latency - state.ewma_latency)
+
+    def record_failure(self, url, probe=False):
+        """记录一次连接失败或服务端错误"""
+        with self.lock:
+            state = self._get(url)
+            if state is None:
+                return
+            if not probe:
+                state.requests += 1
+            state.failures += 1
+            state.consecutive_failures += 1
+            if state.consecutive_failures >= self.config["failure_threshold"]:
+                state.unhealthy_until = time.monotonic() + self.config["unhealthy_cooldown"]
+                print(f"\n[接口 {state.url} 暂时不可用，{self.config['unhealthy_cooldown']:.0f}秒后重试]")
+
+    def probe(self, url):
+        """探测接口地址：收到任何HTTP响应即视为可达，返回首字节延迟(秒)，不可达时返回None"""
+        request = urllib.request.Request(url.rstrip("/") + "/models", method="GET")
+        start_time = time.monotonic()
+        try:
+            with urllib.request.urlopen(request, timeout=self.config["probe_timeout"]) as response:
+                response.read(1)
+        except urllib.error.HTTPError:
+            # 401/404等错误码说明服务端可达
+            pass
+        except Exception:
+            return None
+        return time.monotonic() - start_time
+
+    def check_all(self):
+        """对所有接口地址做一次健康检查"""
+        for state in list(self.endpoints):
+            latency = self.probe(state.url)
+            with self.lock:
+                state.last_probe = time.time()
+            # 探测结果不计入请求数
+            if latency is None:
+                self.record_failure(state.url, probe=True)
+            else:
+                self.record_latency(state.url, latency, probe=True)
+
+    def _health_loop(self):
+        interval = self.config["health_check_interval"]
+        while not self.stop_event.is_set():
+            self.check_all()
+            self.stop_event.wait(interval)
+
+    def start_health_checks(self):
+        """启动后台健康检查线程"""
+        if self.config["health_check_interval"] <= 0 or self.health_thread is not None:
+            return
+        self.health_thread = threading.Thread(target=self._health_loop, name="endpoint-health", daemon=True)
+        self.health_thread.start()
+
+    def stop(self):
+        """停止后台健康检查"""
+        self.stop_event.set()
+        if self.health_thread is not None:
+            self.health_thread.join(timeout=1)
+            self.health_thread = None
+
+    def snapshot(self):
+        """返回各接口地址的状态"""
+        now = time.monotonic()
+        with self.lock:
+            return [state.as_dict(now) for state in self.endpoints]
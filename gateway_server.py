@@ -0,0 +1,582 @@
+import sys
+import json
+import time
+import uuid
+import queue
+import base64
+import socket
+import struct
+import hashlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import qwen_chat
+from audio_sinks import decode_pcm
+from message_model import Message
+from conversation_tree import ConversationTree
+
+# WebSocket握手用的固定GUID（RFC 6455）
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# WebSocket操作码
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+# WebSocket关闭码：消息过大
+CLOSE_MESSAGE_TOO_BIG = 1009
+
+# 默认网关配置
+DEFAULT_GATEWAY_CONFIG = {
+    "send_queue_size": 256,       # 每个连接待发送的最大帧数
+    "slow_client_timeout": 10.0,  # 客户端读取过慢时最多阻塞多久(秒)，超时断开连接
+    "session_ttl": 1800.0,        # 会话空闲多久后清理(秒)
+    "max_request_bytes": 200 * 1024 * 1024,
+}
+
+
+class SlowClientError(Exception):
+    """客户端读取过慢，发送队列长时间已满"""
+
+
+class MessageTooBigError(Exception):
+    """客户端发送的WebSocket消息超过max_request_bytes"""
+
+
+class Session:
+    """一个客户端会话，保存对话历史"""
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.conversation = ConversationTree()
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+
+
+class SessionStore:
+    """会话表，定期清理空闲会话"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get(self, session_id=None):
+        with self.lock:
+            now = time.monotonic()
+            for key in [k for k, s in self.sessions.items() if now - s.last_used > self.ttl]:
+                del self.sessions[key]
+            if not session_id:
+                session_id = uuid.uuid4().hex
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = self.sessions[session_id] = Session(session_id)
+            session.last_used = now
+            return session
+
+    def drop(self, session_id):
+        with self.lock:
+            self.sessions.pop(session_id, None)
+
+    def __len__(self):
+        return len(self.sessions)
+
+
+class BoundedSender:
+    """带有界队列的发送线程：上游数据先进队列，由独立线程写入套接字。
+    客户端读取过慢导致队列写满时，生产者会阻塞（反压到上游读取），超时则断开连接。
+
+    abort为断开连接的函数：客户端读取过慢时写入线程可能阻塞在发送上，
+    先断开连接让它出错返回，再等它结束。
+    """
+
+    def __init__(self, write, queue_size, timeout, abort=None):
+        self.write = write
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.timeout = timeout
+        self.abort = abort
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name="gateway-sender", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                self.write(item)
+            except Exception as e:
+                self.error = e
+
+    def send(self, item):
+        if self.error is not None:
+            raise ConnectionError(f"连接已断开: {self.error}")
+        try:
+            self.queue.put(item, timeout=self.timeout)
+        except queue.Full:
+            self.error = SlowClientError("客户端读取过慢")
+            raise self.error
+
+    def close(self):
+        """等待队列中的数据发送完毕；客户端读取过慢或连接已出错时直接断开连接，不再等待"""
+        if self.error is None:
+            try:
+                self.queue.put(None, timeout=self.timeout)
+            except queue.Full:
+                self.error = SlowClientError("客户端读取过慢")
+        if self.error is not None:
+            self._abort()
+        self.thread.join()
+
+    def _abort(self):
+        if self.abort is not None:
+            try:
+                self.abort()
+            except OSError:
+                pass
+        # 清空队列后放入结束标记，队列已满时也不会阻塞（出错后写入线程只丢弃数据）
+        while True:
+            try:
+                self.queue.put_nowait(None)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def depth(self):
+        return self.queue.qsize()
+
+
+def set_send_timeout(sock, seconds):
+    """只限制套接字的发送：客户端不读取时阻塞的发送超时出错，写入线程不会一直卡住
+
+    不用settimeout()：它同时限制读取，WebSocket连接空闲等待客户端消息时会超时断开。
+    """
+    if sys.platform == "win32":
+        value = struct.pack("L", int(seconds * 1000))
+    else:
+        value = struct.pack("ll", int(seconds), int(seconds % 1 * 1000000))
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, value)
+
+
+def build_turn_message(request):
+    """根据客户端请求构建用户消息，媒体数据为base64字符串"""
+    prompt = request.get("prompt") or ""
+    if request.get("audio") and not prompt:
+        prompt = "我刚才说的是什么？请回答我的问题或请求。"
+    return qwen_chat.build_user_message(
+        prompt,
+        base64_audio=request.get("audio"),
+        base64_image=request.get("image"),
+        image_type=request.get("image_type", "png"),
+        base64_video=request.get("video"),
+        video_type=request.get("video_type", "mp4"),
+    )
+
+
+def run_turn(session, request, send_event, send_pcm=None):
+    """执行一轮对话：文字事件通过send_event发送，语音回复解码为PCM后通过send_pcm发送"""
+    use_audio = bool(request.get("output_audio")) and send_pcm is not None
+    with session.lock:
+        # "regenerate": true时重新生成上一条回复，新回复成为原回复的兄弟分支
+        user_turn = session.conversation.regenerate() if request.get("regenerate") else None
+        if request.get("regenerate") and user_turn is None:
+            raise ValueError("没有可以重新生成的回复")
+        if user_turn is not None:
+            user_message = session.conversation.request_for(user_turn)
+            parent = user_turn.parent
+        else:
+            user_message = build_turn_message(request)
+            parent = session.conversation.head
+        completion_args = {
+            "model": request.get("model") or qwen_chat.get_selected_model(),
+            "messages": session.conversation.history(parent) + [user_message],
+            "modalities": ["text", "audio"] if use_audio else ["text"],
+            "stream": True,
+            "stream_options": {"include_usage": True},
+        }
+        if use_audio:
+            completion_args["audio"] = {"voice": request.get("voice", "Cherry"), "format": "wav"}
+
+        # 客户端反馈某一轮慢时，可按trace_id在跟踪记录中查看各阶段耗时
+        trace = qwen_chat.start_turn_trace("gateway.turn", session.session_id)
+        send_event({"type": "start", "session_id": session.session_id, "model": completion_args["model"],
+                    "trace_id": trace.trace_id})
+        full_response = ""
+        transcript = ""
+        start_time = time.time()
+        priority = "voice" if request.get("audio") else "text"
+        try:
+            for chunk in qwen_chat.stream_completion(completion_args, session_id=session.session_id,
+                                                     priority=priority, trace=trace):
+                if chunk.choices:
+                    delta = chunk.choices[0].delta
+                    if delta.content:
+                        full_response += delta.content
+                        send_event({"type": "text", "delta": delta.content})
+                    audio = getattr(delta, "audio", None)
+                    if use_audio and isinstance(audio, dict):
+                        if audio.get("transcript"):
+                            transcript += audio["transcript"]
+                            send_event({"type": "transcript", "delta": audio["transcript"]})
+                        if audio.get("data"):
+                            send_pcm(decode_pcm(audio["data"]))
+                elif getattr(chunk, "usage", None):
+                    send_event({"type": "usage",
+                                "prompt_tokens": chunk.usage.prompt_tokens,
+                                "completion_tokens": chunk.usage.completion_tokens})
+        except Exception as e:
+            # 请求出错或客户端断开
+            trace.fail(e)
+            raise
+        finally:
+            trace.end()
+
+        # 历史记录中只保留文字
+        session.conversation.commit(parent, user_message, Message.assistant(full_response or transcript), user_turn)
+        send_event({"type": "done", "text": full_response or transcript, "latency": time.time() - start_time})
+
+
+class GatewayHandler(BaseHTTPRequestHandler):
+    """HTTP/SSE和WebSocket请求处理"""
+
+    server_version = "QwenOmniGateway/1.0"
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        sys.stderr.write(f"[网关] {self.address_string()} {format % args}\n")
+
+    @property
+    def gateway(self):
+        return self.server.gateway
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _abort_connection(self):
+        """断开连接：阻塞在发送上的线程立即出错返回"""
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.connection.close()
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > self.gateway.config["max_request_bytes"]:
+            raise ValueError("请求体过大")
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/v1/ws" and self.headers.get("Upgrade", "").lower() == "websocket":
+            self._handle_websocket()
+        elif path == "/health":
+            self._send_json(200, {"status": "ok"})
+        elif path == "/metrics":
+            self._send_json(200, self.gateway.metrics())
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        parsed = urlparse(self.path)
+        try:
+            request = self._read_json()
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        if parsed.path == "/v1/sessions":
+            session = self.gateway.sessions.get()
+            self._send_json(200, {"session_id": session.session_id})
+        elif parsed.path == "/v1/chat":
+            session_id = request.get("session_id") or parse_qs(parsed.query).get("session_id", [None])[0]
+            self._handle_sse(self.gateway.sessions.get(session_id), request)
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def _handle_sse(self, session, request):
+        """以SSE流式返回文字事件"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def write(data):
+            self.wfile.write(data)
+            self.wfile.flush()
+
+        set_send_timeout(self.connection, self.gateway.config["slow_client_timeout"])
+        sender = BoundedSender(write, self.gateway.config["send_queue_size"],
+                               self.gateway.config["slow_client_timeout"], self._abort_connection)
+
+        def send_event(event):
+            payload = json.dumps(event, ensure_ascii=False)
+            sender.send(f"event: {event['type']}\ndata: {payload}\n\n".encode("utf-8"))
+
+        try:
+            # SSE只传输文字，语音回复请使用WebSocket
+            request = dict(request, output_audio=False)
+            run_turn(session, request, send_event)
+        except Exception as e:
+            try:
+                send_event({"type": "error", "message": str(e)})
+            except Exception:
+                pass
+        finally:
+            sender.close()
+
+    def _handle_websocket(self):
+        """WebSocket连接：文本帧传JSON请求和事件，二进制帧传PCM音频（24kHz、16位、单声道）"""
+        key = self.headers.get("Sec-WebSocket-Key")
+        if not key:
+            self._send_json(400, {"error": "missing Sec-WebSocket-Key"})
+            return
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+        self.send_response(101, "Switching Protocols")
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept)
+        self.end_headers()
+        self.wfile.flush()
+        self.close_connection = True
+
+        connection = WebSocketConnection(self.connection, self.rfile, self.gateway.config["max_request_bytes"])
+        set_send_timeout(self.connection, self.gateway.config["slow_client_timeout"])
+        sender = BoundedSender(lambda frame: connection.send_frame(*frame),
+                               self.gateway.config["send_queue_size"],
+                               self.gateway.config["slow_client_timeout"], self._abort_connection)
+        session = self.gateway.sessions.get()
+        self.gateway.connection_opened()
+        pending_audio = None
+        close_payload = b""
+
+        def send_event(event):
+            sender.send((OP_TEXT, json.dumps(event, ensure_ascii=False).encode("utf-8")))
+
+        def send_pcm(pcm):
+            sender.send((OP_BINARY, pcm))
+
+        try:
+            send_event({"type": "session", "session_id": session.session_id,
+                        "audio_format": {"encoding": "pcm_s16le", "sample_rate": 24000, "channels": 1}})
+            while True:
+                opcode, payload = connection.read_message()
+                if opcode == OP_CLOSE:
+                    break
+                if opcode == OP_PING:
+                    sender.send((OP_PONG, payload))
+                elif opcode == OP_BINARY:
+                    # 二进制帧为下一轮对话的语音输入(WAV)
+                    pending_audio = payload
+                elif opcode == OP_TEXT:
+                    try:
+                        request = json.loads(payload.decode("utf-8"))
+                        if pending_audio is not None and not request.get("audio"):
+                            request["audio"] = base64.b64encode(pending_audio).decode("ascii")
+                        pending_audio = None
+                        run_turn(session, request, send_event, send_pcm)
+                    except (SlowClientError, ConnectionError):
+                        raise
+                    except Exception as e:
+                        send_event({"type": "error", "message": str(e)})
+        except MessageTooBigError as e:
+            self.log_message("WebSocket连接结束: %s", e)
+            close_payload = struct.pack("!H", CLOSE_MESSAGE_TOO_BIG) + "消息过大".encode("utf-8")
+        except (ConnectionError, SlowClientError, OSError) as e:
+            self.log_message("WebSocket连接结束: %s", e)
+        finally:
+            try:
+                sender.send((OP_CLOSE, close_payload))
+            except Exception:
+                pass
+            sender.close()
+            self.gateway.sessions.drop(session.session_id)
+            self.gateway.connection_closed()
+
+
+# 按掩码字节异或的转换表，用到时生成
+_xor_tables = {}
+
+
+def _xor_table(value):
+    table = _xor_tables.get(value)
+    if table is None:
+        table = _xor_tables[value] = bytes(byte ^ value for byte in range(256))
+    return table
+
+
+def unmask(payload, mask):
+    """用4字节掩码解码帧数据：每隔4字节的一组用bytes.translate查表异或，不逐字节循环"""
+    data = bytearray(payload)
+    for offset in range(4):
+        data[offset::4] = data[offset::4].translate(_xor_table(mask[offset]))
+    return bytes(data)
+
+
+class WebSocketConnection:
+    """最小的WebSocket帧读写实现（服务端）
+
+    max_message_bytes限制单帧和合并分片后整条消息的长度，超过时抛出MessageTooBigError，
+    不读取（也不分配）帧数据。
+    """
+
+    def __init__(self, sock, rfile, max_message_bytes=None):
+        self.sock = sock
+        self.rfile = rfile
+        self.max_message_bytes = max_message_bytes
+        self.write_lock = threading.Lock()
+        # 尚未收齐的分片消息：分片之间可以插入控制帧
+        self.fragment_opcode = None
+        self.fragments = []
+        self.fragment_bytes = 0
+
+    def _check_size(self, length):
+        if self.max_message_bytes is not None and length > self.max_message_bytes:
+            raise MessageTooBigError(f"消息长度{length}字节超过上限{self.max_message_bytes}字节")
+
+    def _read_exact(self, size):
+        data = self.rfile.read(size)
+        if len(data) < size:
+            raise ConnectionError("连接已关闭")
+        return data
+
+    def read_frame(self):
+        first, second = self._read_exact(2)
+        fin = bool(first & 0x80)
+        opcode = first & 0x0F
+        masked = bool(second & 0x80)
+        length = second & 0x7F
+        if length == 126:
+            length = struct.unpack("!H", self._read_exact(2))[0]
+        elif length == 127:
+            length = struct.unpack("!Q", self._read_exact(8))[0]
+        self._check_size(length)
+        mask = self._read_exact(4) if masked else None
+        payload = self._read_exact(length)
+        if mask and length:
+            payload = unmask(payload, mask)
+        return fin, opcode, payload
+
+    def read_message(self):
+        """读取一条完整消息（合并分片帧）
+
+        分片之间插入的控制帧直接返回，已收到的分片保留，下次调用时继续合并。
+        """
+        while True:
+            fin, opcode, payload = self.read_frame()
+            if opcode >= OP_CLOSE:
+                return opcode, payload
+            if opcode == OP_CONTINUATION:
+                if self.fragment_opcode is None:
+                    raise ConnectionError("收到没有起始帧的分片")
+                self.fragments.append(payload)
+                self.fragment_bytes += len(payload)
+            else:
+                self.fragment_opcode = opcode
+                self.fragments = [payload]
+                self.fragment_bytes = len(payload)
+            self._check_size(self.fragment_bytes)
+            if fin:
+                opcode, parts = self.fragment_opcode, self.fragments
+                self.fragment_opcode = None
+                self.fragments = []
+                self.fragment_bytes = 0
+                return opcode, parts[0] if len(parts) == 1 else b"".join(parts)
+
+    def send_frame(self, opcode, payload):
+        header = bytes([0x80 | opcode])
+        length = len(payload)
+        if length < 126:
+            header += bytes([length])
+        elif length < 65536:
+            header += bytes([126]) + struct.pack("!H", length)
+        else:
+            header += bytes([127]) + struct.pack("!Q", length)
+        with self.write_lock:
+            self.sock.sendall(header)
+            if length:
+                self.sock.sendall(payload)
+
+
+class Gateway:
+    """网关：共享同一个进程内的客户端、限流器和调度器，为多个客户端提供服务"""
+
+    def __init__(self, config=None):
+        self.config = dict(DEFAULT_GATEWAY_CONFIG)
+        self.config.update(config or {})
+        self.sessions = SessionStore(self.config["session_ttl"])
+        self.lock = threading.Lock()
+        self.connections = 0
+
+    def connection_opened(self):
+        with self.lock:
+            self.connections += 1
+
+    def connection_closed(self):
+        with self.lock:
+            self.connections -= 1
+
+    def metrics(self):
+        """汇总网关和调用链路上各组件的指标"""
+        return {
+            "sessions": len(self.sessions),
+            "websocket_connections": self.connections,
+            "rate_limiter": qwen_chat.rate_limiter.metrics(),
+            "scheduler": qwen_chat.scheduler.metrics(),
+            "single_flight": qwen_chat.single_flight.metrics(),
+            "keys": qwen_chat.get_key_pool(interactive=False).usage_report(),
+            "endpoints": qwen_chat.get_endpoint_pool().snapshot(),
+            "models": qwen_chat.model_router.snapshot(),
+        }
+
+
+def serve(host="127.0.0.1", port=8765, config=None):
+    """启动网关服务"""
+    # 预先初始化客户端和接口地址池，避免第一个请求承担初始化开销
+    qwen_chat.get_key_pool(interactive=False)
+    qwen_chat.get_endpoint_pool()
+
+    server = ThreadingHTTPServer((host, port), GatewayHandler)
+    server.daemon_threads = True
+    server.gateway = Gateway(config)
+    print(f"[网关已启动: http://{host}:{server.server_address[1]}  WebSocket: ws://{host}:{server.server_address[1]}/v1/ws]")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n[网关已停止]")
+    finally:
+        server.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Qwen Omni本地网关：通过HTTP(SSE)和WebSocket为多个客户端提供对话服务")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址 (默认: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8765, help="监听端口 (默认: 8765)")
+    args = parser.parse_args(argv)
+    try:
+        serve(args.host, args.port, qwen_chat.load_config().get("gateway"))
+    except qwen_chat.NoKeyAvailable as e:
+        print(f"[错误] {e}", file=sys.stderr)
+        return 3
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
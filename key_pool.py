@@ -0,0 +1,175 @@
+import time
+import threading
+
+from rate_limiter import TokenBucket
+
+# 默认密钥池配置
+DEFAULT_KEY_POOL_CONFIG = {
+    "rpm_per_key": 60,            # 单个密钥每分钟请求数
+    "tpm_per_key": 100000,        # 单个密钥每分钟tokens数
+    "cooldown_429": 5.0,          # 收到429后的初始冷却时间(秒)，连续429时翻倍
+    "cooldown_max": 120.0,
+    "cooldown_auth": 600.0,       # 认证失败(401/403)后的冷却时间(秒)
+    "max_wait": 30.0,             # 所有密钥都在冷却时的最长等待时间(秒)
+}
+
+
+class NoKeyAvailable(Exception):
+    """没有可用的API密钥"""
+
+
+def mask_key(api_key):
+    """隐藏密钥中间部分，用于日志和统计输出"""
+    if not api_key or len(api_key) <= 8:
+        return "****"
+    return f"{api_key[:4]}...{api_key[-4:]}"
+
+
+class KeyState:
+    """单个密钥的客户端和配额记录"""
+
+    def __init__(self, api_key, client_factory, config):
+        self.api_key = api_key
+        self.client_factory = client_factory
+        self.clients = {}
+        self.request_bucket = TokenBucket(config["rpm_per_key"], config["rpm_per_key"] / 60.0)
+        self.token_bucket = TokenBucket(config["tpm_per_key"], config["tpm_per_key"] / 60.0)
+        self.cooldown_until = 0.0
+        self.cooldown = 0.0
+        self.in_flight = 0
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.errors = 0
+        self.throttled = 0
+        self.auth_failures = 0
+
+    def client_for(self, base_url):
+        """获取该密钥访问指定接口地址的客户端（按需创建并复用）"""
+        client = self.clients.get(base_url)
+        if client is None:
+            client = self.clients[base_url] = self.client_factory(self.api_key, base_url)
+        return client
+
+    def headroom(self, tokens):
+        """剩余配额比例（0~1），取请求数和tokens两者中较紧的一个"""
+        request_ratio = self.request_bucket.tokens / self.request_bucket.capacity
+        token_ratio = (self.token_bucket.tokens - tokens) / self.token_bucket.capacity
+        return min(request_ratio, token_ratio)
+
+    def usage(self):
+        return {
+            "key": mask_key(self.api_key),
+            "requests": self.requests,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "errors": self.errors,
+            "throttled_429": self.throttled,
+            "auth_failures": self.auth_failures,
+            "in_flight": self.in_flight,
+            "cooling_down": max(0.0, self.cooldown_until - time.monotonic()),
+        }
+
+
+class KeyLease:
+    """一次请求占用的密钥"""
+
+    __slots__ = ("state", "tokens")
+
+    def __init__(self, state, tokens):
+        self.state = state
+        self.tokens = tokens
+
+    def client_for(self, base_url):
+        return self.state.client_for(base_url)
+
+
+class KeyPool:
+    """API密钥池：每个密钥单独建客户端并记账，按剩余配额负载均衡
+
+    client_factory(api_key, base_url) 用于创建客户端，每个密钥和接口地址的组合复用同一个客户端。
+    """
+
+    def __init__(self, api_keys, client_factory, config=None):
+        self.config = dict(DEFAULT_KEY_POOL_CONFIG)
+        self.config.update(config or {})
+        self.client_factory = client_factory
+        self.condition = threading.Condition()
+        self.keys = []
+        for api_key in api_keys:
+            self.add_key(api_key)
+
+    def add_key(self, api_key):
+        """添加密钥（重复的密钥会被忽略）"""
+        with self.condition:
+            if not api_key or any(state.api_key == api_key for state in self.keys):
+                return
+            self.keys.append(KeyState(api_key, self.client_factory, self.config))
+            self.condition.notify_all()
+
+    def acquire(self, tokens=1):
+        """选出剩余配额最多且不在冷却中的密钥"""
+        deadline = time.monotonic() + self.config["max_wait"]
+        with self.condition:
+            while True:
+                if not self.keys:
+                    raise NoKeyAvailable("未配置API密钥")
+                now = time.monotonic()
+                available = []
+                for state in self.keys:
+                    state.request_bucket.refill(now)
+                    state.token_bucket.refill(now)
+                    if state.cooldown_until <= now:
+                        available.append(state)
+                if available:
+                    state = max(available, key=lambda s: (s.headroom(tokens), -s.in_flight))
+                    state.request_bucket.take(1)
+                    state.token_bucket.take(min(tokens, state.token_bucket.capacity))
+                    state.in_flight += 1
+                    state.requests += 1
+                    return KeyLease(state, tokens)
+
+                remaining = deadline - now
+                if remaining <= 0:
+                    raise NoKeyAvailable("所有API密钥都在冷却中")
+                next_ready = min(state.cooldown_until for state in self.keys) - now
+                self.condition.wait(min(max(next_ready, 0.01), remaining))
+
+    def release(self, lease, usage=None):
+        """请求成功结束，按实际用量记账"""
+        with self.condition:
+            state = lease.state
+            state.in_flight -= 1
+            state.cooldown = 0.0
+            if usage is not None:
+                prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+                completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+                state.prompt_tokens += prompt_tokens
+                state.completion_tokens += completion_tokens
+                state.token_bucket.take(prompt_tokens + completion_tokens - lease.tokens)
+            self.condition.notify_all()
+
+    def report_error(self, lease, error):
+        """请求失败：429和认证错误会让密钥进入冷却"""
+        status_code = getattr(error, "status_code", None)
+        with self.condition:
+            state = lease.state
+            state.in_flight -= 1
+            state.errors += 1
+            now = time.monotonic()
+            if status_code == 429:
+                state.throttled += 1
+                state.cooldown = min(self.config["cooldown_max"],
+                                     state.cooldown * 2 if state.cooldown else self.config["cooldown_429"])
+                state.cooldown_until = now + state.cooldown
+                print(f"\n[密钥 {mask_key(state.api_key)} 触发限流，冷却{state.cooldown:.0f}秒]")
+            elif status_code in (401, 403):
+                state.auth_failures += 1
+                state.cooldown_until = now + self.config["cooldown_auth"]
+                print(f"\n[密钥 {mask_key(state.api_key)} 认证失败，冷却{self.config['cooldown_auth']:.0f}秒]")
+            self.condition.notify_all()
+
+    def usage_report(self):
+        """返回每个密钥的用量统计"""
+        with self.condition:
+            return [state.usage() for state in self.keys]
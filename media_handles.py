@@ -0,0 +1,198 @@
+import os
+import sys
+import mmap
+import time
+import binascii
+import threading
+import tracemalloc
+
+from streaming_body import LazyPayload, DEFAULT_STREAMING_BODY_CONFIG
+
+
+def encoded_size(raw_size):
+    return (raw_size + 2) // 3 * 4
+
+
+class MediaAccounting:
+    """统计媒体句柄在内存中持有的字节数
+
+    包括内存来源句柄的原始数据（如缩小后的图片），以及序列化时正在生成的base64块
+    和完整字符串。文件来源的句柄空闲时不占用内存。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.live_bytes = 0
+        self.peak_bytes = 0
+        self.handles = 0
+        self.materialized = 0
+
+    def add(self, size):
+        with self.lock:
+            self.live_bytes += size
+            self.peak_bytes = max(self.peak_bytes, self.live_bytes)
+
+    def remove(self, size):
+        with self.lock:
+            self.live_bytes -= size
+
+    def stats(self):
+        with self.lock:
+            return {
+                "live_bytes": self.live_bytes,
+                "peak_bytes": self.peak_bytes,
+                "handles": self.handles,
+                "materialized": self.materialized,
+            }
+
+
+accounting = MediaAccounting()
+
+
+class MediaHandle(LazyPayload):
+    """媒体附件的轻量句柄：引用文件或内存中的原始数据，只在序列化时生成base64
+
+    界面状态、对话记录和聊天线程中只保存句柄；发送请求时由streaming_body边编码边上传，
+    发送完成后不留下base64字符串。
+    """
+
+    def __init__(self, kind, subtype, path=None, data=None, sha256=None):
+        if (path is None) == (data is None):
+            raise ValueError("path和data必须且只能指定一个")
+        self.kind = kind
+        self.subtype = subtype
+        self.path = str(path) if path is not None else None
+        self.data = data
+        self.sha256 = sha256
+        if path is not None:
+            stat = os.stat(self.path)
+            self.size = stat.st_size
+            self.mtime_ns = stat.st_mtime_ns
+        else:
+            self.size = len(data)
+            self.mtime_ns = None
+            accounting.add(self.size)
+        with accounting.lock:
+            accounting.handles += 1
+
+    @classmethod
+    def from_file(cls, kind, path, subtype, sha256=None):
+        return cls(kind, subtype, path=path, sha256=sha256)
+
+    @classmethod
+    def from_bytes(cls, kind, data, subtype, sha256=None):
+        return cls(kind, subtype, data=bytes(data), sha256=sha256)
+
+    def __len__(self):
+        """base64编码后的长度（不需要编码）"""
+        return encoded_size(self.size)
+
+    def __repr__(self):
+        source = self.path or f"<{self.size}字节>"
+        return f"MediaHandle({self.kind}/{self.subtype}, {source})"
+
+    def iter_chunks(self, chunk_bytes=DEFAULT_STREAMING_BODY_CONFIG["chunk_bytes"]):
+        """逐块返回base64编码的bytes；chunk_bytes为3的倍数，各块可以直接拼接"""
+        if chunk_bytes % 3:
+            raise ValueError("chunk_bytes必须是3的倍数")
+        if self.size == 0:
+            return
+        if self.data is not None:
+            yield from self._encode_chunks(memoryview(self.data), chunk_bytes)
+            return
+        with open(self.path, "rb") as source, mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if len(data) != self.size:
+                raise OSError(f"附件在选择后被修改: {self.path}")
+            yield from self._encode_chunks(data, chunk_bytes)
+
+    def _encode_chunks(self, data, chunk_bytes):
+        for start in range(0, self.size, chunk_bytes):
+            chunk = binascii.b2a_base64(data[start:start + chunk_bytes], newline=False)
+            accounting.add(len(chunk))
+            try:
+                yield chunk
+            finally:
+                accounting.remove(len(chunk))
+
+    def identity(self):
+        """用于请求去重的标识：有sha256时按内容，否则按文件路径、大小和修改时间"""
+        if self.sha256:
+            return f"sha256:{self.sha256}"
+        return f"file:{self.path}:{self.size}:{self.mtime_ns}"
+
+    @property
+    def file_backed(self):
+        return self.path is not None
+
+    def __str__(self):
+        """一次性生成完整的base64字符串（如需经由OpenAI SDK发送时），调用方用完即释放"""
+        with accounting.lock:
+            accounting.materialized += 1
+        if self.path is not None:
+            import parallel_b64
+            return parallel_b64.encode_file(self.path)
+        return binascii.b2a_base64(self.data, newline=False).decode("ascii")
+
+    def release(self):
+        """释放内存中的原始数据（文件来源的句柄没有需要释放的内容）"""
+        if self.data is not None:
+            accounting.remove(self.size)
+            self.data = None
+            self.size = 0
+
+    def __del__(self):
+        try:
+            self.release()
+            with accounting.lock:
+                accounting.handles -= 1
+        except Exception:
+            pass
+
+
+def stats():
+    """当前媒体句柄的内存统计"""
+    return accounting.stats()
+
+
+def measure_idle_memory(size_mb=64):
+    """比较附加视频后、发送中和发送后的内存占用：旧做法保存完整base64字符串，句柄只引用文件"""
+    import tempfile
+    from streaming_body import iter_json, data_uri
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "video.mp4")
+        with open(path, "wb") as video:
+            block = os.urandom(1024 * 1024)
+            for _ in range(size_mb):
+                video.write(block)
+
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        with open(path, "rb") as video:
+            base64_video = binascii.b2a_base64(video.read(), newline=False).decode("ascii")
+        held = tracemalloc.get_traced_memory()[0] - baseline
+        del base64_video
+        tracemalloc.stop()
+        print(f"base64字符串: 附加后常驻 {held / 1048576:.1f} MB")
+
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        handle = MediaHandle.from_file("video", path, "mp4")
+        held = tracemalloc.get_traced_memory()[0] - baseline
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        message = {"role": "user", "content": [
+            {"type": "video_url", "video_url": {"url": data_uri("data:video/mp4;base64,", handle)}}]}
+        sent = sum(len(chunk) for chunk in iter_json({"messages": [message]}))
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+        del message, handle
+        after = tracemalloc.get_traced_memory()[0] - baseline
+        tracemalloc.stop()
+        print(f"媒体句柄:     附加后常驻 {held / 1024:.1f} KB，序列化 {sent / 1048576:.1f} MB "
+              f"用时 {elapsed * 1000:.0f} 毫秒、峰值 {peak / 1048576:.2f} MB，发送后 {after / 1024:.1f} KB")
+        print(f"句柄统计: {stats()}")
+
+
+if __name__ == "__main__":
+    measure_idle_memory(int(sys.argv[1]) if len(sys.argv) > 1 else 64)
@@ -0,0 +1,257 @@
+import sys
+import json
+import time
+
+from streaming_body import JsonFragment, LazyPayload, JSON_OPTIONS, DEFAULT_STREAMING_BODY_CONFIG, data_uri, iter_json
+
+# 角色和内容类型只有少数几种取值，驻留后所有消息共用同一个字符串对象
+ROLE_SYSTEM = sys.intern("system")
+ROLE_USER = sys.intern("user")
+ROLE_ASSISTANT = sys.intern("assistant")
+ROLES = {ROLE_SYSTEM, ROLE_USER, ROLE_ASSISTANT}
+
+TYPE_TEXT = sys.intern("text")
+TYPE_AUDIO = sys.intern("input_audio")
+TYPE_IMAGE = sys.intern("image_url")
+TYPE_VIDEO = sys.intern("video_url")
+
+_encoder = json.JSONEncoder(**JSON_OPTIONS)
+
+
+def _encode(value):
+    return _encoder.encode(value).encode("utf-8")
+
+
+class ContentPart(JsonFragment):
+    """多模态消息中的一个内容项：文字，或音频、图片、视频的data URI
+
+    value为文字或data URI（字符串或streaming_body.LazyDataURI），subtype为音频格式。
+    """
+
+    __slots__ = ("type", "value", "subtype", "_fragment")
+
+    def __init__(self, part_type, value, subtype=None):
+        self.type = sys.intern(part_type)
+        self.value = value
+        self.subtype = subtype
+        self._fragment = None
+
+    @classmethod
+    def text(cls, text):
+        return cls(TYPE_TEXT, text)
+
+    @classmethod
+    def media(cls, kind, payload, subtype=None):
+        """由附件类型和base64数据（字符串或媒体句柄）构建"""
+        if kind == "audio":
+            return cls(TYPE_AUDIO, data_uri("data:;base64,", payload), subtype or "wav")
+        if kind == "image":
+            return cls(TYPE_IMAGE, data_uri(f"data:image/{subtype or 'png'};base64,", payload))
+        return cls(TYPE_VIDEO, data_uri(f"data:video/{subtype or 'mp4'};base64,", payload))
+
+    @property
+    def is_media(self):
+        return self.type is not TYPE_TEXT
+
+    @property
+    def is_lazy(self):
+        return isinstance(self.value, LazyPayload)
+
+    @property
+    def file_backed(self):
+        """媒体内容是否只引用磁盘文件（文字不算媒体，视为是）"""
+        if self.type is TYPE_TEXT:
+            return True
+        return self.is_lazy and self.value.file_backed
+
+    def _payload(self):
+        if self.type is TYPE_TEXT:
+            return self.value
+        if self.type is TYPE_AUDIO:
+            return {"data": self.value, "format": self.subtype}
+        return {"url": self.value}
+
+    def get(self, key, default=None):
+        """按OpenAI消息格式读取字段（与读取字典的代码兼容，如模型路由和限流估算）"""
+        if key == "type":
+            return self.type
+        if key == self.type:
+            return self._payload()
+        return default
+
+    def to_wire(self):
+        return {"type": self.type, self.type: self._payload()}
+
+    def iter_json(self, chunk_bytes=DEFAULT_STREAMING_BODY_CONFIG["chunk_bytes"], encoder=None):
+        if self._fragment is not None:
+            yield self._fragment
+        elif self.is_lazy:
+            # 媒体句柄每次发送时重新编码，不缓存
+            yield from iter_json(self.to_wire(), chunk_bytes)
+        else:
+            self._fragment = b"".join(iter_json(self.to_wire(), chunk_bytes))
+            yield self._fragment
+
+    def __repr__(self):
+        if self.type is TYPE_TEXT:
+            return f"ContentPart(text, {self.value[:20]!r})"
+        return f"ContentPart({self.type}, {len(self.value)}字节)"
+
+
+class Message(JsonFragment):
+    """一条对话消息
+
+    消息创建后不再修改：序列化结果在第一次发送时缓存，之后每轮只需序列化新增的消息。
+    parts为None时content是纯文本，否则content为parts列表（文字是其中一项）。
+    """
+
+    __slots__ = ("role", "text", "parts", "created_at", "_fragment")
+
+    def __init__(self, role, text="", parts=None):
+        role = sys.intern(role)
+        if role not in ROLES:
+            raise ValueError(f"未知的消息角色: {role}")
+        self.role = role
+        self.text = text
+        self.parts = tuple(parts) if parts else None
+        self.created_at = time.time()
+        self._fragment = None
+
+    @classmethod
+    def system(cls, text):
+        return cls(ROLE_SYSTEM, text)
+
+    @classmethod
+    def user(cls, text, media_parts=()):
+        """用户消息：媒体内容项按顺序放在文字之前"""
+        if not media_parts:
+            return cls(ROLE_USER, text)
+        return cls(ROLE_USER, text, list(media_parts) + [ContentPart.text(text)])
+
+    @classmethod
+    def assistant(cls, text):
+        return cls(ROLE_ASSISTANT, text)
+
+    @classmethod
+    def from_wire(cls, message):
+        """由OpenAI格式的字典构建（已是Message时原样返回）"""
+        if isinstance(message, Message):
+            return message
+        content = message.get("content")
+        if not isinstance(content, list):
+            return cls(message["role"], content or "")
+        parts = []
+        text = ""
+        for item in content:
+            part_type = item.get("type")
+            payload = item.get(part_type)
+            if part_type == TYPE_TEXT:
+                text = item.get("text", "")
+                parts.append(ContentPart.text(text))
+            elif part_type == TYPE_AUDIO:
+                parts.append(ContentPart(TYPE_AUDIO, payload.get("data"), payload.get("format")))
+            else:
+                parts.append(ContentPart(part_type, payload.get("url")))
+        return cls(message["role"], text, parts)
+
+    @property
+    def has_media(self):
+        return self.parts is not None and any(part.is_media for part in self.parts)
+
+    @property
+    def is_lazy(self):
+        return self.parts is not None and any(part.is_lazy for part in self.parts)
+
+    @property
+    def file_backed(self):
+        """所有媒体内容都只引用磁盘文件，保留消息不会占用媒体数据的内存"""
+        return self.parts is None or all(part.file_backed for part in self.parts)
+
+    @property
+    def content(self):
+        return self.text if self.parts is None else list(self.parts)
+
+    def text_only(self):
+        """去掉媒体内容、只保留文字的消息（写入对话记录时使用，不再持有媒体数据）"""
+        if self.parts is None:
+            return self
+        return Message(self.role, self.text)
+
+    def get(self, key, default=None):
+        """按OpenAI消息格式读取字段（与读取字典的代码兼容）"""
+        if key == "role":
+            return self.role
+        if key == "content":
+            return self.content
+        return default
+
+    def __getitem__(self, key):
+        if key not in ("role", "content"):
+            raise KeyError(key)
+        return self.get(key)
+
+    def to_wire(self):
+        if self.parts is None:
+            return {"role": self.role, "content": self.text}
+        return {"role": self.role, "content": [part.to_wire() for part in self.parts]}
+
+    def iter_json(self, chunk_bytes=DEFAULT_STREAMING_BODY_CONFIG["chunk_bytes"], encoder=None):
+        """输出与json.dumps(materialize(self.to_wire()), **JSON_OPTIONS)逐字节一致的片段"""
+        if self._fragment is not None:
+            yield self._fragment
+            return
+        head = b'{"role":' + _encode(self.role) + b',"content":'
+        if self.parts is None:
+            self._fragment = head + _encode(self.text) + b"}"
+            yield self._fragment
+            return
+        if any(part.is_lazy for part in self.parts):
+            yield head + b"["
+            for index, part in enumerate(self.parts):
+                if index:
+                    yield b","
+                yield from part.iter_json(chunk_bytes)
+            yield b"]}"
+            return
+        self._fragment = head + b"[" + b",".join(b"".join(part.iter_json(chunk_bytes)) for part in self.parts) + b"]}"
+        yield self._fragment
+
+    def __repr__(self):
+        return f"Message({self.role}, {self.text[:20]!r}{', 含媒体' if self.has_media else ''})"
+
+
+def to_wire_messages(messages):
+    """转换为OpenAI格式的字典列表（交给只接受字典的代码，如OpenAI SDK）"""
+    return [message.to_wire() if isinstance(message, Message) else message for message in messages]
+
+
+def benchmark(turns=(10, 100, 1000), text_chars=400):
+    """比较每轮重新序列化整个历史（字典）与使用缓存片段（Message）的耗时"""
+    print(f"{'历史轮数':>8} {'字典每轮':>12} {'Message每轮':>12}")
+    for count in turns:
+        history = []
+        for index in range(count):
+            history.append(Message.user(f"问题{index} " + "字" * text_chars))
+            history.append(Message.assistant(f"回答{index} " + "文" * text_chars))
+        wire = to_wire_messages(history)
+        for message in history:
+            b"".join(message.iter_json())
+
+        new_message = Message.user("新的问题")
+        rounds = 20
+        start = time.perf_counter()
+        for _ in range(rounds):
+            json.dumps({"messages": wire + [new_message.to_wire()]}, **JSON_OPTIONS).encode("utf-8")
+        dict_time = (time.perf_counter() - start) / rounds
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            # 发送时各片段直接写入连接，历史消息不再编码或复制
+            for _ in iter_json({"messages": history + [Message.user("新的问题")]}):
+                pass
+        model_time = (time.perf_counter() - start) / rounds
+        print(f"{count:>8} {dict_time * 1000:>10.2f}ms {model_time * 1000:>10.2f}ms")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,186 @@
+import threading
+
+# 输入模态的优先级（一条消息中包含多种媒体时取最"重"的一种）
+MODALITY_ORDER = ["text", "audio", "image", "video"]
+
+# 消息内容类型与输入模态的对应关系
+CONTENT_TYPE_MODALITY = {
+    "text": "text",
+    "input_audio": "audio",
+    "image_url": "image",
+    "video_url": "video",
+}
+
+# 默认路由配置（默认关闭，保持原有的固定模型行为）
+DEFAULT_ROUTER_CONFIG = {
+    "enabled": False,
+    "dry_run": False,
+    "alpha": 0.2,            # EWMA平滑系数
+    "error_penalty": 5.0,    # 错误率对得分的放大系数
+    "min_samples": 3,        # 样本不足时优先按规则顺序探索
+    "rules": [],
+}
+
+
+def _part_payload_bytes(part):
+    """估算单个内容块的载荷大小"""
+    part_type = part.get("type")
+    if part_type == "text":
+        return len(part.get("text", "").encode("utf-8"))
+    if part_type == "input_audio":
+        return len(part.get("input_audio", {}).get("data", ""))
+    if part_type in ("image_url", "video_url"):
+        return len(part.get(part_type, {}).get("url", ""))
+    return 0
+
+
+def classify_request(messages, modalities):
+    """根据最后一条用户消息和输出模态提取路由特征"""
+    features = {
+        "modality": "text",
+        "payload_bytes": 0,
+        "output": "audio" if "audio" in (modalities or []) else "text",
+    }
+    for message in reversed(messages):
+        if message.get("role") != "user":
+            continue
+        content = message.get("content")
+        if isinstance(content, str):
+            features["payload_bytes"] = len(content.encode("utf-8"))
+        elif isinstance(content, list):
+            rank = 0
+            for part in content:
+                modality = CONTENT_TYPE_MODALITY.get(part.get("type"), "text")
+                rank = max(rank, MODALITY_ORDER.index(modality))
+                features["payload_bytes"] += _part_payload_bytes(part)
+            features["modality"] = MODALITY_ORDER[rank]
+        break
+    return features
+
+
+class ModelStats:
+    """单个模型的滚动统计（EWMA）"""
+
+    def __init__(self):
+        self.samples = 0
+        self.errors = 0
+        self.ewma_first_token = None
+        self.ewma_total = None
+        self.ewma_error_rate = 0.0
+
+    def as_dict(self):
+        return {
+            "samples": self.samples,
+            "errors": self.errors,
+            "ewma_first_token": self.ewma_first_token,
+            "ewma_total": self.ewma_total,
+            "ewma_error_rate": self.ewma_error_rate,
+        }
+
+
+class ModelRouter:
+    """按输入模态、载荷大小和实测延迟为每轮对话选择模型
+
+    规则示例（按顺序匹配，第一条命中的规则给出候选模型）:
+        {"modality": "video", "min_payload_bytes": 0, "max_payload_bytes": 50000000,
+         "output": "audio", "models": ["qwen-omni-turbo", "qwen2.5-omni-7b"]}
+    modality/output 可省略，表示不限。
+    """
+
+    def __init__(self, models, config=None):
+        self.models = list(models)
+        self.config = dict(DEFAULT_ROUTER_CONFIG)
+        self.config.update(config or {})
+        self.stats = {model: ModelStats() for model in self.models}
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.config.get("enabled"))
+
+    @property
+    def dry_run(self):
+        return bool(self.config.get("dry_run"))
+
+    def _match_rule(self, features):
+        """返回第一条匹配的规则"""
+        for rule in self.config.get("rules", []):
+            if rule.get("modality") and rule["modality"] != features["modality"]:
+                continue
+            if rule.get("output") and rule["output"] != features["output"]:
+                continue
+            if features["payload_bytes"] < rule.get("min_payload_bytes", 0):
+                continue
+            max_bytes = rule.get("max_payload_bytes")
+            if max_bytes is not None and features["payload_bytes"] > max_bytes:
+                continue
+            return rule
+        return None
+
+    def _score(self, model):
+        """得分越低越好：首字延迟 × (1 + 错误率 × 惩罚系数)"""
+        stats = self.stats[model]
+        if stats.samples + stats.errors < self.config["min_samples"]:
+            return None
+        if stats.ewma_first_token is None:
+            # 只有失败记录的模型排在最后
+            return float("inf")
+        return stats.ewma_first_token * (1 + stats.ewma_error_rate * self.config["error_penalty"])
+
+    def choose(self, messages, modalities, default_model):
+        """计算本轮应使用的模型（不考虑dry-run）"""
+        features = classify_request(messages, modalities)
+        rule = self._match_rule(features)
+        candidates = [m for m in (rule or {}).get("models", self.models) if m in self.stats]
+        if not candidates:
+            return default_model, features
+
+        with self.lock:
+            # 样本不足的模型先按规则顺序探索
+            for model in candidates:
+                if self._score(model) is None:
+                    return model, features
+            return min(candidates, key=self._score), features
+
+    def route(self, messages, modalities, default_model):
+        """返回本轮实际使用的模型；dry-run模式下只记录建议结果"""
+        if not self.enabled:
+            return default_model
+        model, features = self.choose(messages, modalities, default_model)
+        if self.dry_run:
+            if model != default_model:
+                print(f"\n[路由(dry-run)] {features['modality']}输入/{features['output']}输出, "
+                      f"{features['payload_bytes']}字节 -> 建议使用 {model}，实际使用 {default_model}")
+            return default_model
+        return model
+
+    def record_success(self, model, first_token_latency, total_latency):
+        """记录一次成功调用的延迟"""
+        if model not in self.stats:
+            return
+        alpha = self.config["alpha"]
+        with self.lock:
+            stats = self.stats[model]
+            stats.samples += 1
+            if stats.ewma_first_token is None:
+                stats.ewma_first_token = first_token_latency
+                stats.ewma_total = total_latency
+            else:
+                stats.ewma_first_token += alpha * (first_token_latency - stats.ewma_first_token)
+                stats.ewma_total += alpha * (total_latency - stats.ewma_total)
+            stats.ewma_error_rate *= (1 - alpha)
+
+    def record_error(self, model):
+        """记录一次失败调用"""
+        if model not in self.stats:
+            return
+        alpha = self.config["alpha"]
+        with self.lock:
+            stats = self.stats[model]
+            stats.errors += 1
+            stats.ewma_error_rate += alpha * (1 - stats.ewma_error_rate)
+
+    def snapshot(self):
+        """返回各模型的统计信息"""
+        with self.lock:
+            return {model: stats.as_dict() for model, stats in self.stats.items()}
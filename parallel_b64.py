@@ -0,0 +1,173 @@
+import os
+import sys
+import mmap
+import time
+import binascii
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+# 默认配置
+DEFAULT_PARALLEL_B64_CONFIG = {
+    # 小于该大小的文件直接在当前线程编码（进程间调度的开销大于收益），见benchmark()
+    "min_parallel_bytes": 16 * 1024 * 1024,
+    # 进程数，None表示CPU核数
+    "workers": None,
+    # 每个任务编码的字节数，必须是3的倍数，编码结果才能直接拼接
+    "slice_bytes": 3 * 4 * 1024 * 1024,
+}
+
+# 进程池启动较慢，创建后在进程内复用
+_pool = None
+_pool_workers = None
+_pool_lock = threading.Lock()
+
+
+def encoded_size(raw_size):
+    return (raw_size + 2) // 3 * 4
+
+
+def get_pool(workers):
+    """获取进程内共享的进程池，进程数变化时重新创建"""
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            _pool = ProcessPoolExecutor(max_workers=workers)
+            _pool_workers = workers
+        return _pool
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
+
+
+def _encode_slice(path, output_path, start, end):
+    """子进程：映射源文件，编码[start, end)并写入输出文件中对应的位置"""
+    with open(path, "rb") as source, mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        encoded = binascii.b2a_base64(data[start:end], newline=False)
+    with open(output_path, "r+b") as output:
+        output.seek(start // 3 * 4)
+        output.write(encoded)
+    return end - start
+
+
+def _output_dir():
+    # Linux下/dev/shm在内存中，输出文件不落盘
+    return "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+def encode_serial(path):
+    """在当前线程编码整个文件"""
+    with open(path, "rb") as source:
+        size = os.fstat(source.fileno()).st_size
+        if size == 0:
+            return ""
+        with mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return binascii.b2a_base64(data, newline=False).decode("ascii")
+
+
+def encode_parallel(path, workers=None, slice_bytes=None, progress=None, cancelled=None):
+    """把文件按3字节对齐切片，在进程池中并行编码，各切片的结果写入共享的输出文件（Linux下位于内存中的/dev/shm）后转换为字符串
+
+    progress(已编码字节数, 总字节数)在每个切片完成时调用；cancelled()返回True时
+    取消尚未开始的切片并返回None。
+    """
+    workers = workers or os.cpu_count() or 1
+    slice_bytes = slice_bytes or DEFAULT_PARALLEL_B64_CONFIG["slice_bytes"]
+    if slice_bytes % 3:
+        raise ValueError("slice_bytes必须是3的倍数")
+    size = os.path.getsize(path)
+    if size == 0:
+        return ""
+    # 各进程把编码结果写入同一个预先分配好大小的文件，最后映射到内存一次转换为字符串
+    fd, output_path = tempfile.mkstemp(prefix="b64_", dir=_output_dir())
+    try:
+        os.ftruncate(fd, encoded_size(size))
+        os.close(fd)
+        pool = get_pool(workers)
+        pending = {pool.submit(_encode_slice, str(path), output_path, start, min(start + slice_bytes, size))
+                   for start in range(0, size, slice_bytes)}
+        done = 0
+        while pending:
+            finished, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+            for future in finished:
+                done += future.result()
+            if progress and finished:
+                progress(done, size)
+            if cancelled and cancelled():
+                for future in pending:
+                    future.cancel()
+                # 等待已经开始的切片结束，之后才能删除输出文件
+                wait(pending)
+                return None
+        with open(output_path, "rb") as output, mmap.mmap(output.fileno(), 0, access=mmap.ACCESS_READ) as encoded:
+            return str(encoded, "ascii")
+    finally:
+        os.remove(output_path)
+
+
+def should_parallelize(size, config=None):
+    config = dict(DEFAULT_PARALLEL_B64_CONFIG, **(config or {}))
+    workers = config["workers"] or os.cpu_count() or 1
+    return workers > 1 and size >= config["min_parallel_bytes"]
+
+
+def encode_file(path, config=None, progress=None, cancelled=None):
+    """编码文件为base64字符串：大文件并行编码，小文件或单核时直接编码；取消时返回None"""
+    config = dict(DEFAULT_PARALLEL_B64_CONFIG, **(config or {}))
+    size = os.path.getsize(path)
+    if should_parallelize(size, config):
+        return encode_parallel(path, config["workers"], config["slice_bytes"], progress, cancelled)
+    if cancelled and cancelled():
+        return None
+    encoded = encode_serial(path)
+    if progress:
+        progress(size, size)
+    return encoded
+
+
+def benchmark(sizes_mb=(1, 4, 16, 64, 256), workers=None, rounds=3):
+    """比较不同文件大小下串行与并行编码的耗时，找出并行开始划算的大小"""
+    workers = workers or os.cpu_count() or 1
+    print(f"CPU核数: {os.cpu_count()}，进程数: {workers}")
+    # 先启动进程池，单独报告启动耗时（进程内只发生一次）
+    start = time.perf_counter()
+    pool = get_pool(workers)
+    list(pool.map(abs, range(workers)))
+    print(f"进程池启动: {(time.perf_counter() - start) * 1000:.0f} 毫秒")
+    print(f"{'大小':>8} {'串行':>10} {'并行':>10} {'加速比':>7}")
+    crossover = None
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for size_mb in sizes_mb:
+            path = os.path.join(temp_dir, f"sample_{size_mb}.bin")
+            with open(path, "wb") as sample:
+                block = os.urandom(1024 * 1024)
+                for _ in range(size_mb):
+                    sample.write(block)
+            serial = min(_time(encode_serial, path) for _ in range(rounds))
+            parallel = min(_time(encode_parallel, path, workers) for _ in range(rounds))
+            if crossover is None and parallel < serial:
+                crossover = size_mb
+            print(f"{size_mb:>6}MB {serial * 1000:>8.1f}ms {parallel * 1000:>8.1f}ms {serial / parallel:>6.2f}x")
+            os.remove(path)
+    if crossover is None:
+        print("在测试的大小范围内并行编码没有更快，建议保持串行")
+    else:
+        print(f"从约{crossover}MB开始并行编码更快，可据此设置min_parallel_bytes")
+    shutdown_pool()
+
+
+def _time(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    benchmark(workers=int(sys.argv[1]) if len(sys.argv) > 1 else None)
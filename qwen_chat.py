@@ -1,13 +1,30 @@
 import os
+import sys
 import time
-import subprocess
+import argparse
 import signal
-from openai import OpenAI
+from openai import OpenAI, APIConnectionError
 from pathlib import Path
-import base64
-import numpy as np
-import soundfile as sf
 import json
+import threading
+import socket
+from model_router import ModelRouter
+from rate_limiter import RateLimiter, is_rate_limit_error
+from key_pool import KeyPool, NoKeyAvailable
+from endpoint_pool import EndpointPool
+from scheduler import PriorityScheduler, PRIORITY_CLASSES
+from single_flight import SingleFlight, canonical_request_key
+from audio_sinks import AudioTee, SpeakerSink, WavFileSink, FlacFileSink, decode_pcm
+from audio_playback import PlaybackService, create_backend
+from audio_devices import get_device_manager
+from audio_dsp import OutputDsp
+import streaming_body
+from streaming_body import StreamingConnectionError
+from attachments import AttachmentError, prepare_attachments as prepare_attachment_files
+from message_model import Message, ContentPart
+from conversation_tree import ConversationTree, format_history
+from voice_pipeline import CapturedAudio, ConnectionWarmer
+from tracing import TurnTrace, TraceExporter, traced
 
 try:
     import pyaudio
@@ -15,9 +32,9 @@ try:
     PYAUDIO_AVAILABLE = True
 except ImportError:
     PYAUDIO_AVAILABLE = False
-    print("[警告] PyAudio未安装，录音和实时流式音频播放将不可用。")
-    print("可通过以下命令安装: pip install pyaudio")
-    print("Windows系统可能需要先安装Visual C++ Build Tools")
+    print("[警告] PyAudio未安装，录音和实时流式音频播放将不可用。", file=sys.stderr)
+    print("可通过以下命令安装: pip install pyaudio", file=sys.stderr)
+    print("Windows系统可能需要先安装Visual C++ Build Tools", file=sys.stderr)
 
 # 定义可用模型列表
 AVAILABLE_MODELS = [
@@ -33,24 +50,38 @@ DEFAULT_MODEL = "qwen-omni-turbo-2025-03-26"
 # 配置文件路径
 CONFIG_FILE = Path("config.json")
 
+# DashScope兼容模式默认接口地址（可通过config.json中的"base_url"或"endpoints"修改）
+BASE_URL = "https://dashscope.aliyuncs.com/compatible-mode/v1"
+
+# 已读取的配置（配置文件只读取一次，保存时同时更新）
+_config = None
+_config_lock = threading.Lock()
+
 def load_config():
-    """从配置文件加载配置"""
-    config = {"api_key": None, "model": DEFAULT_MODEL}
-    if CONFIG_FILE.exists():
-        try:
-            with open(CONFIG_FILE, "r") as file:
-                loaded_config = json.load(file)
-                # 合并已加载的配置与默认配置
-                config.update(loaded_config)
-        except Exception as e:
-            print(f"读取配置文件时出错: {e}")
-    return config
+    """从配置文件加载配置，返回副本（出错信息输出到标准错误，不干扰单次调用模式的事件流）"""
+    global _config
+    with _config_lock:
+        if _config is None:
+            config = {"api_key": None, "model": DEFAULT_MODEL}
+            if CONFIG_FILE.exists():
+                try:
+                    with open(CONFIG_FILE, "r") as file:
+                        loaded_config = json.load(file)
+                        # 合并已加载的配置与默认配置
+                        config.update(loaded_config)
+                except Exception as e:
+                    print(f"读取配置文件时出错: {e}", file=sys.stderr)
+            _config = config
+        return dict(_config)
 
 def save_config(config):
     """保存配置到配置文件"""
+    global _config
     try:
         with open(CONFIG_FILE, "w") as file:
             json.dump(config, file)
+        with _config_lock:
+            _config = dict(config)
         return True
     except Exception as e:
         print(f"保存配置文件时出错: {e}")
@@ -61,6 +92,17 @@ def load_api_key():
     config = load_config()
     return config.get("api_key")
 
+def load_api_keys():
+    """从配置文件加载所有API密钥（合并api_key和api_keys两项并去重），都没有时使用环境变量DASHSCOPE_API_KEY"""
+    config = load_config()
+    api_keys = []
+    for api_key in [config.get("api_key")] + list(config.get("api_keys") or []):
+        if api_key and api_key not in api_keys:
+            api_keys.append(api_key)
+    if not api_keys and os.environ.get("DASHSCOPE_API_KEY"):
+        api_keys.append(os.environ["DASHSCOPE_API_KEY"])
+    return api_keys
+
 def save_api_key(api_key):
     """保存API密钥到配置文件"""
     config = load_config()
@@ -90,15 +132,219 @@ def get_api_key():
             print("警告: API密钥未能保存，下次启动需要重新输入")
     return api_key
 
-# 获取API密钥
-API_KEY = get_api_key()
-os.environ["DASHSCOPE_API_KEY"] = API_KEY
+# API密钥池（首次调用get_key_pool()时初始化）
+API_KEY = None
+key_pool = None
+_key_pool_lock = threading.Lock()
+
+def get_key_pool(interactive=True):
+    """获取API密钥池，首次调用时为每个密钥创建客户端（没有已保存的密钥则请求用户输入）"""
+    global API_KEY, key_pool
+    with _key_pool_lock:
+        if key_pool is None:
+            api_keys = load_api_keys()
+            if not api_keys:
+                if not interactive:
+                    raise NoKeyAvailable("未配置API密钥（可在config.json中设置api_key或设置环境变量DASHSCOPE_API_KEY）")
+                api_keys = [get_api_key()]
+            API_KEY = api_keys[0]
+            os.environ["DASHSCOPE_API_KEY"] = API_KEY
+            key_pool = KeyPool(
+                api_keys,
+                lambda api_key, base_url: OpenAI(api_key=api_key, base_url=base_url),
+                load_config().get("key_pool"),
+            )
+        return key_pool
+
+# 接口地址池（首次调用get_endpoint_pool()时初始化）
+endpoint_pool = None
+_endpoint_pool_lock = threading.Lock()
+
+def load_endpoints():
+    """从配置文件加载接口地址列表"""
+    config = load_config()
+    endpoints = list(config.get("endpoints") or [])
+    if not endpoints:
+        endpoints = [config.get("base_url") or BASE_URL]
+    return endpoints
+
+def get_endpoint_pool():
+    """获取接口地址池，首次调用时启动后台健康检查"""
+    global endpoint_pool
+    with _endpoint_pool_lock:
+        if endpoint_pool is None:
+            endpoints = load_endpoints()
+            endpoint_pool = EndpointPool(endpoints, load_config().get("endpoint_pool"))
+            # 只有一个地址时不需要探测
+            if len(endpoints) > 1:
+                endpoint_pool.start_health_checks()
+        return endpoint_pool
+
+def is_failover_error(error):
+    """连接失败、超时和5xx错误可以切换到其他接口地址重试"""
+    status_code = getattr(error, "status_code", None)
+    return (isinstance(error, (APIConnectionError, StreamingConnectionError))
+            or (status_code is not None and status_code >= 500))
+
+# 初始化模型路由器（配置见config.json中的"router"项）
+model_router = ModelRouter(AVAILABLE_MODELS, load_config().get("router"))
+
+# 初始化客户端限流器（配置见config.json中的"rate_limit"项）
+rate_limiter = RateLimiter(load_config().get("rate_limit"))
+
+# 初始化请求调度器（配置见config.json中的"scheduler"项）
+scheduler = PriorityScheduler(load_config().get("scheduler"))
+
+# 初始化相同请求合并（配置见config.json中的"single_flight"项）
+single_flight = SingleFlight(load_config().get("single_flight"))
 
-# 初始化客户端
-client = OpenAI(
-    api_key=API_KEY,
-    base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
-)
+def stream_completion(completion_args, session_id="default", priority="text", trace=None, cancel=None):
+    """调用流式补全接口：按路由规则选择模型，经调度器和限流器排队后发起请求，并记录延迟与错误统计
+    
+    priority为"voice"（交互式语音）、"text"（交互式文字）或"batch"（批处理）。
+    启用single_flight时，与进行中的请求完全相同的请求会共用同一个上游数据流。
+    trace为tracing.TurnTrace时记录请求属性和排队、发送、首个数据等各阶段的时间。
+    cancel为streaming_body.CancelToken时，取消后数据流立即结束（包括仍在等待首个数据时），
+    上游请求被断开（合并的请求在所有订阅者都取消后断开）。
+    """
+    if trace is not None:
+        trace.set_request(completion_args)
+        trace.set("chat.priority", priority)
+        trace.mark("send")
+    if single_flight.enabled:
+        key = canonical_request_key(completion_args)
+        # 与进行中的请求合并时，排队和发送阶段记录在发起上游请求的那一轮中
+        stream = single_flight.stream(
+            key, lambda upstream_cancel: _stream_scheduled(completion_args, session_id, priority, trace, upstream_cancel),
+            cancel)
+    else:
+        stream = _stream_scheduled(completion_args, session_id, priority, trace, cancel)
+    return stream if trace is None else traced(stream, trace)
+
+def _abort_sdk_stream(completion):
+    """从其他线程断开SDK数据流的连接（关闭响应不会唤醒阻塞在读取上的线程）"""
+    network_stream = completion.response.extensions.get("network_stream")
+    sock = network_stream.get_extra_info("socket") if network_stream is not None else None
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+def _stream_scheduled(completion_args, session_id, priority, trace=None, cancel=None):
+    """选择模型并经调度器排队"""
+    model = model_router.route(completion_args["messages"],
+                               completion_args.get("modalities"),
+                               completion_args["model"])
+    completion_args = dict(completion_args, model=model)
+    if trace is not None:
+        trace.set("gen_ai.request.model", model)
+    
+    # 调度：交互式请求优先于批处理
+    ticket = scheduler.acquire(session_id, priority) if scheduler.enabled else None
+    try:
+        yield from _stream_admitted(completion_args, model, session_id, priority, ticket, trace, cancel)
+    finally:
+        if ticket is not None:
+            scheduler.release(ticket)
+
+def _stream_admitted(completion_args, model, session_id, priority, ticket, trace=None, cancel=None):
+    """已获得调度名额的请求：限流排队、选择密钥和接口地址后发起请求"""
+    # 限流：按估算的tokens排队等待配额
+    estimated_prompt_tokens, charged_tokens = rate_limiter.estimate_tokens(completion_args["messages"])
+    if rate_limiter.enabled:
+        waited = rate_limiter.acquire(session_id, charged_tokens, priority=PRIORITY_CLASSES[priority])
+        if waited > 1:
+            print(f"\n[限流: 排队等待了{waited:.1f}秒]")
+    
+    # 从密钥池中选出剩余配额最多的密钥
+    pool = get_key_pool()
+    endpoints = get_endpoint_pool()
+    lease = pool.acquire(charged_tokens)
+    if trace is not None:
+        trace.mark("admitted")
+    
+    start_time = time.time()
+    first_token_latency = None
+    usage = None
+    completion = None
+    unregister = None
+    try:
+        # 依次尝试最快的健康接口地址，尚未收到数据前失败则切换
+        failover_order = endpoints.failover_order()
+        for attempt, base_url in enumerate(failover_order):
+            attempt_start = time.time()
+            if cancel is not None and cancel.cancelled:
+                break
+            try:
+                client = lease.client_for(base_url)
+                if streaming_body.uses_streaming_body(completion_args):
+                    # 含媒体句柄：边编码边上传，不在内存中生成完整的请求体，
+                    # 历史消息直接使用缓存的JSON片段
+                    completion = streaming_body.create_chat_completion(
+                        client.base_url, client.api_key, completion_args, load_config().get("streaming_body"),
+                        cancel)
+                else:
+                    # 消息对象转换为普通的字典（文字共用原来的字符串，不复制）
+                    completion = client.chat.completions.create(**streaming_body.materialize(completion_args))
+                    if cancel is not None:
+                        # 取消时断开连接，正在读取数据的线程随即结束
+                        unregister = cancel.register(lambda: _abort_sdk_stream(completion))
+            except Exception as e:
+                if cancel is not None and cancel.cancelled:
+                    break
+                if not is_failover_error(e):
+                    raise
+                endpoints.record_failure(base_url)
+                if attempt == len(failover_order) - 1:
+                    raise
+                print(f"\n[接口 {base_url} 请求失败，切换到下一个接口]")
+                continue
+            endpoints.record_latency(base_url, time.time() - attempt_start)
+            if trace is not None:
+                trace.mark("response_start")
+                trace.set("chat.endpoint", str(base_url))
+                trace.set("chat.failover_attempts", attempt)
+            break
+        
+        for chunk in completion or ():
+            if cancel is not None and cancel.cancelled:
+                break
+            if first_token_latency is None:
+                first_token_latency = time.time() - start_time
+                if ticket is not None:
+                    scheduler.record_first_token(ticket, time.monotonic() - ticket.granted_at)
+            if getattr(chunk, "usage", None):
+                usage = chunk.usage
+            yield chunk
+    except GeneratorExit:
+        # 调用方提前结束读取
+        if completion is not None and hasattr(completion, "close"):
+            completion.close()
+        pool.release(lease, usage)
+        raise
+    except Exception as e:
+        if cancel is not None and cancel.cancelled:
+            # 取消时断开连接引起的错误不计入接口和密钥的错误统计
+            pool.release(lease, usage)
+            return
+        pool.report_error(lease, e)
+        model_router.record_error(model)
+        if rate_limiter.enabled and is_rate_limit_error(e):
+            rate_limiter.record_throttled()
+        raise
+    finally:
+        if unregister is not None:
+            unregister()
+    
+    pool.release(lease, usage)
+    if cancel is not None and cancel.cancelled:
+        return
+    total_latency = time.time() - start_time
+    model_router.record_success(model, first_token_latency if first_token_latency is not None else total_latency, total_latency)
+    if rate_limiter.enabled:
+        rate_limiter.record_success()
+        rate_limiter.reconcile(estimated_prompt_tokens, charged_tokens, usage)
 
 # 创建保存音频的目录
 output_dir = Path("audio_output")
@@ -112,92 +358,187 @@ def save_audio_base64(audio_string, filename, samplerate=24000):
     """从Base64字符串保存音频文件"""
     audio_path = output_dir / filename
     try:
-        # 解码Base64数据
-        wav_bytes = base64.b64decode(audio_string)
-        # 转换为NumPy数组
-        audio_np = np.frombuffer(wav_bytes, dtype=np.int16)
-        # 保存为WAV文件
-        sf.write(str(audio_path), audio_np, samplerate=samplerate)
+        # 解码Base64数据后直接写入WAV文件，不经过NumPy转换
+        wav_file = WavFileSink(audio_path, samplerate)
+        try:
+            wav_file.write(decode_pcm(audio_string))
+        finally:
+            wav_file.close()
         return audio_path
     except Exception as e:
         print(f"保存音频文件时出错: {e}")
         return None
 
-def encode_image(image_path):
-    """将图像文件编码为Base64"""
-    try:
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode("utf-8")
-    except Exception as e:
-        print(f"[图像编码出错: {str(e)}]")
-        return None
+# 后台播放服务（首次调用get_playback_service()时初始化，配置见config.json中的"playback"项）
+playback_service = None
+_playback_lock = threading.Lock()
 
-def encode_video(video_path):
-    """将视频文件编码为Base64"""
-    try:
-        with open(video_path, "rb") as video_file:
-            return base64.b64encode(video_file.read()).decode("utf-8")
-    except Exception as e:
-        print(f"[视频编码出错: {str(e)}]")
+def get_audio_devices():
+    """获取进程共享的音频设备管理器（配置见config.json中的"audio_devices"项）"""
+    return get_device_manager(load_config().get("audio_devices"))
+
+def prewarm_audio_devices(use_input=True, use_output=True):
+    """在后台预先打开录音和播放设备，缩短第一次录音和播放的等待时间"""
+    if not PYAUDIO_AVAILABLE or not (use_input or use_output):
+        return
+    manager = get_audio_devices()
+    
+    def prewarm():
+        output_format = None
+        if use_output:
+            # 启用重采样时播放设备按原生采样率打开
+            dsp = make_output_dsp(24000, manager.native_output_rate())
+            output_format = (dsp.out_rate if dsp else 24000, 1)
+        manager.prewarm(input_format=(16000, 1, 1024) if use_input else None, output_format=output_format)
+    
+    threading.Thread(target=prewarm, name="audio-prewarm", daemon=True).start()
+
+def get_playback_service():
+    """获取进程内的后台播放服务"""
+    global playback_service
+    with _playback_lock:
+        if playback_service is None:
+            if PYAUDIO_AVAILABLE:
+                get_audio_devices()
+            config = load_config().get("playback") or {}
+            playback_service = PlaybackService(create_backend(config), config.get("block_frames", 1024),
+                                               dsp_factory=make_output_dsp)
+        return playback_service
+
+# 跟踪记录导出（首次调用get_trace_exporter()时初始化，配置见config.json中的"tracing"项）
+trace_exporter = None
+_trace_lock = threading.Lock()
+
+def get_trace_exporter():
+    """获取进程共享的跟踪记录导出器"""
+    global trace_exporter
+    with _trace_lock:
+        if trace_exporter is None:
+            trace_exporter = TraceExporter(load_config().get("tracing"))
+        return trace_exporter
+
+def start_turn_trace(name, session_id=None):
+    """开始记录一轮对话的各阶段耗时（结束时调用end()或end_turn_trace()导出）"""
+    return TurnTrace(name, get_trace_exporter(), {"session.id": session_id} if session_id else None)
+
+def end_turn_trace(trace, playing=False):
+    """结束一轮的跟踪记录；playing为True时等这一轮的语音回复播完（或被停止）后再导出"""
+    if playing:
+        get_playback_service().call_when_done(trace.end_playback)
+    else:
+        trace.end()
+
+def make_output_dsp(in_rate=24000, device_rate=None):
+    """创建输出音频处理链（重采样到设备原生采样率、响度归一化、裁掉开头静音），
+    配置见config.json中的"dsp"项，未启用时返回None"""
+    config = load_config().get("dsp") or {}
+    if not config.get("enabled", True):
         return None
+    return OutputDsp(in_rate, device_rate, config)
+
+def create_output_dsp(in_rate=24000):
+    """为一段流式播放的回复创建处理链"""
+    return make_output_dsp(in_rate, get_playback_service().backend.native_rate())
 
-def play_audio_system(audio_path):
-    """使用系统命令播放音频文件"""
+def play_audio_system(audio_path, trace=None):
+    """在后台播放音频文件，不阻塞调用者（可用stop_playback()停止）"""
     try:
-        # PowerShell命令来播放音频
-        ps_cmd = f'(New-Object Media.SoundPlayer "{audio_path}").PlaySync()'
-        subprocess.run(['powershell', '-Command', ps_cmd], check=True)
+        if trace is not None:
+            get_playback_service().call_when_done(lambda finished: finished and trace.mark("playback_start"))
+        get_playback_service().play_file(audio_path)
     except Exception as e:
         print(f"播放音频时出错: {e}")
 
+def stop_playback():
+    """停止正在播放的语音并清空播放队列"""
+    if playback_service is not None:
+        playback_service.stop()
+
 def play_audio_streaming(audio_string):
     """实时播放Base64编码的音频数据"""
-    if not PYAUDIO_AVAILABLE:
-        print("[错误] 无法实时播放音频: PyAudio未安装")
-        return
-    
     try:
-        # 解码Base64数据
-        wav_bytes = base64.b64decode(audio_string)
-        # 转换为NumPy数组
-        audio_np = np.frombuffer(wav_bytes, dtype=np.int16)
-        
-        # 初始化PyAudio (如果尚未初始化)
-        if not hasattr(play_audio_streaming, 'audio_stream'):
-            p = pyaudio.PyAudio()
-            play_audio_streaming.p = p
-            play_audio_streaming.audio_stream = p.open(
-                format=pyaudio.paInt16,
-                channels=1,
-                rate=24000,
-                output=True
-            )
-        
-        # 播放音频数据
-        play_audio_streaming.audio_stream.write(audio_np.tobytes())
+        play_pcm_streaming(decode_pcm(audio_string))
     except Exception as e:
         print(f"实时播放音频时出错: {e}")
 
+def play_pcm_streaming(pcm, samplerate=24000):
+    """实时播放已解码的PCM数据（16位、单声道），连续的数据块无间隙地接着播放"""
+    get_playback_service().play_pcm(pcm, samplerate)
+
 def cleanup_audio_streaming():
     """清理流式音频资源"""
-    if hasattr(play_audio_streaming, 'audio_stream'):
-        play_audio_streaming.audio_stream.stop_stream()
-        play_audio_streaming.audio_stream.close()
-        play_audio_streaming.p.terminate()
-        delattr(play_audio_streaming, 'audio_stream')
-        delattr(play_audio_streaming, 'p')
-
-def record_audio(filename, duration=60, rate=16000, chunk=1024, channels=1, format=pyaudio.paInt16):
-    """录制音频并保存到文件，可通过Ctrl+C提前结束录音"""
+    global playback_service
+    with _playback_lock:
+        if playback_service is not None:
+            playback_service.shutdown()
+            playback_service = None
+
+def traced_player(trace):
+    """返回实时播放函数：第一次播放时在播放队列中记录这一轮开始播放的时间（前面的音频播完时）"""
+    started = []
+    
+    def play(pcm, samplerate=24000):
+        if not started:
+            started.append(True)
+            get_playback_service().call_when_done(lambda finished: finished and trace.mark("playback_start"))
+        play_pcm_streaming(pcm, samplerate)
+    
+    return play
+
+def create_audio_tee(audio_path=None, speaker=False, sinks=None, trace=None):
+    """创建音频分发器：每个数据块只解码一次，同时送往扬声器、文件等输出
+    
+    audio_path以.flac结尾时保存为FLAC，否则保存为WAV；sinks为额外的输出。
+    trace不为None时记录回复开始播放的时间。
+    """
+    tee = AudioTee()
+    if speaker:
+        tee.add(SpeakerSink(traced_player(trace) if trace is not None else play_pcm_streaming, create_output_dsp()))
+    if audio_path:
+        audio_path = Path(audio_path)
+        if audio_path.suffix.lower() == ".flac":
+            tee.add(FlacFileSink(audio_path))
+        else:
+            tee.add(WavFileSink(audio_path))
+    for sink in sinks or []:
+        tee.add(sink)
+    return tee
+
+def finish_audio_tee(tee, audio_path):
+    """关闭音频分发器；没有收到音频时删除空文件，返回保存的文件路径"""
+    tee.close()
+    if not audio_path:
+        return None
+    audio_path = Path(audio_path)
+    if tee.bytes_written == 0:
+        audio_path.unlink(missing_ok=True)
+        return None
+    return audio_path
+
+def record_audio(filename, duration=60, rate=16000, chunk=1024, channels=1, format=None, on_frame=None):
+    """录制音频并保存到文件，可通过Ctrl+C提前结束录音
+    
+    录音数据边录边写入文件；on_frame(数据)在每读到一帧时调用（如边录边编码，见voice_pipeline）。
+    """
     if not PYAUDIO_AVAILABLE:
         print("[错误] 无法录音: PyAudio未安装")
         return None
+    if format is None:
+        format = pyaudio.paInt16
+    
+    # 等上一条语音回复播完再录音，避免把回放的声音录进去
+    if playback_service is not None and playback_service.is_playing:
+        print("[等待语音回复播放完毕，可按Ctrl+C跳过...]")
+        try:
+            playback_service.wait()
+        except KeyboardInterrupt:
+            stop_playback()
     
     record_path = Path("audio_input") / filename
     record_path.parent.mkdir(exist_ok=True)
     
-    # 用于存储录音数据的列表
-    frames = []
+    # 已录制的帧数
+    frame_count = 0
     
     # 用于标记录音是否被中断
     recording_interrupted = False
@@ -212,58 +553,46 @@ def record_audio(filename, duration=60, rate=16000, chunk=1024, channels=1, form
     signal.signal(signal.SIGINT, handle_interrupt)
     
     try:
-        p = pyaudio.PyAudio()
-        stream = p.open(format=format, 
-                      channels=channels,
-                      rate=rate,
-                      input=True,
-                      frames_per_buffer=chunk)
-
-        print(f"[开始录音...最长{duration}秒，按Ctrl+C可提前结束]")
-        
-        start_time = time.time()
-        max_chunks = int(rate / chunk * duration)
-        
-        # 录音循环
-        for i in range(max_chunks):
-            if recording_interrupted:
-                break
-                
-            # 每秒更新一次状态
-            if i % int(rate / chunk) == 0:
-                elapsed = time.time() - start_time
-                remaining = duration - elapsed
-                print(f"\r已录制: {elapsed:.1f}秒 | 剩余: {remaining:.1f}秒...", end="", flush=True)
+        # 使用共享的输入流，不再每次初始化PortAudio
+        sampwidth = pyaudio.get_sample_size(format)
+        wf = wave.open(str(record_path), 'wb')
+        wf.setnchannels(channels)
+        wf.setsampwidth(sampwidth)
+        wf.setframerate(rate)
+        with wf, get_audio_devices().acquire_input(rate, channels, chunk, sampwidth) as stream:
+            print(f"[开始录音...最长{duration}秒，按Ctrl+C可提前结束]")
             
-            try:
+            start_time = time.time()
+            max_chunks = int(rate / chunk * duration)
+            
+            # 录音循环
+            for i in range(max_chunks):
+                if recording_interrupted:
+                    break
+                    
+                # 每秒更新一次状态
+                if i % int(rate / chunk) == 0:
+                    elapsed = time.time() - start_time
+                    remaining = duration - elapsed
+                    print(f"\r已录制: {elapsed:.1f}秒 | 剩余: {remaining:.1f}秒...", end="", flush=True)
+                
+                # 缓冲区溢出时不抛出异常，其余读取错误（如设备被拔出）会结束录音
                 data = stream.read(chunk)
-                frames.append(data)
-            except IOError as e:
-                # 忽略溢出错误，继续录音
-                print(f"\r[警告: {e}]", end="", flush=True)
+                wf.writeframes(data)
+                frame_count += 1
+                if on_frame:
+                    on_frame(data)
         
         if not recording_interrupted:
             print("\r[录音完成，已达到最大时长]                    ")
         
-        # 停止和关闭流
-        stream.stop_stream()
-        stream.close()
-        p.terminate()
-        
         # 检查是否录到了内容
-        if not frames:
+        if not frame_count:
+            record_path.unlink(missing_ok=True)
             print("[录音为空，未保存文件]")
             return None
         
-        # 保存录音
-        wf = wave.open(str(record_path), 'wb')
-        wf.setnchannels(channels)
-        wf.setsampwidth(p.get_sample_size(format))
-        wf.setframerate(rate)
-        wf.writeframes(b''.join(frames))
-        wf.close()
-        
-        actual_duration = len(frames) * chunk / rate
+        actual_duration = frame_count * chunk / rate
         print(f"[已保存录音，实际长度: {actual_duration:.1f}秒]")
         
         return record_path
@@ -275,17 +604,75 @@ def record_audio(filename, duration=60, rate=16000, chunk=1024, channels=1, form
         # 恢复原来的信号处理函数
         signal.signal(signal.SIGINT, original_handler)
 
-def encode_audio(audio_path):
-    """将音频文件编码为Base64"""
+def prewarm_connection():
+    """在后台预先连接最快的接口地址，录音期间持续保持；返回ConnectionWarmer（用完调用stop()）"""
+    return ConnectionWarmer(get_endpoint_pool().failover_order()[0], load_config().get("streaming_body")).start()
+
+def record_voice_input(filename, duration=60, rate=16000, trace=None):
+    """录制一轮语音输入：录音的同时逐帧编码并预先连接接口，录音结束即可发送
+    
+    返回(录音文件路径, CapturedAudio)，CapturedAudio可以直接作为build_user_message的base64_audio；
+    录音失败时返回(None, None)。trace为tracing.TurnTrace时记录录音起止和编码完成的时间。
+    """
+    capture = CapturedAudio(rate)
+    warmer = prewarm_connection()
     try:
-        with open(audio_path, "rb") as audio_file:
-            return base64.b64encode(audio_file.read()).decode("utf-8")
-    except Exception as e:
-        print(f"[音频编码出错: {str(e)}]")
+        audio_path = record_audio(filename, duration=duration, rate=rate, on_frame=capture.write)
+    finally:
+        warmer.stop()
+    if not audio_path:
+        return None, None
+    capture.finish()
+    if trace is not None:
+        trace_recording(trace, capture)
+    return audio_path, capture
+
+def trace_recording(trace, capture):
+    """把录音（CapturedAudio）的开始、停止和编码完成时间记录到这一轮的跟踪记录中"""
+    trace.mark("record_start", capture.started_at)
+    trace.mark("record_end", capture.stopped_at)
+    trace.mark("encoded", capture.finished_at)
+    trace.set("chat.record_seconds", round(capture.duration, 2))
+
+def attachment_part(kind, base64_data, subtype=None):
+    """构建一个多模态内容项，kind为audio、image或video；base64_data为base64字符串或媒体句柄（MediaHandle）"""
+    return ContentPart.media(kind, base64_data, subtype)
+
+def build_user_message(text, base64_audio=None, base64_image=None, image_type="png", base64_video=None, video_type="mp4",
+                       attachments=None):
+    """构建用户消息（message_model.Message），有媒体数据时生成多模态内容
+
+    attachments为prepare_attachments()返回的附件列表，可以同时包含多张图片、音频和视频，
+    按顺序放在文字之前。
+    """
+    parts = []
+    if base64_audio:
+        parts.append(attachment_part("audio", base64_audio))
+    elif base64_image:
+        parts.append(attachment_part("image", base64_image, image_type))
+    elif base64_video:
+        parts.append(attachment_part("video", base64_video, video_type))
+    for attachment in attachments or []:
+        parts.append(attachment_part(attachment["kind"], attachment["media"], attachment["subtype"]))
+    return Message.user(text, parts)
+
+def prepare_attachments(paths, progress=None, cancelled=None):
+    """并行读取并编码多个附件，总大小超出上限时自动缩小（配置见config.json中的"attachments"项）"""
+    return prepare_attachment_files(paths, load_config().get("attachments"), progress, cancelled)
+
+def load_attachment(path):
+    """读取交互模式中选择的一个文件，返回附件列表（引用文件的媒体句柄，发送时才边读边编码）；失败时返回None"""
+    try:
+        return prepare_attachments([path])
+    except AttachmentError as e:
+        print(f"[{e}]")
         return None
 
 def chat_with_qwen():
     """与Qwen模型进行对话"""
+    # 初始化API密钥池（首次使用时会请求输入API密钥）
+    get_key_pool()
+    
     print("欢迎使用Qwen Omni聊天程序!")
     
     # 选择模型
@@ -350,22 +737,29 @@ def chat_with_qwen():
     use_image_input = (input_mode == "3")
     use_video_input = (input_mode == "4")  # 视频输入标志
     
+    # 在后台打开音频设备
+    prewarm_audio_devices(use_input=use_voice_input, use_output=use_audio)
+    
     print(f"\n已选择{'语音' if use_voice_input else '图片+文字' if use_image_input else '视频+文字' if use_video_input else '文字'}输入，{'文字+' + ('实时' if use_streaming_audio else '') + '语音' if use_audio else '仅文字'}输出模式。")
     print("输入'exit'或'退出'结束对话，输入'record'或'录音'使用语音输入（如已选择文字输入模式）。")
     print("输入'image'或'图片'上传图片（如已选择文字输入模式）。")
+    if use_audio:
+        print("输入'stop'或'停止'停止正在播放的语音回复。")
     print("输入'video'或'视频'上传视频（如已选择文字输入模式）。")  # 添加视频上传提示
+    print("输入'retry'或'重试'重新生成上一条回复，'edit'或'编辑'修改上一条消息，'branch'或'分支'切换到其他分支。")
     
-    # 存储对话历史
-    messages = []
+    # 存储对话历史：重试和编辑生成新的分支，各分支共用公共前缀
+    conversation = ConversationTree()
     
     try:
         while True:
             # 获取用户输入
             image_path = None
-            base64_image = None
             base64_audio = None  # 确保变量存在
             video_path = None  # 视频文件路径
-            base64_video = None  # 视频Base64编码
+            attachments = None  # 选择的图片或视频（load_attachment返回的附件列表）
+            retry_turn = None  # 重新生成回复时为原来的用户消息节点
+            turn_trace = start_turn_trace("cli.turn", "cli")  # 记录这一轮各阶段的耗时
             
             if use_voice_input:
                 print("\n[准备录音输入]")
@@ -377,19 +771,14 @@ def chat_with_qwen():
                     print("[无效输入，使用默认值60秒]")
                     duration = 60
                 
-                # 录制音频
-                audio_path = record_audio(f"input_{int(time.time())}.wav", duration=duration)
+                # 录制音频：边录边编码，同时预先连接接口
+                audio_path, base64_audio = record_voice_input(f"input_{int(time.time())}.wav", duration=duration,
+                                                              trace=turn_trace)
                 
                 if not audio_path:
                     print("[录音失败，请重试或切换到文字输入]")
                     continue
                 
-                # 编码音频
-                base64_audio = encode_audio(audio_path)
-                if not base64_audio:
-                    print("[音频编码失败，请重试]")
-                    continue
-                
                 user_input = "我刚才说的是什么？请回答我的问题或请求。"
                 print(f"\n你: [语音输入已录制，长度:{duration}秒]")
                 
@@ -407,10 +796,10 @@ def chat_with_qwen():
                         print("[未选择图片，请重试]")
                         continue
                     
-                    # 编码图片
-                    base64_image = encode_image(image_path)
-                    if not base64_image:
-                        print("[图片编码失败，请重试]")
+                    # 读取图片（只保存引用文件的媒体句柄，不生成base64字符串）
+                    attachments = load_attachment(image_path)
+                    if attachments is None:
+                        print("[图片读取失败，请重试]")
                         continue
                     
                     print(f"[已选择图片: {image_path}]")
@@ -446,10 +835,10 @@ def chat_with_qwen():
                         print("[未选择视频，请重试]")
                         continue
                     
-                    # 编码视频
-                    base64_video = encode_video(video_path)
-                    if not base64_video:
-                        print("[视频编码失败，请重试]")
+                    # 读取视频（只保存引用文件的媒体句柄，不生成base64字符串）
+                    attachments = load_attachment(video_path)
+                    if attachments is None:
+                        print("[视频读取失败，请重试]")
                         continue
                     
                     print(f"[已选择视频: {video_path}]")
@@ -488,19 +877,14 @@ def chat_with_qwen():
                         print("[无效输入，使用默认值60秒]")
                         duration = 60
                     
-                    # 录制音频
-                    audio_path = record_audio(f"input_{int(time.time())}.wav", duration=duration)
+                    # 录制音频：边录边编码，同时预先连接接口
+                    audio_path, base64_audio = record_voice_input(f"input_{int(time.time())}.wav",
+                                                                  duration=duration, trace=turn_trace)
                     
                     if not audio_path:
                         print("[录音失败，请重试]")
                         continue
                     
-                    # 编码音频
-                    base64_audio = encode_audio(audio_path)
-                    if not base64_audio:
-                        print("[音频编码失败，请重试]")
-                        continue
-                    
                     user_input = "我刚才说的是什么？请回答我的问题或请求。"
                     print(f"你: [语音输入已替换为: {user_input}]")
                     
@@ -517,10 +901,10 @@ def chat_with_qwen():
                             print("[未选择图片，请输入文本]")
                             continue
                         
-                        # 编码图片
-                        base64_image = encode_image(image_path)
-                        if not base64_image:
-                            print("[图片编码失败，请重试]")
+                        # 读取图片（只保存引用文件的媒体句柄，不生成base64字符串）
+                        attachments = load_attachment(image_path)
+                        if attachments is None:
+                            print("[图片读取失败，请重试]")
                             continue
                         
                         print(f"[已选择图片: {image_path}]")
@@ -553,10 +937,10 @@ def chat_with_qwen():
                             print("[未选择视频，请输入文本]")
                             continue
                         
-                        # 编码视频
-                        base64_video = encode_video(video_path)
-                        if not base64_video:
-                            print("[视频编码失败，请重试]")
+                        # 读取视频（只保存引用文件的媒体句柄，不生成base64字符串）
+                        attachments = load_attachment(video_path)
+                        if attachments is None:
+                            print("[视频读取失败，请重试]")
                             continue
                         
                         print(f"[已选择视频: {video_path}]")
@@ -576,6 +960,46 @@ def chat_with_qwen():
                         print(f"[选择视频时出错: {str(e)}]")
                         continue
                 
+                # 重新生成上一条回复，原回复保留为另一个分支
+                elif user_input.lower() in ['retry', '重试']:
+                    retry_turn = conversation.regenerate()
+                    if retry_turn is None:
+                        print("[还没有可以重新生成的回复]")
+                        continue
+                    user_input = retry_turn.message.text
+                    print(f"[重新生成: {user_input}]")
+                
+                # 修改上一条消息，发送后成为新的分支
+                elif user_input.lower() in ['edit', '编辑']:
+                    previous_head = conversation.head
+                    edited_turn = conversation.edit_last()
+                    if edited_turn is None:
+                        print("[还没有可以编辑的消息]")
+                        continue
+                    print(f"[原消息: {edited_turn.message.text}]")
+                    user_input = input("修改为: ")
+                    if not user_input.strip():
+                        # 放弃编辑，回到原来的分支
+                        conversation.switch(previous_head)
+                        print("[已取消编辑]")
+                        continue
+                
+                # 切换到最近分叉处的下一个分支
+                elif user_input.lower() in ['branch', '分支']:
+                    switched = conversation.switch_branch()
+                    if switched is None:
+                        print("[没有其他分支]")
+                        continue
+                    print(f"\n[分支 {switched[0] + 1}/{switched[1]}]")
+                    print(format_history(conversation.history()), end="")
+                    continue
+                
+                # 停止正在播放的语音回复
+                elif user_input.lower() in ['stop', '停止']:
+                    stop_playback()
+                    print("[已停止播放]")
+                    continue
+                
                 # 检查是否退出
                 elif user_input.lower() in ['exit', '退出']:
                     print("谢谢使用，再见!")
@@ -583,60 +1007,27 @@ def chat_with_qwen():
             
             print("\n正在思考...", end="", flush=True)
             
+            audio_tee = None
             try:
                 # 准备消息内容
-                if use_voice_input or user_input.lower() in ['record', '录音']:
+                if retry_turn is not None:
+                    # 再次发送原来的完整消息
+                    user_message = conversation.request_for(retry_turn)
+                elif use_voice_input or user_input.lower() in ['record', '录音']:
                     # 构建多模态消息
-                    message_content = [
-                        {
-                            "type": "input_audio",
-                            "input_audio": {
-                                "data": f"data:;base64,{base64_audio}",
-                                "format": "wav",  # 根据实际录音格式调整
-                            },
-                        },
-                        {"type": "text", "text": user_input}
-                    ]
-                    messages.append({"role": "user", "content": message_content})
-                elif use_image_input or base64_image:
-                    # 构建包含图片的消息
-                    image_extension = Path(image_path).suffix.lower().replace(".", "") if image_path else "png"
-                    message_content = [
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/{image_extension};base64,{base64_image}"
-                            }
-                        },
-                        {"type": "text", "text": user_input}
-                    ]
-                    messages.append({"role": "user", "content": message_content})
-                    # 重置标志，除非用户明确选择了图片输入模式
-                    if not use_image_input:
-                        use_image_input = False
-                elif use_video_input or base64_video:
-                    # 构建包含视频的消息
-                    message_content = [
-                        {
-                            "type": "video_url",
-                            "video_url": {
-                                "url": f"data:video/mp4;base64,{base64_video}"  # 假设是MP4格式
-                            }
-                        },
-                        {"type": "text", "text": user_input}
-                    ]
-                    messages.append({"role": "user", "content": message_content})
-                    # 重置标志，除非用户明确选择了视频输入模式
-                    if not use_video_input:
-                        use_video_input = False
+                    user_message = build_user_message(user_input, base64_audio=base64_audio)
+                elif attachments:
+                    # 构建包含图片或视频的消息，格式按文件扩展名确定
+                    user_message = build_user_message(user_input, attachments=attachments)
                 else:
                     # 普通文本消息
-                    messages.append({"role": "user", "content": user_input})
+                    user_message = Message.user(user_input)
+                parent = retry_turn.parent if retry_turn is not None else conversation.head
                 
                 # 调用API
                 completion_args = {
                     "model": selected_model,  # 使用选定的模型
-                    "messages": messages,
+                    "messages": conversation.history(parent) + [user_message],
                     "modalities": modalities,
                     "stream": True,
                     "stream_options": {"include_usage": True},
@@ -646,13 +1037,17 @@ def chat_with_qwen():
                 if use_audio:
                     completion_args["audio"] = {"voice": "Cherry", "format": "wav"}
                 
-                completion = client.chat.completions.create(**completion_args)
+                completion = stream_completion(completion_args, session_id="cli",
+                                               priority="voice" if base64_audio else "text", trace=turn_trace)
                 
                 print("\r助手: ", end="", flush=True)
                 
-                # 收集完整的回复文本和音频内容
+                # 收集完整的回复文本；音频边接收边解码，同时播放（实时模式）并保存到文件
                 full_response = ""
-                audio_string = ""
+                audio_path = None
+                if use_audio:
+                    audio_path = output_dir / f"response_{int(time.time())}.wav"
+                    audio_tee = create_audio_tee(audio_path, speaker=use_streaming_audio, trace=turn_trace)
                 
                 for chunk in completion:
                     if chunk.choices:
@@ -666,13 +1061,7 @@ def chat_with_qwen():
                             try:
                                 # 获取音频数据
                                 if isinstance(delta.audio, dict) and "data" in delta.audio:
-                                    chunk_audio_data = delta.audio["data"]
-                                    # 如果是实时流式播放，则立即播放
-                                    if use_streaming_audio:
-                                        play_audio_streaming(chunk_audio_data)
-                                    # 否则，将数据累加起来
-                                    else:
-                                        audio_string += chunk_audio_data
+                                    audio_tee.write_base64(delta.audio["data"])
                             except Exception as e:
                                 # 如果有文本记录，则输出
                                 if isinstance(delta.audio, dict) and "transcript" in delta.audio:
@@ -683,36 +1072,38 @@ def chat_with_qwen():
                     elif hasattr(chunk, 'usage'):
                         print(f"\n\n[使用统计: 输入tokens: {chunk.usage.prompt_tokens}, 输出tokens: {chunk.usage.completion_tokens}]")
                 
-                # 将助手回复简化为纯文本以添加到历史记录
-                if len(messages) > 0 and isinstance(messages[-1]["content"], list):
-                    # 如果最后一条消息是多模态内容，需要调整历史记录格式
-                    for item in messages[-1]["content"]:
-                        if item.get("type") == "text":
-                            messages[-1] = {"role": "user", "content": item.get("text", "")}
-                            break
+                # 添加到对话历史（用户消息只保留文字），重新生成的回复成为原回复的兄弟分支
+                conversation.commit(parent, user_message, Message.assistant(full_response), retry_turn)
+                if "record_end" in turn_trace.marks:
+                    print(f"\n{turn_trace.report()}")
                 
-                # 添加助手回复到对话历史
-                messages.append({"role": "assistant", "content": full_response})
-                
-                # 如果有音频内容且非实时播放模式，等全部接收完再播放
-                if use_audio and not use_streaming_audio and audio_string:
-                    audio_filename = f"response_{int(time.time())}.wav"
+                # 等所有音频输出写完；非实时播放模式下接收完再播放
+                playing = False
+                if audio_tee:
                     try:
-                        print(f"\n[正在处理音频...]")
-                        audio_path = save_audio_base64(audio_string, audio_filename)
+                        audio_path = finish_audio_tee(audio_tee, audio_path)
+                        audio_tee = None
+                        playing = use_streaming_audio
                         if audio_path:
-                            print(f"[音频已保存到 {audio_path}]")
-                            print(f"[播放语音回复...]")
-                            play_audio_system(audio_path)
-                        else:
-                            print("[无法处理音频内容]")
+                            print(f"\n[音频已保存到 {audio_path}]")
+                            if not use_streaming_audio:
+                                print(f"[播放语音回复...]")
+                                play_audio_system(audio_path, trace=turn_trace)
+                                playing = True
                     except Exception as e:
                         print(f"[处理音频时出错: {str(e)}]")
                 
+                # 跟踪记录在语音回复播完后写入（见config.json中的"tracing"项）
+                end_turn_trace(turn_trace, playing)
+                
             except Exception as e:
                 print(f"\n发生错误: {str(e)}")
                 import traceback
                 print(traceback.format_exc())
+                if audio_tee:
+                    finish_audio_tee(audio_tee, audio_path)
+                turn_trace.fail(e)
+                end_turn_trace(turn_trace)
                 
             # 如果是语音输入模式，每次对话后询问是否继续使用语音输入
             if use_voice_input:
@@ -730,9 +1121,156 @@ def chat_with_qwen():
                 use_video_input = choice in ['y', 'yes', '是', 'true', 't', '']
                 
     finally:
-        # 如果使用了流式音频，确保资源被清理
-        if use_audio and use_streaming_audio:
+        # 如果使用了语音输出，确保播放资源被清理
+        if use_audio:
             cleanup_audio_streaming()
 
+# 单次调用模式的退出码
+EXIT_OK = 0
+EXIT_API_ERROR = 1
+EXIT_USAGE = 2
+EXIT_INPUT_ERROR = 3
+EXIT_INTERRUPTED = 130
+
+def parse_args(argv=None):
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(
+        description="Qwen Omni聊天程序。不带参数时进入交互模式；"
+                    "指定--prompt或媒体文件、或从管道输入时，执行单次对话并以JSONL事件输出到标准输出。")
+    parser.add_argument("-p", "--prompt", help="提示词；标准输入为管道时，管道内容会追加在提示词之后")
+    parser.add_argument("--image", action="append", default=[], help="图片文件路径（可重复指定多张）")
+    parser.add_argument("--video", action="append", default=[], help="视频文件路径（可重复指定）")
+    parser.add_argument("--audio", action="append", default=[], help="音频文件路径(.wav，可重复指定)")
+    parser.add_argument("-m", "--model", help="使用的模型 (默认: 配置文件中选择的模型)")
+    parser.add_argument("--output-audio", nargs="?", const="", metavar="PATH",
+                        help="同时生成语音回复并保存为WAV文件 (默认保存到audio_output目录)")
+    parser.add_argument("--duplex", action="store_true",
+                        help="全双工语音模式：麦克风一直打开，说完一句话自动发送，回复播放时开口即可打断")
+    parser.add_argument("--mic-file", metavar="PATH",
+                        help="全双工模式下用WAV文件（16kHz、16位、单声道）代替麦克风")
+    return parser.parse_args(argv)
+
+def emit_event(stream, event_type, **fields):
+    """输出一行JSONL事件"""
+    stream.write(json.dumps(dict(type=event_type, **fields), ensure_ascii=False) + "\n")
+    stream.flush()
+
+def run_single_shot(args):
+    """执行单次对话，按JSONL事件流输出结果，返回退出码"""
+    # 标准输出只用于事件流，其余提示信息改到标准错误
+    events = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        prompt = args.prompt or ""
+        if not sys.stdin.isatty():
+            piped = sys.stdin.read().strip()
+            if piped:
+                prompt = f"{prompt}\n\n{piped}" if prompt else piped
+        
+        # 并行读取媒体文件，总大小超出上限时自动缩小图片和视频
+        media_paths = args.image + args.video + args.audio
+        try:
+            attachments = prepare_attachments(media_paths)
+        except AttachmentError as e:
+            emit_event(events, "error", message=str(e))
+            return EXIT_INPUT_ERROR
+        has_audio = bool(args.audio)
+        if has_audio:
+            prompt = prompt or "我刚才说的是什么？请回答我的问题或请求。"
+        if not prompt:
+            emit_event(events, "error", message="没有输入内容，请使用--prompt、媒体文件参数或管道输入")
+            return EXIT_USAGE
+        
+        try:
+            get_key_pool(interactive=False)
+        except NoKeyAvailable as e:
+            emit_event(events, "error", message=str(e))
+            return EXIT_INPUT_ERROR
+        
+        use_audio = args.output_audio is not None
+        model = args.model or get_selected_model()
+        completion_args = {
+            "model": model,
+            "messages": [build_user_message(prompt, attachments=attachments)],
+            "modalities": ["text", "audio"] if use_audio else ["text"],
+            "stream": True,
+            "stream_options": {"include_usage": True},
+        }
+        if use_audio:
+            completion_args["audio"] = {"voice": "Cherry", "format": "wav"}
+        
+        trace = start_turn_trace("cli.oneshot")
+        emit_event(events, "start", model=model, trace_id=trace.trace_id)
+        start_time = time.time()
+        first_token_latency = None
+        full_response = ""
+        transcript = ""
+        audio_path = None
+        audio_tee = None
+        if use_audio:
+            # 音频边接收边写入文件（--output-audio以.flac结尾时保存为FLAC）
+            audio_path = Path(args.output_audio) if args.output_audio else output_dir / f"response_{int(time.time())}.wav"
+            try:
+                audio_tee = create_audio_tee(audio_path)
+            except Exception as e:
+                emit_event(events, "error", message=f"无法写入音频文件 {audio_path}: {e}")
+                return EXIT_INPUT_ERROR
+        try:
+            for chunk in stream_completion(completion_args, session_id="cli",
+                                           priority="voice" if has_audio else "text", trace=trace):
+                if chunk.choices:
+                    delta = chunk.choices[0].delta
+                    if delta.content:
+                        if first_token_latency is None:
+                            first_token_latency = time.time() - start_time
+                        full_response += delta.content
+                        emit_event(events, "text", delta=delta.content)
+                    audio = getattr(delta, "audio", None)
+                    if use_audio and isinstance(audio, dict):
+                        if audio.get("transcript"):
+                            if first_token_latency is None:
+                                first_token_latency = time.time() - start_time
+                            transcript += audio["transcript"]
+                            emit_event(events, "transcript", delta=audio["transcript"])
+                        if audio.get("data"):
+                            audio_tee.write_base64(audio["data"])
+                elif getattr(chunk, "usage", None):
+                    emit_event(events, "usage",
+                               prompt_tokens=chunk.usage.prompt_tokens,
+                               completion_tokens=chunk.usage.completion_tokens)
+        except Exception as e:
+            emit_event(events, "error", message=str(e), status_code=getattr(e, "status_code", None))
+            return EXIT_API_ERROR
+        finally:
+            if audio_tee:
+                audio_path = finish_audio_tee(audio_tee, audio_path)
+            trace.end()
+        
+        if audio_path:
+            emit_event(events, "audio", path=str(audio_path))
+        
+        emit_event(events, "done", text=full_response or transcript,
+                   first_token_latency=first_token_latency, latency=time.time() - start_time)
+        return EXIT_OK
+    except KeyboardInterrupt:
+        emit_event(events, "error", message="已中断")
+        return EXIT_INTERRUPTED
+    finally:
+        sys.stdout = events
+
+def main(argv=None):
+    """命令行入口：有参数或管道输入时执行单次对话，否则进入交互模式"""
+    args = parse_args(argv)
+    if args.duplex:
+        import duplex_voice
+        return duplex_voice.run_duplex(args.mic_file, args.model)
+    # 指定了任何单次调用的参数（包括只有--model或--output-audio）时不进入交互模式，缺少输入内容时报错
+    single_shot_options = (args.prompt is not None or args.image or args.video or args.audio
+                           or args.model is not None or args.output_audio is not None)
+    if not single_shot_options and sys.stdin.isatty():
+        chat_with_qwen()
+        return EXIT_OK
+    return run_single_shot(args)
+
 if __name__ == "__main__":
-    chat_with_qwen()
+    sys.exit(main())
@@ -5,8 +5,7 @@ import threading
 import queue
 import signal
 import wave
-import pyaudio
-import base64
+from collections import OrderedDict
 from pathlib import Path
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
                             QHBoxLayout, QPushButton, QTextEdit, QComboBox, 
@@ -14,11 +13,14 @@ from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout,
                             QFileDialog, QSpinBox, QSplitter, QGraphicsBlurEffect,
                             QGraphicsDropShadowEffect, QGraphicsOpacityEffect,
                             QDialog, QInputDialog)
-from PyQt5.QtCore import Qt, QObject, pyqtSignal, QTimer, QEvent, QThread
-from PyQt5.QtGui import QPalette, QColor, QFont, QIcon, QTextCursor, QPainter, QPixmap, QPen
+from PyQt5.QtCore import Qt, QObject, pyqtSignal, QTimer, QEvent, QThread, QSize
+from PyQt5.QtGui import QPalette, QColor, QFont, QIcon, QTextCursor, QPainter, QPixmap, QPen, QImageReader
 
 # 导入原始的qwen_chat模块
 import qwen_chat
+from message_model import Message
+from conversation_tree import ConversationTree, format_history
+from voice_pipeline import CapturedAudio
 
 # 创建消息队列用于线程间通信
 message_queue = queue.Queue()
@@ -100,63 +102,51 @@ class RecordingThread(QThread):
                 record_path = Path("audio_input") / filename
                 record_path.parent.mkdir(exist_ok=True)
                 
-                # 初始化PyAudio
-                p = pyaudio.PyAudio()
-                stream = p.open(format=pyaudio.paInt16, 
-                              channels=1,
-                              rate=16000,
-                              input=True,
-                              frames_per_buffer=1024)
-                
-                frames = []
+                frame_count = 0
                 max_chunks = int(16000 / 1024 * self.duration)
                 
-                # 录音循环
-                for i in range(max_chunks):
-                    if self.is_interrupted:
-                        break
-                    
-                    # 更新进度
-                    if i % int(16000 / 1024) == 0:  # 每秒更新一次
-                        elapsed = time.time() - self.start_time
-                        progress = min(int(elapsed / self.duration * 100), 100)
-                        self.progress.emit(progress)
-                    
-                    try:
-                        data = stream.read(1024)
-                        frames.append(data)
-                    except IOError as e:
-                        # 忽略溢出错误，继续录音
-                        self.status.emit(f"\r[警告: {e}]")
+                # 边录边写入文件、逐帧编码，同时预先连接接口，停止录音后即可发送
+                capture = CapturedAudio(16000)
+                warmer = qwen_chat.prewarm_connection()
+                wf = wave.open(str(record_path), 'wb')
+                wf.setnchannels(1)
+                wf.setsampwidth(2)
+                wf.setframerate(16000)
                 
-                # 停止和关闭流
-                stream.stop_stream()
-                stream.close()
-                p.terminate()
+                try:
+                    # 使用共享的输入流，不再每次初始化PortAudio
+                    with wf, qwen_chat.get_audio_devices().acquire_input(16000, 1, 1024) as stream:
+                        # 录音循环
+                        for i in range(max_chunks):
+                            if self.is_interrupted:
+                                break
+                        
+                            # 更新进度
+                            if i % int(16000 / 1024) == 0:  # 每秒更新一次
+                                elapsed = time.time() - self.start_time
+                                progress = min(int(elapsed / self.duration * 100), 100)
+                                self.progress.emit(progress)
+                        
+                            # 缓冲区溢出时不抛出异常，其余读取错误（如设备被拔出）会结束录音
+                            data = stream.read(1024)
+                            wf.writeframes(data)
+                            capture.write(data)
+                            frame_count += 1
+                finally:
+                    warmer.stop()
                 
                 # 检查是否录到了内容
-                if not frames:
+                if not frame_count:
+                    record_path.unlink(missing_ok=True)
                     self.status.emit("[录音为空，未保存文件]")
                     self.finished.emit(None, None)
                     return
                 
-                # 保存录音
-                wf = wave.open(str(record_path), 'wb')
-                wf.setnchannels(1)
-                wf.setsampwidth(p.get_sample_size(pyaudio.paInt16))
-                wf.setframerate(16000)
-                wf.writeframes(b''.join(frames))
-                wf.close()
-                
-                actual_duration = len(frames) * 1024 / 16000
+                actual_duration = frame_count * 1024 / 16000
                 self.status.emit(f"[已保存录音，实际长度: {actual_duration:.1f}秒]")
                 
-                # 编码音频
-                base64_audio = None
-                with open(record_path, "rb") as audio_file:
-                    base64_audio = base64.b64encode(audio_file.read()).decode("utf-8")
-                
-                self.finished.emit(record_path, base64_audio)
+                # 录音期间已经编码，只需补上文件头
+                self.finished.emit(record_path, capture.finish())
                 
             except Exception as e:
                 import traceback
@@ -175,22 +165,123 @@ class RecordingThread(QThread):
         self.is_interrupted = True
         self.status.emit("[录音被用户中断]")
 
+class LRUCache:
+    """线程安全的LRU缓存，按条目数和总大小淘汰最久未使用的条目"""
+    
+    def __init__(self, max_items=32, max_bytes=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+    
+    def get(self, key):
+        with self.lock:
+            entry = self.items.get(key)
+            if entry is None:
+                return None
+            self.items.move_to_end(key)
+            return entry[0]
+    
+    def put(self, key, value, size=0):
+        with self.lock:
+            if key in self.items:
+                self.total_bytes -= self.items.pop(key)[1]
+            self.items[key] = (value, size)
+            self.total_bytes += size
+            while self.items and (len(self.items) > self.max_items or
+                                  (self.max_bytes and self.total_bytes > self.max_bytes)):
+                _, (_, evicted_size) = self.items.popitem(last=False)
+                self.total_bytes -= evicted_size
+
+# 缩略图缓存：(路径, 大小, 修改时间, 高度) -> QImage
+thumbnail_cache = LRUCache(max_items=64)
+
+def file_signature(path):
+    stat = os.stat(path)
+    return str(path), stat.st_size, stat.st_mtime_ns
+
+def load_thumbnail(path, height):
+    """按缩略图尺寸解码图片（QImageReader只解码所需大小），结果缓存；失败返回None"""
+    key = file_signature(path) + (height,)
+    image = thumbnail_cache.get(key)
+    if image is None:
+        reader = QImageReader(str(path))
+        reader.setAutoTransform(True)
+        size = reader.size()
+        if size.isValid() and size.height() > height:
+            reader.setScaledSize(size.scaled(QSize(size.width(), height), Qt.KeepAspectRatio))
+        image = reader.read()
+        if image.isNull():
+            return None
+        thumbnail_cache.put(key, image)
+    return image
+
+def describe_paths(paths):
+    """附件列表的简短描述，如“a.png 等3个文件”"""
+    name = os.path.basename(paths[0])
+    return name if len(paths) == 1 else f"{name} 等{len(paths)}个文件"
+
+# 附件预处理线程：在后台生成缩略图，并行编码多个附件（见qwen_chat.prepare_attachments）
+class MediaPrepThread(QThread):
+    progress = pyqtSignal(int)
+    thumbnail = pyqtSignal(object)
+    ready = pyqtSignal(object)
+    failed = pyqtSignal(str)
+    
+    def __init__(self, kind, paths, thumbnail_height=0):
+        super().__init__()
+        self.kind = kind
+        self.paths = list(paths)
+        self.thumbnail_height = thumbnail_height
+        self.cancelled = False
+    
+    def cancel(self):
+        self.cancelled = True
+    
+    def run(self):
+        try:
+            if self.kind == "image" and self.thumbnail_height > 0:
+                image = load_thumbnail(self.paths[0], self.thumbnail_height)
+                if image is not None and not self.cancelled:
+                    self.thumbnail.emit(image)
+            
+            attachments = qwen_chat.prepare_attachments(
+                self.paths,
+                progress=lambda done, total: self.progress.emit(int(done * 100 / max(1, total))),
+                cancelled=lambda: self.cancelled)
+            
+            if attachments is not None and not self.cancelled:
+                self.progress.emit(100)
+                self.ready.emit({"kind": self.kind, "paths": self.paths, "attachments": attachments})
+        except Exception as e:
+            if not self.cancelled:
+                self.failed.emit(str(e))
+
 # 聊天线程类
 class ChatThread(QThread):
-    def __init__(self, user_input, messages, use_voice, use_audio, use_streaming_audio, base64_audio, base64_image=None, image_type="png", base64_video=None, selected_model=None):
+    def __init__(self, user_input, conversation, use_voice, use_audio, use_streaming_audio, audio_media, attachments=None,
+                 selected_model=None, user_turn=None):
         super().__init__()
         self.user_input = user_input
-        self.messages = messages.copy()  # 复制消息列表以避免线程安全问题
+        # 对话树的节点创建后不再修改，线程只记住从哪个节点继续，不需要复制消息列表
+        self.conversation = conversation
+        # 重新生成回复时为原来的用户消息节点，直接再次发送它的完整内容
+        self.user_turn = user_turn
+        self.parent = user_turn.parent if user_turn is not None else conversation.head
         self.use_voice = use_voice
         self.use_audio = use_audio
         self.use_streaming_audio = use_streaming_audio
-        self.base64_audio = base64_audio
-        self.base64_image = base64_image
-        self.image_type = image_type
-        self.base64_video = base64_video
+        # 录音和附件都是媒体句柄（见media_handles），发送请求时才生成base64
+        self.audio_media = audio_media
+        # 附件列表，可以同时包含多张图片和视频
+        self.attachments = attachments or []
         self.selected_model = selected_model or qwen_chat.get_selected_model()
     
     def run(self):
+        audio_tee = None
+        # 记录这一轮各阶段的耗时，语音回复播完后写入跟踪记录
+        trace = qwen_chat.start_turn_trace("ui.turn", "ui")
         try:
             # 添加系统消息
             message_queue.put(("system", "正在思考..."))
@@ -198,52 +289,19 @@ class ChatThread(QThread):
             # 设置模态
             modalities = ["text", "audio"] if self.use_audio else ["text"]
             
-            # 准备消息内容
-            if self.use_voice:
-                # 构建多模态消息
-                message_content = [
-                    {
-                        "type": "input_audio",
-                        "input_audio": {
-                            "data": f"data:;base64,{self.base64_audio}",
-                            "format": "wav",
-                        },
-                    },
-                    {"type": "text", "text": self.user_input}
-                ]
-                self.messages.append({"role": "user", "content": message_content})
-            elif self.base64_image:
-                # 构建包含图片的消息
-                message_content = [
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/{self.image_type};base64,{self.base64_image}"
-                        }
-                    },
-                    {"type": "text", "text": self.user_input}
-                ]
-                self.messages.append({"role": "user", "content": message_content})
-            elif self.base64_video:
-                # 构建包含视频的消息
-                message_content = [
-                    {
-                        "type": "video_url",
-                        "video_url": {
-                            "url": f"data:video/mp4;base64,{self.base64_video}"
-                        }
-                    },
-                    {"type": "text", "text": self.user_input}
-                ]
-                self.messages.append({"role": "user", "content": message_content})
+            # 准备消息内容：语音和各个附件按顺序放在文字之前
+            if self.user_turn is not None:
+                self.user_message = self.conversation.request_for(self.user_turn)
             else:
-                # 普通文本消息
-                self.messages.append({"role": "user", "content": self.user_input})
+                self.user_message = qwen_chat.build_user_message(
+                    self.user_input, self.audio_media if self.use_voice else None, attachments=self.attachments)
+                if self.use_voice and isinstance(self.audio_media, CapturedAudio):
+                    qwen_chat.trace_recording(trace, self.audio_media)
             
             # 调用API
             completion_args = {
                 "model": self.selected_model,  # 使用选定的模型
-                "messages": self.messages,
+                "messages": self.conversation.history(self.parent) + [self.user_message],
                 "modalities": modalities,
                 "stream": True,
                 "stream_options": {"include_usage": True},
@@ -253,15 +311,16 @@ class ChatThread(QThread):
             if self.use_audio:
                 completion_args["audio"] = {"voice": "Cherry", "format": "wav"}
             
-            # 创建客户端
-            client = qwen_chat.client
-            
-            # 调用API
-            completion = client.chat.completions.create(**completion_args)
+            # 调用API（经由模型路由）
+            completion = qwen_chat.stream_completion(completion_args, session_id="ui",
+                                                     priority="voice" if self.use_voice else "text", trace=trace)
             
-            # 收集完整的回复文本和音频内容
+            # 收集完整的回复文本；音频边接收边解码，同时播放（实时模式）并保存到文件
             full_response = ""
-            audio_string = ""
+            audio_path = None
+            if self.use_audio:
+                audio_path = qwen_chat.output_dir / f"response_{int(time.time())}.wav"
+                audio_tee = qwen_chat.create_audio_tee(audio_path, speaker=self.use_streaming_audio, trace=trace)
             
             message_queue.put(("text", "助手: "))
             
@@ -277,13 +336,7 @@ class ChatThread(QThread):
                         try:
                             # 获取音频数据
                             if isinstance(delta.audio, dict) and "data" in delta.audio:
-                                chunk_audio_data = delta.audio["data"]
-                                # 如果是实时流式播放，则立即播放
-                                if self.use_streaming_audio:
-                                    qwen_chat.play_audio_streaming(chunk_audio_data)
-                                # 否则，将数据累加起来
-                                else:
-                                    audio_string += chunk_audio_data
+                                audio_tee.write_base64(delta.audio["data"])
                         except Exception as e:
                             # 如果有文本记录，则输出
                             if isinstance(delta.audio, dict) and "transcript" in delta.audio:
@@ -297,11 +350,19 @@ class ChatThread(QThread):
                         f"输出tokens: {chunk.usage.completion_tokens}]"
                     ))
             
+            # 等所有音频输出写完
+            if audio_tee:
+                audio_path = qwen_chat.finish_audio_tee(audio_tee, audio_path)
+                audio_tee = None
+            
             # 返回结果
             return_data = {
                 "full_response": full_response,
-                "audio_string": audio_string,
-                "messages": self.messages
+                "audio_path": audio_path,
+                "parent": self.parent,
+                "user_message": self.user_message,
+                "user_turn": self.user_turn,
+                "trace": trace,
             }
             
             # 将结果放入队列
@@ -312,6 +373,10 @@ class ChatThread(QThread):
             message_queue.put(("system", f"发生错误: {str(e)}"))
             message_queue.put(("system", traceback.format_exc()))
             message_queue.put(("error", None))
+            if audio_tee:
+                qwen_chat.finish_audio_tee(audio_tee, audio_path)
+            trace.fail(e)
+            trace.end()
 
 # API密钥输入对话框
 class ApiKeyDialog(QDialog):
@@ -410,6 +475,9 @@ class QwenChatUI(QMainWindow):
         # 检查是否有保存的API密钥
         self.check_api_key()
         
+        # 在后台打开音频设备，缩短第一次录音和播放的等待时间
+        qwen_chat.prewarm_audio_devices()
+        
         # 设置窗口标题和大小
         self.setWindowTitle("Qwen Omni 聊天助手")
         self.resize(1000, 700)
@@ -588,11 +656,11 @@ class QwenChatUI(QMainWindow):
         # 输入模式选择
         self.input_mode_label = QLabel("输入模式:")
         self.input_mode_combo = QComboBox()
-        self.input_mode_combo.addItem("键盘文字输入")
+        self.input_mode_combo.addItem("键盘文字输入", "text")
         if qwen_chat.PYAUDIO_AVAILABLE:
-            self.input_mode_combo.addItem("语音录音输入")
-        self.input_mode_combo.addItem("图片+文字输入")
-        self.input_mode_combo.addItem("视频+文字输入")
+            self.input_mode_combo.addItem("语音录音输入", "voice")
+        self.input_mode_combo.addItem("图片+文字输入", "image")
+        self.input_mode_combo.addItem("视频+文字输入", "video")
         self.input_mode_combo.currentIndexChanged.connect(self.update_input_mode)
         
         # 添加退出按钮
@@ -612,6 +680,10 @@ class QwenChatUI(QMainWindow):
         """)
         self.exit_button.clicked.connect(self.close)
         
+        # 停止播放按钮
+        self.stop_playback_button = QPushButton("停止播放")
+        self.stop_playback_button.clicked.connect(self.stop_playback)
+        
         # 添加到设置布局
         self.settings_layout.addWidget(self.model_label)
         self.settings_layout.addWidget(self.model_combo)
@@ -620,6 +692,7 @@ class QwenChatUI(QMainWindow):
         self.settings_layout.addWidget(self.input_mode_label)
         self.settings_layout.addWidget(self.input_mode_combo)
         self.settings_layout.addStretch()
+        self.settings_layout.addWidget(self.stop_playback_button)
         self.settings_layout.addWidget(self.exit_button)
         
         # 添加设置布局到底部布局
@@ -693,6 +766,24 @@ class QwenChatUI(QMainWindow):
         self.video_preview.setMaximumHeight(200)
         self.video_preview.setStyleSheet("background-color: rgba(240, 240, 240, 120);")
         
+        # 附件处理进度和取消按钮
+        self.media_layout = QHBoxLayout()
+        self.media_status_label = QLabel("")
+        self.media_progress = QProgressBar()
+        self.media_progress.setRange(0, 100)
+        self.cancel_media_button = QPushButton("取消")
+        self.cancel_media_button.clicked.connect(self.cancel_media_prep)
+        self.media_layout.addWidget(self.media_status_label)
+        self.media_layout.addWidget(self.media_progress, 1)
+        self.media_layout.addWidget(self.cancel_media_button)
+        self.media_container = QWidget()
+        self.media_container.setLayout(self.media_layout)
+        self.media_container.setVisible(False)
+        
+        # 这一轮将要一起发送的录音、图片和视频（切换输入模式时保留）
+        self.turn_media_label = QLabel("")
+        self.turn_media_label.setVisible(False)
+        
         # 创建文本输入区域
         self.input_layout = QHBoxLayout()
         self.text_input = QTextEdit()
@@ -708,6 +799,24 @@ class QwenChatUI(QMainWindow):
         self.input_layout.addWidget(self.text_input)
         self.input_layout.addWidget(self.send_button)
         
+        # 重试、编辑和切换分支
+        self.branch_layout = QHBoxLayout()
+        self.regenerate_button = QPushButton("重新生成")
+        self.regenerate_button.clicked.connect(self.regenerate_reply)
+        self.edit_button = QPushButton("编辑上一条")
+        self.edit_button.clicked.connect(self.edit_last_prompt)
+        self.prev_branch_button = QPushButton("◀")
+        self.prev_branch_button.clicked.connect(lambda: self.switch_branch(-1))
+        self.branch_label = QLabel("")
+        self.next_branch_button = QPushButton("▶")
+        self.next_branch_button.clicked.connect(lambda: self.switch_branch(1))
+        self.branch_layout.addStretch()
+        self.branch_layout.addWidget(self.regenerate_button)
+        self.branch_layout.addWidget(self.edit_button)
+        self.branch_layout.addWidget(self.prev_branch_button)
+        self.branch_layout.addWidget(self.branch_label)
+        self.branch_layout.addWidget(self.next_branch_button)
+        
         # 添加录音布局和输入布局到底部布局
         self.bottom_layout.addLayout(self.recording_layout)
         self.bottom_layout.addWidget(self.recording_progress)
@@ -715,6 +824,9 @@ class QwenChatUI(QMainWindow):
         self.bottom_layout.addWidget(self.image_preview)
         self.bottom_layout.addLayout(self.video_layout)
         self.bottom_layout.addWidget(self.video_preview)
+        self.bottom_layout.addWidget(self.media_container)
+        self.bottom_layout.addWidget(self.turn_media_label)
+        self.bottom_layout.addLayout(self.branch_layout)
         self.bottom_layout.addLayout(self.input_layout)
         
         # 添加聊天区域和底部控制区域到主布局
@@ -722,18 +834,25 @@ class QwenChatUI(QMainWindow):
         self.main_layout.addWidget(self.bottom_container, 3)
         
         # 初始化变量
-        self.messages = []
+        self.conversation = ConversationTree()
         self.recording_thread = None
         self.chat_thread = None
         self.recording_timer = None
         self.audio_path = None
-        self.base64_audio = None
+        self.audio_media = None
         self.signals = ChatSignals()
-        self.image_path = None
-        self.base64_image = None
-        self.image_type = "png"
-        self.video_path = None
-        self.base64_video = None
+        # 选择的图片、视频路径，以及后台编码完成后的附件列表
+        self.image_paths = []
+        self.image_attachments = None
+        self.video_paths = []
+        self.video_attachments = None
+        # 进行中的预处理线程和进度，按类型（image/video）分开，图片和视频可以同时处理
+        self.media_prep_threads = {}
+        self.media_prep_progress = {}
+        # 预处理线程在结束前保留引用（包括已取消的）
+        self.media_threads = set()
+        # 附件还在处理时点了发送，处理完成后自动发送
+        self.pending_send = False
         self.selected_model = current_model
         
         # 连接信号
@@ -770,13 +889,8 @@ class QwenChatUI(QMainWindow):
                 if api_key.strip():
                     # 保存API密钥
                     if qwen_chat.save_api_key(api_key):
-                        # 重新初始化客户端
-                        qwen_chat.API_KEY = api_key
-                        os.environ["DASHSCOPE_API_KEY"] = api_key
-                        qwen_chat.client = OpenAI(
-                            api_key=api_key,
-                            base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
-                        )
+                        # 初始化密钥池和客户端
+                        qwen_chat.get_key_pool()
                         QMessageBox.information(self, "成功", "API密钥已保存，下次启动将自动读取")
                     else:
                         QMessageBox.warning(self, "警告", "API密钥保存失败，程序可能无法正常工作")
@@ -900,47 +1014,39 @@ class QwenChatUI(QMainWindow):
             return
         
         full_response = result.get("full_response", "")
-        audio_string = result.get("audio_string", "")
-        self.messages = result.get("messages", self.messages)
+        audio_path = result.get("audio_path")
         
-        if len(self.messages) >= 2 and isinstance(self.messages[-2]["content"], list):
-            user_input = self.messages[-2].get("content", "")
-            if isinstance(user_input, list):
-                for item in user_input:
-                    if item.get("type") == "text":
-                        user_input = item.get("text", "")
-                        break
-            self.messages[-2] = {"role": "user", "content": user_input}
-        
-        if len(self.messages) > 0 and self.messages[-1].get("role") != "assistant":
-            self.messages.append({"role": "assistant", "content": full_response})
+        # 记录到对话树：重新生成的回复成为原回复的兄弟分支
+        self.conversation.commit(result["parent"], result["user_message"],
+                                 Message.assistant(full_response), result["user_turn"])
+        self.update_branch_label()
         
         use_audio = self.output_mode_combo.currentIndex() > 0
         use_streaming_audio = self.output_mode_combo.currentIndex() == 2
+        trace = result["trace"]
+        playing = use_audio and use_streaming_audio
         
-        if use_audio and not use_streaming_audio and audio_string:
-            audio_filename = f"response_{int(time.time())}.wav"
-            try:
-                self.append_system_message("[正在处理音频...]")
-                audio_path = qwen_chat.save_audio_base64(audio_string, audio_filename)
-                if audio_path:
-                    self.append_system_message(f"[音频已保存到 {audio_path}]")
+        if use_audio and audio_path:
+            self.append_system_message(f"[音频已保存到 {audio_path}]")
+            if not use_streaming_audio:
+                try:
                     self.append_system_message("[播放语音回复...]")
-                    qwen_chat.play_audio_system(audio_path)
-                else:
-                    self.append_system_message("[无法处理音频内容]")
-            except Exception as e:
-                self.append_system_message(f"[处理音频时出错: {str(e)}]")
+                    qwen_chat.play_audio_system(audio_path, trace=trace)
+                    playing = True
+                except Exception as e:
+                    self.append_system_message(f"[处理音频时出错: {str(e)}]")
         
+        # 跟踪记录在语音回复播完后写入
+        qwen_chat.end_turn_trace(trace, playing)
         self.on_chat_completed()
     
     def update_input_mode(self):
-        """根据选择的输入模式更新UI"""
-        use_voice = self.input_mode_combo.currentIndex() == 1
-        use_image = self.input_mode_combo.currentIndex() == 2
-        use_video = self.input_mode_combo.currentIndex() == 3
+        """根据选择的输入模式显示对应的控件；已录制的语音和已选的附件都保留，发送时一起发送"""
+        mode = self.input_mode_combo.currentData()
+        use_voice = mode == "voice"
+        use_image = mode == "image"
+        use_video = mode == "video"
         
-        self.text_input.setVisible(not use_voice)
         self.duration_label.setVisible(use_voice)
         self.duration_spin.setVisible(use_voice)
         self.record_button.setVisible(use_voice)
@@ -956,91 +1062,195 @@ class QwenChatUI(QMainWindow):
         self.browse_video_button.setVisible(use_video)
         self.clear_video_button.setVisible(use_video)
         self.video_preview.setVisible(use_video)
-        
-        if not use_voice:
-            self.audio_path = None
-            self.base64_audio = None
-        
-        if not use_image:
-            self.clear_image()
-        
-        if not use_video:
-            self.clear_video()
+    
+    def update_turn_media(self):
+        """显示这一轮将要一起发送的录音和附件"""
+        items = []
+        if self.audio_media is not None:
+            items.append("录音")
+        if self.image_paths:
+            items.append(f"{len(self.image_paths)}张图片")
+        if self.video_paths:
+            items.append(f"{len(self.video_paths)}个视频")
+        self.turn_media_label.setText(f"本轮将一起发送: {'、'.join(items)}" if items else "")
+        self.turn_media_label.setVisible(bool(items))
+    
+    def clear_recording(self):
+        """清除已录制的语音"""
+        self.audio_path = None
+        self.audio_media = None
+        self.recording_progress.setVisible(False)
+        self.update_turn_media()
     
     def browse_image(self):
-        """浏览并选择图片"""
-        file_path, _ = QFileDialog.getOpenFileName(
-            self, "选择图片", "", "图片文件 (*.png *.jpg *.jpeg *.bmp *.gif)"
+        """浏览并选择图片（可多选），在后台生成缩略图并编码"""
+        file_paths, _ = QFileDialog.getOpenFileNames(
+            self, "选择图片", "", "图片文件 (*.png *.jpg *.jpeg *.bmp *.gif *.webp)"
         )
         
-        if file_path:
-            try:
-                self.image_path = file_path
-                self.image_type = Path(file_path).suffix.lower().replace(".", "")
-                if self.image_type not in ["png", "jpg", "jpeg", "bmp", "gif"]:
-                    self.image_type = "png"
-                
-                self.base64_image = qwen_chat.encode_image(file_path)
-                
-                self.image_path_label.setText(os.path.basename(file_path))
-                self.show_image_preview(file_path)
-                
-                self.append_system_message(f"[已选择图片: {os.path.basename(file_path)}]")
-            except Exception as e:
-                self.append_system_message(f"[图片加载失败: {str(e)}]")
-                self.clear_image()
+        if file_paths:
+            self.clear_image()
+            self.image_paths = file_paths
+            self.image_path_label.setText(describe_paths(file_paths))
+            self.start_media_prep("image", file_paths)
+            self.update_turn_media()
     
     def clear_image(self):
         """清除选择的图片"""
-        self.image_path = None
-        self.base64_image = None
+        self.stop_media_prep("image")
+        self.image_paths = []
+        self.image_attachments = None
         self.image_path_label.setText("未选择图片")
         self.image_preview.clear()
         self.image_preview.setText("图片预览")
+        self.update_turn_media()
     
     def show_image_preview(self, image_path):
-        """显示图片预览"""
+        """显示图片预览（按预览尺寸解码，不加载原图）"""
         if not image_path or not os.path.exists(image_path):
             return
         
-        pixmap = QPixmap(image_path)
-        if not pixmap.isNull():
-            preview_height = self.image_preview.height()
-            scaled_pixmap = pixmap.scaledToHeight(preview_height - 10, Qt.SmoothTransformation)
-            self.image_preview.setPixmap(scaled_pixmap)
+        image = load_thumbnail(image_path, self.image_preview.height() - 10)
+        if image is not None:
+            self.image_preview.setPixmap(QPixmap.fromImage(image))
     
     def browse_video(self):
-        """浏览并选择视频"""
-        file_path, _ = QFileDialog.getOpenFileName(
-            self, "选择视频", "", "视频文件 (*.mp4 *.avi *.mov)"
+        """浏览并选择视频（可多选），在后台编码"""
+        file_paths, _ = QFileDialog.getOpenFileNames(
+            self, "选择视频", "", "视频文件 (*.mp4 *.avi *.mov *.mkv)"
         )
         
-        if file_path:
-            try:
-                self.video_path = file_path
-                
-                self.base64_video = qwen_chat.encode_video(file_path)
-                
-                self.video_path_label.setText(os.path.basename(file_path))
-                
-                self.append_system_message(f"[已选择视频: {os.path.basename(file_path)}]")
-            except Exception as e:
-                self.append_system_message(f"[视频加载失败: {str(e)}]")
-                self.clear_video()
+        if file_paths:
+            self.clear_video()
+            self.video_paths = file_paths
+            self.video_path_label.setText(describe_paths(file_paths))
+            size_mb = sum(os.path.getsize(path) for path in file_paths) / (1024 * 1024)
+            self.video_preview.setText(f"{describe_paths(file_paths)}\n{size_mb:.1f} MB")
+            self.start_media_prep("video", file_paths)
+            self.update_turn_media()
     
     def clear_video(self):
         """清除选择的视频"""
-        self.video_path = None
-        self.base64_video = None
+        self.stop_media_prep("video")
+        self.video_paths = []
+        self.video_attachments = None
         self.video_path_label.setText("未选择视频")
         self.video_preview.clear()
         self.video_preview.setText("视频预览")
+        self.update_turn_media()
+    
+    def start_media_prep(self, kind, paths):
+        """启动附件预处理线程（同类型进行中的处理会被取消，另一类型不受影响）"""
+        self.stop_media_prep(kind)
+        thread = MediaPrepThread(kind, paths, self.image_preview.height() - 10)
+        thread.progress.connect(lambda value: self.on_media_progress(thread, value))
+        thread.thumbnail.connect(self.on_media_thumbnail)
+        thread.ready.connect(self.on_media_ready)
+        thread.failed.connect(self.on_media_failed)
+        self.media_prep_threads[kind] = thread
+        self.media_prep_progress[kind] = 0
+        self.media_threads.add(thread)
+        thread.finished.connect(lambda: self.media_threads.discard(thread))
+        self.update_media_status()
+        thread.start()
+    
+    def stop_media_prep(self, kind=None):
+        """取消进行中的预处理（kind不为None时只取消该类型）"""
+        kinds = [kind] if kind is not None else list(self.media_prep_threads)
+        for name in kinds:
+            thread = self.media_prep_threads.pop(name, None)
+            if thread is None:
+                continue
+            self.media_prep_progress.pop(name, None)
+            self.pending_send = False
+            thread.cancel()
+        self.update_media_status()
+    
+    def finish_media_prep(self, kind):
+        """预处理已结束（完成或失败），不再跟踪该线程"""
+        self.media_prep_threads.pop(kind, None)
+        self.media_prep_progress.pop(kind, None)
+        self.update_media_status()
+    
+    def update_media_status(self):
+        """更新附件处理进度；图片和视频同时处理时显示平均进度"""
+        if not self.media_prep_threads:
+            self.media_container.setVisible(False)
+            return
+        names = "和".join("图片" if kind == "image" else "视频" for kind in self.media_prep_threads)
+        self.media_status_label.setText(f"正在处理{names}...")
+        self.media_progress.setValue(sum(self.media_prep_progress.values()) // len(self.media_prep_progress))
+        self.media_container.setVisible(True)
+    
+    def on_media_progress(self, thread, value):
+        """某个预处理线程的进度"""
+        if self.media_prep_threads.get(thread.kind) is thread:
+            self.media_prep_progress[thread.kind] = value
+            self.update_media_status()
+    
+    def cancel_media_prep(self):
+        """取消按钮：取消处理并清除处理中的附件"""
+        if not self.media_prep_threads:
+            return
+        if "image" in self.media_prep_threads:
+            self.clear_image()
+        if "video" in self.media_prep_threads:
+            self.clear_video()
+        self.append_system_message("[已取消附件处理]")
+    
+    def is_media_preparing(self):
+        return bool(self.media_prep_threads)
+    
+    def on_media_thumbnail(self, image):
+        """缩略图已生成"""
+        if self.sender() is self.media_prep_threads.get("image"):
+            self.image_preview.setPixmap(QPixmap.fromImage(image))
+    
+    def on_media_ready(self, result):
+        """附件编码完成"""
+        kind = result["kind"]
+        if self.sender() is not self.media_prep_threads.get(kind):
+            return
+        self.finish_media_prep(kind)
+        attachments = result["attachments"]
+        if kind == "image":
+            self.image_attachments = attachments
+            self.append_system_message(f"[已选择图片: {describe_paths(result['paths'])}]")
+        else:
+            self.video_attachments = attachments
+            self.append_system_message(f"[已选择视频: {describe_paths(result['paths'])}]")
+        downscaled = [os.path.basename(a["path"]) for a in attachments if a["downscaled"]]
+        if downscaled:
+            self.append_system_message(f"[附件总大小超出上限，已自动缩小: {', '.join(downscaled)}]")
+        if self.pending_send and not self.is_media_preparing():
+            self.pending_send = False
+            self.send_message()
+    
+    def on_media_failed(self, error):
+        """附件处理失败"""
+        thread = self.sender()
+        kind = thread.kind
+        if self.media_prep_threads.get(kind) is not thread:
+            return
+        self.finish_media_prep(kind)
+        self.append_system_message(f"[{'图片' if kind == 'image' else '视频'}加载失败: {error}]")
+        if kind == "image":
+            self.clear_image()
+        else:
+            self.clear_video()
+    
+    def stop_playback(self):
+        """停止正在播放的语音回复"""
+        qwen_chat.stop_playback()
     
     def start_recording(self):
         """开始录音"""
         if hasattr(self, 'recording_thread') and self.recording_thread and self.recording_thread.isRunning():
             return
         
+        # 开始录音时停止播放，避免把回放的声音录进去
+        qwen_chat.stop_playback()
+        
         duration = self.duration_spin.value()
         self.recording_progress.setRange(0, duration)
         self.recording_progress.setValue(0)
@@ -1061,13 +1271,14 @@ class QwenChatUI(QMainWindow):
             self.recording_thread.interrupt()
             self.stop_record_button.setEnabled(False)
     
-    def on_recording_finished(self, audio_path, base64_audio):
+    def on_recording_finished(self, audio_path, audio_media):
         """录音完成回调"""
         self.audio_path = audio_path
-        self.base64_audio = base64_audio
+        self.audio_media = audio_media
         self.recording_progress.setValue(100)
         self.record_button.setEnabled(True)
         self.stop_record_button.setEnabled(False)
+        self.update_turn_media()
     
     def update_recording_progress(self, value):
         """更新录音进度条"""
@@ -1078,59 +1289,48 @@ class QwenChatUI(QMainWindow):
         self.recording_status_label.setText(status)
     
     def send_message(self):
-        """发送消息"""
+        """发送消息：文字和已录制的语音、已选的图片、视频一起作为这一轮发送"""
         if hasattr(self, 'chat_thread') and self.chat_thread and self.chat_thread.isRunning():
             return
         
-        use_voice = self.input_mode_combo.currentIndex() == 1
-        use_image = self.input_mode_combo.currentIndex() == 2
-        use_video = self.input_mode_combo.currentIndex() == 3
+        use_voice = self.audio_media is not None
+        has_media = bool(self.image_paths or self.video_paths)
+        text = self.text_input.toPlainText().strip()
         
-        if use_voice:
-            if not self.audio_path or not self.base64_audio:
-                QMessageBox.warning(self, "警告", "请先录制语音")
-                return
-            
+        if text:
+            user_input = text
+        elif use_voice:
             user_input = "我刚才说的是什么？请回答我的问题或请求。"
-            self.append_to_chat(f"你: [语音输入]\n")
-        elif use_image:
-            if not self.image_path or not self.base64_image:
-                QMessageBox.warning(self, "警告", "请先选择图片")
-                return
-            
-            user_input = self.text_input.toPlainText().strip()
-            if not user_input:
-                QMessageBox.warning(self, "警告", "请输入关于图片的问题或描述")
-                return
-            
-            self.append_to_chat(f"你: [已上传图片] {user_input}\n")
-            
-            self.text_input.clear()
-        elif use_video:
-            if not self.video_path or not self.base64_video:
-                QMessageBox.warning(self, "警告", "请先选择视频")
-                return
-            
-            user_input = self.text_input.toPlainText().strip()
-            if not user_input:
-                QMessageBox.warning(self, "警告", "请输入关于视频的问题或描述")
-                return
-            
-            self.append_to_chat(f"你: [已上传视频] {user_input}\n")
-            
-            self.text_input.clear()
+        elif has_media:
+            QMessageBox.warning(self, "警告", "请输入关于图片或视频的问题或描述")
+            return
+        elif self.input_mode_combo.currentData() == "voice":
+            QMessageBox.warning(self, "警告", "请先录制语音")
+            return
         else:
-            user_input = self.text_input.toPlainText().strip()
-            if not user_input:
-                return
-            
-            if user_input.lower() in ['exit', '退出']:
-                self.close()
-                return
-            
-            self.append_to_chat(f"你: {user_input}\n")
-            
-            self.text_input.clear()
+            return
+        
+        if not use_voice and not has_media and user_input.lower() in ['exit', '退出']:
+            self.close()
+            return
+        
+        if (self.image_paths and self.image_attachments is None) or \
+                (self.video_paths and self.video_attachments is None):
+            self.wait_for_media()
+            return
+        
+        attachments = (self.image_attachments or []) + (self.video_attachments or [])
+        labels = []
+        if use_voice:
+            labels.append("[语音输入]")
+        if self.image_attachments:
+            labels.append(f"[已上传{len(self.image_attachments)}张图片]")
+        if self.video_attachments:
+            labels.append(f"[已上传{len(self.video_attachments)}个视频]")
+        if text:
+            labels.append(text)
+        self.append_to_chat(f"你: {' '.join(labels)}\n")
+        self.text_input.clear()
         
         self.set_input_enabled(False)
         
@@ -1140,17 +1340,87 @@ class QwenChatUI(QMainWindow):
         
         self.chat_thread = ChatThread(
             user_input, 
-            self.messages, 
+            self.conversation, 
             use_voice, 
             use_audio, 
             use_streaming_audio, 
-            self.base64_audio,
-            self.base64_image if use_image else None,
-            self.image_type if use_image else None,
-            self.base64_video if use_video else None,
+            self.audio_media,
+            attachments,
             self.selected_model  # 传递选定的模型
         )
         self.chat_thread.start()
+        
+        # 录音和附件属于这一轮（对话树中保留，重新生成时一起发送），下一轮重新选择
+        self.clear_recording()
+        self.clear_image()
+        self.clear_video()
+    
+    def regenerate_reply(self):
+        """重新生成最后一条回复，原回复保留为另一个分支"""
+        if self.chat_thread and self.chat_thread.isRunning():
+            return
+        user_turn = self.conversation.regenerate()
+        if user_turn is None:
+            QMessageBox.warning(self, "警告", "还没有可以重新生成的回复")
+            return
+        self.render_conversation(self.conversation.history(user_turn))
+        self.set_input_enabled(False)
+        
+        output_mode_idx = self.output_mode_combo.currentIndex()
+        self.chat_thread = ChatThread(
+            user_turn.message.text,
+            self.conversation,
+            False,
+            output_mode_idx > 0,
+            output_mode_idx == 2,
+            None,
+            selected_model=self.selected_model,
+            user_turn=user_turn,
+        )
+        self.chat_thread.start()
+    
+    def edit_last_prompt(self):
+        """编辑最后一条用户消息：把原文放回输入框，发送后成为新的分支"""
+        if self.chat_thread and self.chat_thread.isRunning():
+            return
+        user_turn = self.conversation.edit_last()
+        if user_turn is None:
+            QMessageBox.warning(self, "警告", "还没有可以编辑的消息")
+            return
+        self.render_conversation()
+        self.text_input.setPlainText(user_turn.message.text)
+        self.append_system_message("[编辑后发送将生成新的分支，原来的对话可用◀ ▶切换回去]")
+    
+    def switch_branch(self, offset):
+        """在最近的分叉处切换分支"""
+        if self.chat_thread and self.chat_thread.isRunning():
+            return
+        if self.conversation.switch_branch(offset) is None:
+            return
+        self.render_conversation()
+    
+    def render_conversation(self, messages=None):
+        """按对话树的当前分支重新显示聊天记录"""
+        self.chat_history.clear()
+        self.append_to_chat(format_history(self.conversation.history() if messages is None else messages))
+        self.update_branch_label()
+    
+    def update_branch_label(self):
+        turn = self.conversation.branch_point()
+        if turn is None:
+            self.branch_label.setText("")
+            return
+        siblings, index = self.conversation.siblings(turn)
+        self.branch_label.setText(f"分支 {index + 1}/{len(siblings)}")
+    
+    def wait_for_media(self):
+        """附件还在处理中：处理完成后自动发送"""
+        if not self.is_media_preparing():
+            QMessageBox.warning(self, "警告", "附件处理失败，请重新选择")
+            return
+        if not self.pending_send:
+            self.pending_send = True
+            self.append_system_message("[附件处理中，完成后自动发送]")
     
     def model_changed(self, index):
         """处理模型选择变化"""
@@ -1167,19 +1437,21 @@ class QwenChatUI(QMainWindow):
         """设置输入控件的启用状态"""
         self.send_button.setEnabled(enabled)
         self.text_input.setEnabled(enabled)
+        self.regenerate_button.setEnabled(enabled)
+        self.edit_button.setEnabled(enabled)
+        self.prev_branch_button.setEnabled(enabled)
+        self.next_branch_button.setEnabled(enabled)
         self.input_mode_combo.setEnabled(enabled)
         self.output_mode_combo.setEnabled(enabled)
         self.model_combo.setEnabled(enabled)
         
-        if self.input_mode_combo.currentIndex() == 1:
-            self.record_button.setEnabled(enabled)
-            self.duration_spin.setEnabled(enabled)
-        elif self.input_mode_combo.currentIndex() == 2:
-            self.browse_image_button.setEnabled(enabled)
-            self.clear_image_button.setEnabled(enabled)
-        elif self.input_mode_combo.currentIndex() == 3:
-            self.browse_video_button.setEnabled(enabled)
-            self.clear_video_button.setEnabled(enabled)
+        recording = self.recording_thread is not None and self.recording_thread.isRunning()
+        self.record_button.setEnabled(enabled and not recording)
+        self.duration_spin.setEnabled(enabled)
+        self.browse_image_button.setEnabled(enabled)
+        self.clear_image_button.setEnabled(enabled)
+        self.browse_video_button.setEnabled(enabled)
+        self.clear_video_button.setEnabled(enabled)
     
     def append_to_chat(self, text):
         """添加文本到聊天历史"""
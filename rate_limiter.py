@@ -0,0 +1,240 @@
+import time
+import threading
+from collections import OrderedDict, deque
+
+# 默认限流配置（默认关闭）
+DEFAULT_RATE_LIMIT_CONFIG = {
+    "enabled": False,
+    "rpm": 60,                      # 每分钟请求数
+    "tpm": 100000,                  # 每分钟tokens数
+    "max_queue_wait": 30.0,         # 最长排队时间(秒)
+    "chars_per_token": 2.0,         # 文本字符数/token 的估算比例
+    "media_bytes_per_token": 1000,  # 媒体数据(base64)字节数/token 的估算比例
+    "default_completion_tokens": 512,
+    "backoff_initial": 1.0,         # 收到429后的初始退避时间(秒)
+    "backoff_max": 60.0,
+    "decrease_factor": 0.7,         # 收到429后请求速率的缩放系数
+    "increase_step": 0.05,          # 每次成功后速率恢复的步长
+    "min_rate_scale": 0.1,
+}
+
+
+class RateLimitTimeout(Exception):
+    """排队等待超过最大时长"""
+
+
+class TokenBucket:
+    """令牌桶"""
+
+    def __init__(self, capacity, refill_per_sec):
+        self.capacity = float(capacity)
+        self.refill_per_sec = float(refill_per_sec)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.refill_per_sec)
+            self.updated = now
+
+    def time_until(self, amount):
+        """距离桶内令牌足够还需等待的秒数"""
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        if self.refill_per_sec <= 0:
+            return float("inf")
+        return (amount - self.tokens) / self.refill_per_sec
+
+    def take(self, amount):
+        # 允许变为负数，用于按实际用量补扣
+        self.tokens -= amount
+
+    def give(self, amount):
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class _Ticket:
+    """排队中的一次请求"""
+
+    __slots__ = ("session_id", "tokens", "priority", "enqueued_at")
+
+    def __init__(self, session_id, tokens, priority=0):
+        self.session_id = session_id
+        self.tokens = tokens
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+
+
+class RateLimiter:
+    """按RPM/TPM限流的客户端准入控制
+
+    - 请求数和tokens各用一个令牌桶
+    - 不同会话之间轮转放行，避免单个会话占满配额；优先级高（数值小）的请求先放行
+    - 收到429后指数退避，并按AIMD方式降低请求速率
+    """
+
+    def __init__(self, config=None):
+        self.config = dict(DEFAULT_RATE_LIMIT_CONFIG)
+        self.config.update(config or {})
+        self.request_bucket = TokenBucket(self.config["rpm"], self.config["rpm"] / 60.0)
+        self.token_bucket = TokenBucket(self.config["tpm"], self.config["tpm"] / 60.0)
+        self.condition = threading.Condition()
+        self.waiting = OrderedDict()  # session_id -> deque[_Ticket]
+        self.rate_scale = 1.0
+        self.backoff = 0.0
+        self.blocked_until = 0.0
+        self.estimate_ratio = 1.0     # 实际prompt tokens / 估算值 的EWMA
+        self.counters = {
+            "granted": 0,
+            "timeouts": 0,
+            "throttled_429": 0,
+            "wait_total": 0.0,
+            "wait_max": 0.0,
+        }
+
+    @property
+    def enabled(self):
+        return bool(self.config.get("enabled"))
+
+    def estimate_tokens(self, messages):
+        """估算一次请求消耗的tokens（prompt估算值 + 预留的输出tokens）"""
+        text_chars = 0
+        media_bytes = 0
+        for message in messages:
+            content = message.get("content")
+            if isinstance(content, str):
+                text_chars += len(content)
+            elif isinstance(content, list):
+                for part in content:
+                    part_type = part.get("type")
+                    if part_type == "text":
+                        text_chars += len(part.get("text", ""))
+                    elif part_type == "input_audio":
+                        media_bytes += len(part.get("input_audio", {}).get("data", ""))
+                    elif part_type in ("image_url", "video_url"):
+                        media_bytes += len(part.get(part_type, {}).get("url", ""))
+        prompt_tokens = (text_chars / self.config["chars_per_token"]
+                         + media_bytes / self.config["media_bytes_per_token"])
+        prompt_tokens = int(prompt_tokens * self.estimate_ratio) + 1
+        return prompt_tokens, prompt_tokens + self.config["default_completion_tokens"]
+
+    def _refill(self, now):
+        self.request_bucket.refill_per_sec = self.config["rpm"] / 60.0 * self.rate_scale
+        self.request_bucket.refill(now)
+        self.token_bucket.refill(now)
+
+    def _head_ticket(self):
+        """按会话轮转顺序，选出各会话队首中优先级最高的请求"""
+        head = None
+        for tickets in self.waiting.values():
+            if head is None or tickets[0].priority < head.priority:
+                head = tickets[0]
+        return head
+
+    def _remove_ticket(self, ticket):
+        tickets = self.waiting.get(ticket.session_id)
+        if tickets is None:
+            return
+        try:
+            tickets.remove(ticket)
+        except ValueError:
+            pass
+        if not tickets:
+            del self.waiting[ticket.session_id]
+
+    def acquire(self, session_id, tokens, max_wait=None, priority=0):
+        """排队直到配额允许放行，返回实际等待的秒数；超时抛出RateLimitTimeout"""
+        if max_wait is None:
+            max_wait = self.config["max_queue_wait"]
+        ticket = _Ticket(session_id, tokens, priority)
+        deadline = ticket.enqueued_at + max_wait
+
+        with self.condition:
+            self.waiting.setdefault(session_id, deque()).append(ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if self._head_ticket() is ticket:
+                        wait = max(self.blocked_until - now,
+                                   self.request_bucket.time_until(1),
+                                   self.token_bucket.time_until(tokens))
+                        if wait <= 0:
+                            self.request_bucket.take(1)
+                            self.token_bucket.take(min(tokens, self.token_bucket.capacity))
+                            break
+                    else:
+                        # 等待其他会话放行后再检查
+                        wait = 0.05
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        self.counters["timeouts"] += 1
+                        raise RateLimitTimeout(f"排队等待超过{max_wait:.0f}秒")
+                    self.condition.wait(min(wait, remaining, 1.0))
+            finally:
+                # 放行或超时后都要移出队列，并把该会话轮转到队尾
+                was_head = self._head_ticket() is ticket
+                self._remove_ticket(ticket)
+                if was_head and session_id in self.waiting:
+                    self.waiting.move_to_end(session_id)
+                self.condition.notify_all()
+
+            waited = time.monotonic() - ticket.enqueued_at
+            self.counters["granted"] += 1
+            self.counters["wait_total"] += waited
+            self.counters["wait_max"] = max(self.counters["wait_max"], waited)
+            return waited
+
+    def reconcile(self, estimated_prompt_tokens, charged_tokens, usage):
+        """根据接口返回的实际用量修正令牌桶和估算比例"""
+        if usage is None:
+            return
+        actual = (getattr(usage, "prompt_tokens", 0) or 0) + (getattr(usage, "completion_tokens", 0) or 0)
+        actual_prompt = getattr(usage, "prompt_tokens", 0) or 0
+        with self.condition:
+            self.token_bucket.take(actual - charged_tokens)
+            if actual_prompt and estimated_prompt_tokens:
+                ratio = actual_prompt / (estimated_prompt_tokens / self.estimate_ratio)
+                self.estimate_ratio += 0.2 * (ratio - self.estimate_ratio)
+            self.condition.notify_all()
+
+    def record_throttled(self):
+        """收到429响应：指数退避并降低请求速率"""
+        with self.condition:
+            self.counters["throttled_429"] += 1
+            self.backoff = min(self.config["backoff_max"],
+                               self.backoff * 2 if self.backoff else self.config["backoff_initial"])
+            self.blocked_until = time.monotonic() + self.backoff
+            self.rate_scale = max(self.config["min_rate_scale"], self.rate_scale * self.config["decrease_factor"])
+
+    def record_success(self):
+        """请求成功：逐步恢复速率"""
+        with self.condition:
+            self.backoff = 0.0
+            self.rate_scale = min(1.0, self.rate_scale + self.config["increase_step"])
+
+    def metrics(self):
+        """返回队列深度、等待时间等指标"""
+        with self.condition:
+            granted = self.counters["granted"]
+            return {
+                "queue_depth": sum(len(tickets) for tickets in self.waiting.values()),
+                "waiting_sessions": len(self.waiting),
+                "granted": granted,
+                "timeouts": self.counters["timeouts"],
+                "throttled_429": self.counters["throttled_429"],
+                "wait_avg": self.counters["wait_total"] / granted if granted else 0.0,
+                "wait_max": self.counters["wait_max"],
+                "rate_scale": self.rate_scale,
+                "backoff": self.backoff,
+                "estimate_ratio": self.estimate_ratio,
+                "request_tokens": self.request_bucket.tokens,
+                "tpm_tokens": self.token_bucket.tokens,
+            }
+
+
+def is_rate_limit_error(error):
+    """判断异常是否为429限流错误"""
+    return getattr(error, "status_code", None) == 429
@@ -0,0 +1,193 @@
+import time
+import threading
+
+# 优先级类别，数值越小优先级越高
+PRIORITY_CLASSES = {
+    "voice": 0,   # 交互式语音
+    "text": 1,    # 交互式文字
+    "batch": 2,   # 后台批处理
+}
+
+# 默认调度配置
+DEFAULT_SCHEDULER_CONFIG = {
+    "enabled": False,
+    "max_concurrent": 4,          # 同时进行中的请求数上限
+    "reserved_interactive": 1,    # 为交互式请求保留的并发名额，批处理不能占用
+    "max_queue_wait": 300.0,      # 最长排队时间(秒)
+    "session_weights": {},        # 会话权重，同一类别内按权重分配
+    "slo_first_token": {          # 各类别首字延迟目标(秒，含排队时间)
+        "voice": 1.5,
+        "text": 3.0,
+        "batch": 60.0,
+    },
+}
+
+
+class SchedulerTimeout(Exception):
+    """排队等待超过最大时长"""
+
+
+class _Ticket:
+    """排队中的一次请求"""
+
+    __slots__ = ("session_id", "priority_class", "priority", "finish_tag", "enqueued_at", "granted_at")
+
+    def __init__(self, session_id, priority_class, finish_tag):
+        self.session_id = session_id
+        self.priority_class = priority_class
+        self.priority = PRIORITY_CLASSES[priority_class]
+        self.finish_tag = finish_tag
+        self.enqueued_at = time.monotonic()
+        self.granted_at = None
+
+
+class ClassStats:
+    """单个优先级类别的延迟统计"""
+
+    # 保留最近多少个样本用于计算分位数
+    WINDOW = 200
+
+    def __init__(self, slo):
+        self.slo = slo
+        self.requests = 0
+        self.waits = []
+        self.first_tokens = []
+        self.slo_violations = 0
+
+    @staticmethod
+    def _percentile(values, percent):
+        if not values:
+            return None
+        ordered = sorted(values)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+    def add(self, samples, value):
+        samples.append(value)
+        if len(samples) > self.WINDOW:
+            del samples[0]
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "wait_p50": self._percentile(self.waits, 50),
+            "wait_p95": self._percentile(self.waits, 95),
+            "first_token_p50": self._percentile(self.first_tokens, 50),
+            "first_token_p95": self._percentile(self.first_tokens, 95),
+            "slo_first_token": self.slo,
+            "slo_violations": self.slo_violations,
+        }
+
+
+class PriorityScheduler:
+    """请求调度器：交互式语音 > 交互式文字 > 批处理
+
+    - 不同类别之间严格按优先级放行，排队中尚未开始的批处理请求会被后到的交互式请求抢先
+    - 同一类别内按会话权重做加权公平排队（按虚拟完成时间放行）
+    - 批处理不能占用为交互式请求保留的并发名额
+    """
+
+    def __init__(self, config=None):
+        self.config = dict(DEFAULT_SCHEDULER_CONFIG)
+        self.config.update(config or {})
+        self.condition = threading.Condition()
+        self.queue = []
+        self.running = 0
+        self.virtual_time = {name: 0.0 for name in PRIORITY_CLASSES}
+        # (类别, 会话) -> 上次的虚拟完成时间；排队中和进行中的请求数，归零时删除该会话的状态
+        self.session_finish = {}
+        self.session_active = {}
+        slo = self.config["slo_first_token"]
+        self.stats = {name: ClassStats(slo.get(name)) for name in PRIORITY_CLASSES}
+
+    @property
+    def enabled(self):
+        return bool(self.config.get("enabled"))
+
+    def _weight(self, session_id):
+        return float(self.config["session_weights"].get(session_id, 1.0)) or 1.0
+
+    def _next_ticket(self):
+        """按(优先级, 虚拟完成时间)选出下一个应放行的请求"""
+        if not self.queue:
+            return None
+        return min(self.queue, key=lambda ticket: (ticket.priority, ticket.finish_tag, ticket.enqueued_at))
+
+    def _can_start(self, ticket):
+        free = self.config["max_concurrent"] - self.running
+        if ticket.priority_class == "batch":
+            return free > self.config["reserved_interactive"]
+        return free > 0
+
+    def acquire(self, session_id, priority_class="text"):
+        """排队直到获得并发名额，返回票据（结束后需调用release）"""
+        if priority_class not in PRIORITY_CLASSES:
+            raise ValueError(f"未知的优先级类别: {priority_class}")
+        with self.condition:
+            # 加权公平排队：虚拟完成时间 = max(类别虚拟时间, 该会话上次完成时间) + 1/权重
+            key = (priority_class, session_id)
+            start_tag = max(self.virtual_time[priority_class], self.session_finish.get(key, 0.0))
+            ticket = _Ticket(session_id, priority_class, start_tag + 1.0 / self._weight(session_id))
+            self.session_finish[key] = ticket.finish_tag
+            self.session_active[key] = self.session_active.get(key, 0) + 1
+            self.queue.append(ticket)
+
+            deadline = ticket.enqueued_at + self.config["max_queue_wait"]
+            granted = False
+            try:
+                while not (self._next_ticket() is ticket and self._can_start(ticket)):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise SchedulerTimeout(f"调度排队超过{self.config['max_queue_wait']:.0f}秒")
+                    self.condition.wait(remaining)
+                granted = True
+            finally:
+                self.queue.remove(ticket)
+                if not granted:
+                    self._session_done(ticket)
+                self.condition.notify_all()
+
+            self.running += 1
+            self.virtual_time[priority_class] = max(self.virtual_time[priority_class], start_tag)
+            ticket.granted_at = time.monotonic()
+            stats = self.stats[priority_class]
+            stats.requests += 1
+            stats.add(stats.waits, ticket.granted_at - ticket.enqueued_at)
+            return ticket
+
+    def record_first_token(self, ticket, latency):
+        """记录首字延迟，latency为从获得名额到首字的时间，统计时加上调度排队时间"""
+        with self.condition:
+            stats = self.stats[ticket.priority_class]
+            total = (ticket.granted_at - ticket.enqueued_at) + latency
+            stats.add(stats.first_tokens, total)
+            if stats.slo is not None and total > stats.slo:
+                stats.slo_violations += 1
+
+    def release(self, ticket):
+        """请求结束，归还并发名额"""
+        with self.condition:
+            self.running -= 1
+            self._session_done(ticket)
+            self.condition.notify_all()
+
+    def _session_done(self, ticket):
+        """会话的一个请求结束（或放弃排队）；没有排队中和进行中的请求时删除它的状态，
+        会话表的大小只与活跃会话数有关"""
+        key = (ticket.priority_class, ticket.session_id)
+        remaining = self.session_active.get(key, 0) - 1
+        if remaining > 0:
+            self.session_active[key] = remaining
+        else:
+            self.session_active.pop(key, None)
+            self.session_finish.pop(key, None)
+
+    def metrics(self):
+        """返回各类别的排队和首字延迟指标"""
+        with self.condition:
+            return {
+                "running": self.running,
+                "sessions": len(self.session_active),
+                "queued": {name: sum(1 for t in self.queue if t.priority_class == name)
+                           for name in PRIORITY_CLASSES},
+                "classes": {name: stats.as_dict() for name, stats in self.stats.items()},
+            }
@@ -0,0 +1,177 @@
+import json
+import hashlib
+import threading
+
+from streaming_body import CancelToken, json_default
+
+# 默认配置（默认关闭）
+DEFAULT_SINGLE_FLIGHT_CONFIG = {
+    "enabled": False,
+}
+
+
+def canonical_request_key(completion_args):
+    """把请求参数规范化后计算摘要，参数相同（与字典键顺序无关）的请求得到相同的键"""
+    # 以文件为数据源的附件按文件标识参与计算，不读取文件内容
+    canonical = json.dumps(completion_args, sort_keys=True, ensure_ascii=False, separators=(",", ":"),
+                           default=json_default)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class _Flight:
+    """一次进行中的上游请求，缓存已收到的全部数据块供后加入的订阅者回放
+
+    最后一个订阅者离开时通过cancel取消上游请求，释放密钥、限流配额和调度名额。
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.cancel = CancelToken()
+        self.condition = threading.Condition()
+
+
+class _Subscription:
+    """一个订阅者的数据流：按自己的进度读取缓存的数据块，close()时离开请求
+
+    不使用生成器实现：尚未开始读取的生成器在close()时不会执行清理代码，订阅者计数无法减少。
+    """
+
+    def __init__(self, owner, key, flight, cancel=None):
+        self.owner = owner
+        self.key = key
+        self.flight = flight
+        self.cancel = cancel
+        self.index = 0
+        self.closed = False
+        # 订阅者被取消时唤醒正在等待数据的读取
+        self.unregister = cancel.register(self._wake) if cancel is not None else None
+
+    def _wake(self):
+        with self.flight.condition:
+            self.flight.condition.notify_all()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.closed:
+            raise StopIteration
+        flight = self.flight
+        try:
+            with flight.condition:
+                while (self.index >= len(flight.chunks) and not flight.done
+                       and not (self.cancel is not None and self.cancel.cancelled)):
+                    flight.condition.wait()
+                if self.index < len(flight.chunks) and not (self.cancel is not None and self.cancel.cancelled):
+                    chunk = flight.chunks[self.index]
+                    self.index += 1
+                    return chunk
+                error = flight.error if self.index >= len(flight.chunks) else None
+        except BaseException:
+            self.close()
+            raise
+        self.close()
+        if error is not None and not (self.cancel is not None and self.cancel.cancelled):
+            raise error
+        raise StopIteration
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.unregister is not None:
+            self.unregister()
+        self.owner._leave(self.key, self.flight)
+
+    def __del__(self):
+        self.close()
+
+
+class SingleFlight:
+    """合并相同的进行中请求：相同请求只发起一次上游调用，结果分发给所有订阅者
+
+    上游数据由后台线程拉取并缓存，每个订阅者按自己的进度读取，
+    中途加入的订阅者会先回放已经收到的文字和音频数据块。
+    """
+
+    def __init__(self, config=None):
+        self.config = dict(DEFAULT_SINGLE_FLIGHT_CONFIG)
+        self.config.update(config or {})
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.upstream_calls = 0
+        self.coalesced = 0
+
+    @property
+    def enabled(self):
+        return bool(self.config.get("enabled"))
+
+    def stream(self, key, start_upstream, cancel=None):
+        """订阅键为key的请求；没有进行中的相同请求时调用start_upstream(upstream_cancel)发起上游请求
+
+        cancel为CancelToken时，取消后该订阅者的数据流立即结束；
+        所有订阅者都离开后，upstream_cancel被取消，上游请求随之结束。
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is None:
+                flight = self.flights[key] = _Flight()
+                self.upstream_calls += 1
+                threading.Thread(target=self._pump, args=(key, flight, start_upstream),
+                                 name="single-flight", daemon=True).start()
+            else:
+                self.coalesced += 1
+            flight.subscribers += 1
+        return _Subscription(self, key, flight, cancel)
+
+    def _pump(self, key, flight, start_upstream):
+        """后台线程：读取上游数据并通知所有订阅者"""
+        upstream = None
+        try:
+            upstream = start_upstream(flight.cancel)
+            for chunk in upstream:
+                if flight.cancel.cancelled:
+                    break
+                with flight.condition:
+                    flight.chunks.append(chunk)
+                    flight.condition.notify_all()
+        except Exception as e:
+            # 取消后上游的错误（如连接被断开）没有订阅者关心
+            if not flight.cancel.cancelled:
+                flight.error = e
+        finally:
+            # 关闭上游数据流，执行其清理代码（归还密钥、调度名额）
+            close = getattr(upstream, "close", None)
+            if close is not None:
+                close()
+            # 先移出登记表，之后到达的相同请求会重新发起上游调用
+            with self.lock:
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+            with flight.condition:
+                flight.done = True
+                flight.condition.notify_all()
+
+    def _leave(self, key, flight):
+        """订阅者离开；最后一个订阅者离开且请求未完成时取消上游请求"""
+        with self.lock:
+            with flight.condition:
+                flight.subscribers -= 1
+                abandoned = flight.subscribers == 0 and not flight.done
+            if abandoned and self.flights.get(key) is flight:
+                # 立即移出登记表，之后到达的相同请求不再加入将被取消的请求
+                del self.flights[key]
+        if abandoned:
+            flight.cancel.cancel()
+
+    def metrics(self):
+        """返回上游调用次数和被合并的请求数"""
+        with self.lock:
+            return {
+                "in_flight": len(self.flights),
+                "upstream_calls": self.upstream_calls,
+                "coalesced": self.coalesced,
+            }
@@ -0,0 +1,401 @@
+import json
+import time
+import socket
+import threading
+import http.client
+from types import SimpleNamespace
+from urllib.parse import urlsplit
+
+# 默认配置
+DEFAULT_STREAMING_BODY_CONFIG = {
+    # 上传时每次从文件读取并编码的字节数（3的倍数）
+    "chunk_bytes": 3 * 64 * 1024,
+    # 连接和读取超时(秒)
+    "timeout": 600,
+    # 预先建立的连接超过该时间(秒)未使用则不再使用（服务器可能已关闭空闲连接）
+    "warm_max_age": 20,
+}
+
+# 预先建立的连接：(scheme, host, port) -> (连接, 建立时间)
+_warm_connections = {}
+_warm_lock = threading.Lock()
+
+# 与请求体逐字节一致的标准序列化参数
+JSON_OPTIONS = {"ensure_ascii": False, "separators": (",", ":")}
+
+
+class LazyPayload:
+    """延迟生成的JSON字符串值：长度可以预先计算，内容在序列化时分块生成
+
+    子类实现__len__、iter_chunks()和identity()。
+    """
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def iter_chunks(self, chunk_bytes=DEFAULT_STREAMING_BODY_CONFIG["chunk_bytes"]):
+        """逐块返回UTF-8编码、无需JSON转义的内容"""
+        raise NotImplementedError
+
+    def identity(self):
+        """用于请求去重的标识（不生成内容）"""
+        raise NotImplementedError
+
+    @property
+    def file_backed(self):
+        """内容是否来自磁盘文件（保留引用不占用内存）"""
+        return False
+
+    def __str__(self):
+        # 需要完整字符串时（如经由OpenAI SDK发送）才一次性生成
+        return b"".join(self.iter_chunks()).decode("utf-8")
+
+
+class LazyDataURI(LazyPayload):
+    """内容延迟生成的data URI，如"data:video/mp4;base64," + 媒体的base64编码"""
+
+    def __init__(self, prefix, payload):
+        self.prefix = prefix
+        self.payload = payload
+
+    def __len__(self):
+        return len(self.prefix) + len(self.payload)
+
+    def iter_chunks(self, chunk_bytes=DEFAULT_STREAMING_BODY_CONFIG["chunk_bytes"]):
+        # 前缀中可能有需要转义的字符，按JSON字符串的规则编码
+        yield json.dumps(self.prefix, **JSON_OPTIONS)[1:-1].encode("utf-8")
+        yield from self.payload.iter_chunks(chunk_bytes)
+
+    def identity(self):
+        return self.prefix + self.payload.identity()
+
+    @property
+    def file_backed(self):
+        return self.payload.file_backed
+
+    def __str__(self):
+        return self.prefix + str(self.payload)
+
+
+class JsonFragment:
+    """自行序列化的JSON值（如message_model.Message），可以缓存自己的序列化结果
+
+    子类实现iter_json()（输出与标准序列化逐字节一致）、to_wire()（转换为普通的JSON结构）
+    和is_lazy（是否包含延迟生成的内容）。
+    """
+
+    # 子类用__slots__减小每条消息的内存，基类也不能带__dict__
+    __slots__ = ()
+
+    @property
+    def is_lazy(self):
+        return False
+
+    def iter_json(self, chunk_bytes, encoder):
+        raise NotImplementedError
+
+    def to_wire(self):
+        raise NotImplementedError
+
+
+def data_uri(prefix, payload):
+    """构建data URI：payload为字符串时直接拼接，为LazyPayload时返回LazyDataURI"""
+    if isinstance(payload, LazyPayload):
+        return LazyDataURI(prefix, payload)
+    return f"{prefix}{payload}"
+
+
+def uses_streaming_body(value):
+    """请求参数中是否包含延迟生成的内容（媒体句柄、录音），需要由本模块边编码边上传
+
+    只有缓存了JSON片段的消息对象不需要：materialize()后照常经由OpenAI SDK发送。
+    """
+    if isinstance(value, LazyPayload):
+        return True
+    if isinstance(value, JsonFragment):
+        return value.is_lazy
+    if isinstance(value, dict):
+        return any(uses_streaming_body(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return any(uses_streaming_body(item) for item in value)
+    return False
+
+
+def materialize(value):
+    """把延迟生成的内容全部替换为字符串，得到普通的JSON结构"""
+    if isinstance(value, LazyPayload):
+        return str(value)
+    if isinstance(value, JsonFragment):
+        return materialize(value.to_wire())
+    if isinstance(value, dict):
+        return {key: materialize(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [materialize(item) for item in value]
+    return value
+
+
+def json_default(value):
+    """json.dumps的default参数：延迟生成的内容按标识序列化（用于计算请求摘要）"""
+    if isinstance(value, LazyPayload):
+        return value.identity()
+    if isinstance(value, JsonFragment):
+        return value.to_wire()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def iter_json(value, chunk_bytes=DEFAULT_STREAMING_BODY_CONFIG["chunk_bytes"], encoder=None):
+    """逐段生成UTF-8编码的JSON，与json.dumps(materialize(value), **JSON_OPTIONS)逐字节一致
+
+    延迟生成的内容（如媒体文件的base64编码）在生成到该位置时才分块读取和编码，
+    内存占用与文件大小无关。
+    """
+    encoder = encoder or json.JSONEncoder(**JSON_OPTIONS)
+    if isinstance(value, LazyPayload):
+        yield b'"'
+        yield from value.iter_chunks(chunk_bytes)
+        yield b'"'
+    elif isinstance(value, JsonFragment):
+        yield from value.iter_json(chunk_bytes, encoder)
+    elif isinstance(value, dict):
+        yield b"{"
+        for index, (key, item) in enumerate(value.items()):
+            if isinstance(key, str):
+                key_json = encoder.encode(key)
+            else:
+                # 与json模块一致：数字、布尔值和None作为键时转为字符串
+                key_json = encoder.encode({key: 0})[1:-3]
+            yield (b"," if index else b"") + key_json.encode("utf-8") + b":"
+            yield from iter_json(item, chunk_bytes, encoder)
+        yield b"}"
+    elif isinstance(value, (list, tuple)):
+        yield b"["
+        for index, item in enumerate(value):
+            if index:
+                yield b","
+            yield from iter_json(item, chunk_bytes, encoder)
+        yield b"]"
+    else:
+        yield encoder.encode(value).encode("utf-8")
+
+
+def coalesce(chunks, min_bytes):
+    """把小片段合并到至少min_bytes再输出，减少分块传输时的块数和系统调用"""
+    buffer = []
+    size = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= min_bytes:
+            yield b"".join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield b"".join(buffer)
+
+
+class StreamingHTTPError(Exception):
+    """接口返回错误状态码"""
+
+    def __init__(self, status_code, message):
+        super().__init__(f"HTTP {status_code}: {message}")
+        self.status_code = status_code
+
+
+class StreamingConnectionError(Exception):
+    """连接失败或超时"""
+
+
+class CancelToken:
+    """可以从其他线程取消的请求
+
+    cancel()时依次调用已登记的回调（如断开连接，使阻塞在发送或读取上的线程立即返回）。
+    请求被取消后数据流直接结束，不抛出异常。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.callbacks = []
+        self.cancelled = False
+
+    def cancel(self):
+        with self.lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                # 断开连接时的错误可以忽略，读取数据的线程会自行清理
+                pass
+
+    def register(self, callback):
+        """登记取消时调用的回调（已取消时立即调用），返回注销函数"""
+        with self.lock:
+            if not self.cancelled:
+                self.callbacks.append(callback)
+                return lambda: self._unregister(callback)
+        callback()
+        return lambda: None
+
+    def _unregister(self, callback):
+        with self.lock:
+            if callback in self.callbacks:
+                self.callbacks.remove(callback)
+
+
+class StreamChunk(SimpleNamespace):
+    """流式响应的数据块，字段访问方式与OpenAI SDK的对象一致，缺少的字段为None"""
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return None
+
+
+def to_chunk(value):
+    """把解析出的JSON转换为StreamChunk；audio字段保持为字典（与SDK一致）"""
+    if isinstance(value, dict):
+        return StreamChunk(**{key: item if key == "audio" else to_chunk(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return [to_chunk(item) for item in value]
+    return value
+
+
+def iter_sse(response):
+    """解析SSE响应，逐个返回data字段的JSON，遇到[DONE]结束"""
+    data_lines = []
+    for raw_line in response:
+        line = raw_line.decode("utf-8").rstrip("\r\n")
+        if line.startswith("data:"):
+            data_lines.append(line[5:].lstrip(" "))
+            continue
+        if line or not data_lines:
+            continue
+        data = "\n".join(data_lines)
+        data_lines = []
+        if data == "[DONE]":
+            return
+        yield json.loads(data)
+    if data_lines and data_lines != ["[DONE]"]:
+        yield json.loads("\n".join(data_lines))
+
+
+def _connection_key(base_url):
+    parts = urlsplit(str(base_url))
+    return parts.scheme, parts.hostname, parts.port
+
+
+def _open(base_url, timeout):
+    parts = urlsplit(str(base_url))
+    connection_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+    return connection_class(parts.hostname, parts.port, timeout=timeout), parts.path.rstrip("/")
+
+
+def prewarm(base_url, config=None):
+    """预先建立到接口地址的连接（TCP和TLS握手），下一次请求直接使用；失败时返回False
+
+    每个地址只保留一个预先建立的连接，再次调用时替换旧的连接。
+    """
+    config = dict(DEFAULT_STREAMING_BODY_CONFIG, **(config or {}))
+    connection, _ = _open(base_url, config["timeout"])
+    try:
+        connection.connect()
+    except (OSError, http.client.HTTPException):
+        connection.close()
+        return False
+    with _warm_lock:
+        old = _warm_connections.get(_connection_key(base_url))
+        _warm_connections[_connection_key(base_url)] = (connection, time.monotonic())
+    if old is not None:
+        old[0].close()
+    return True
+
+
+def _connect(base_url, timeout, max_age):
+    """返回(连接, 路径前缀, 是否为预先建立的连接)"""
+    with _warm_lock:
+        warm = _warm_connections.pop(_connection_key(base_url), None)
+    if warm is not None:
+        connection, opened_at = warm
+        if time.monotonic() - opened_at <= max_age:
+            connection.timeout = timeout
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+            return connection, urlsplit(str(base_url)).path.rstrip("/"), True
+        connection.close()
+    connection, path = _open(base_url, timeout)
+    return connection, path, False
+
+
+def _abort(sock):
+    """从其他线程断开连接：阻塞在发送或读取上的线程立即返回（连接由该线程关闭）"""
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+def create_chat_completion(base_url, api_key, completion_args, config=None, cancel=None):
+    """以分块传输编码发送请求体，边编码边上传，返回流式响应数据块的迭代器
+
+    请求在调用时即发出（与SDK的create()一样，连接错误和错误状态码在这里抛出）。
+    cancel为CancelToken时，取消后立即断开连接，数据流直接结束。
+    """
+    config = dict(DEFAULT_STREAMING_BODY_CONFIG, **(config or {}))
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json",
+        "Accept": "text/event-stream",
+    }
+    while True:
+        if cancel is not None and cancel.cancelled:
+            return iter(())
+        connection, path, warm = _connect(base_url, config["timeout"], config["warm_max_age"])
+        unregister = None
+        try:
+            # 先建立连接，取消时才有可以断开的套接字
+            if connection.sock is None:
+                connection.connect()
+            if cancel is not None:
+                # 记下套接字：响应声明关闭连接时，connection.sock会被置空而由响应继续使用
+                sock = connection.sock
+                unregister = cancel.register(lambda: _abort(sock))
+            connection.request("POST", f"{path}/chat/completions",
+                               body=coalesce(iter_json(completion_args, config["chunk_bytes"]), config["chunk_bytes"]),
+                               headers=headers, encode_chunked=True)
+            response = connection.getresponse()
+            break
+        except (OSError, http.client.HTTPException) as e:
+            if unregister is not None:
+                unregister()
+            connection.close()
+            if cancel is not None and cancel.cancelled:
+                return iter(())
+            if warm:
+                # 预先建立的连接可能已被服务器关闭，换新连接重试一次
+                continue
+            raise StreamingConnectionError(f"连接 {base_url} 失败: {e}") from e
+    if response.status >= 400:
+        message = response.read().decode("utf-8", "replace")
+        if unregister is not None:
+            unregister()
+        connection.close()
+        raise StreamingHTTPError(response.status, message)
+    return _iter_response(connection, response, cancel, unregister)
+
+
+def _iter_response(connection, response, cancel=None, unregister=None):
+    try:
+        for event in iter_sse(response):
+            yield to_chunk(event)
+    except (OSError, http.client.HTTPException) as e:
+        # 取消时连接被断开，不算错误
+        if cancel is not None and cancel.cancelled:
+            return
+        raise StreamingConnectionError(f"读取响应失败: {e}") from e
+    finally:
+        if unregister is not None:
+            unregister()
+        connection.close()
@@ -0,0 +1,33 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+# 测试直接导入仓库根目录下的模块；密钥池使用环境变量中的模拟密钥，不请求输入
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DASHSCOPE_API_KEY", "mock")
+
+from duplex_voice import MockCompletionServer
+
+
+@pytest.fixture
+def mock_server():
+    """本地模拟的流式补全接口（见duplex_voice.MockCompletionServer）"""
+    server = MockCompletionServer(first_byte_delay=0.05, reply_seconds=0.2, generate_speed=20.0).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def endpoints(monkeypatch):
+    """把qwen_chat的接口地址池替换为指定的地址列表：endpoints([url, ...])"""
+    import qwen_chat
+    from endpoint_pool import EndpointPool
+
+    def install(urls, config=None):
+        pool = EndpointPool(urls, config)
+        monkeypatch.setattr(qwen_chat, "endpoint_pool", pool)
+        return pool
+
+    return install
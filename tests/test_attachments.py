@@ -0,0 +1,82 @@
+import os
+
+import pytest
+
+import attachments
+from attachments import prepare_attachments, plan_targets, AttachmentError
+
+
+@pytest.fixture
+def media_files(tmp_path):
+    files = {}
+    for name, size in (("photo.png", 300 * 1024), ("clip.mp4", 2 * 1024 * 1024), ("voice.wav", 100 * 1024)):
+        path = tmp_path / name
+        path.write_bytes(os.urandom(size))
+        files[name] = path
+    return files
+
+
+def test_no_budget_by_default_sends_files_unchanged(media_files, monkeypatch):
+    monkeypatch.setattr(attachments, "can_downscale", lambda kind: pytest.fail("不应尝试缩小"))
+    prepared = prepare_attachments(media_files.values())
+
+    assert [item["kind"] for item in prepared] == ["image", "video", "audio"]
+    for item, path in zip(prepared, media_files.values()):
+        assert not item["downscaled"]
+        assert item["media"].path == str(path) and item["media"].data is None
+    assert plan_targets([str(path) for path in media_files.values()], None) == [None, None, None]
+
+
+def test_budget_that_cannot_be_met_does_not_reject_files(media_files, monkeypatch, capsys):
+    # 没有Pillow和ffmpeg：无法缩小，附件按原样发送，只打印提示
+    monkeypatch.setattr(attachments, "can_downscale", lambda kind: False)
+    prepared = prepare_attachments(media_files.values(), {"max_total_bytes": 1024})
+
+    assert len(prepared) == 3 and not any(item["downscaled"] for item in prepared)
+    assert "按原样发送" in capsys.readouterr().err
+
+
+def test_budget_is_shared_among_downscalable_files(media_files, monkeypatch):
+    monkeypatch.setattr(attachments, "can_downscale", lambda kind: kind in ("image", "video"))
+    paths = [str(path) for path in media_files.values()]
+    audio = os.path.getsize(media_files["voice.wav"])
+    budget = attachments.encoded_size(audio) + 1024 * 1024
+
+    image, video, fixed = plan_targets(paths, budget)
+    # 音频不能缩小，按原样计入；剩余额度按大小比例分给图片和视频
+    assert fixed is None
+    assert video == pytest.approx(image * 2048 / 300, rel=0.01)
+    assert attachments.encoded_size(image + video) <= 1024 * 1024 + 4
+    # 音频已经占满额度时不缩小其他附件，也不报错
+    assert plan_targets(paths, attachments.encoded_size(audio)) == [None, None, None]
+
+
+def test_downscale_that_does_not_shrink_keeps_the_original(media_files, monkeypatch):
+    path = media_files["photo.png"]
+    monkeypatch.setattr(attachments, "downscale_image", lambda *args: os.urandom(os.path.getsize(path) + 10))
+    item = attachments.prepare_attachment(path, 1024)
+    assert not item["downscaled"] and item["media"].path == str(path)
+
+
+def test_unsupported_or_missing_files_are_errors(tmp_path):
+    with pytest.raises(AttachmentError):
+        prepare_attachments([tmp_path / "notes.txt"])
+    with pytest.raises(AttachmentError):
+        prepare_attachments([tmp_path / "missing.png"])
+
+
+def test_cli_attachment_is_a_file_backed_handle(media_files, tmp_path, capsys):
+    import media_handles
+    import qwen_chat
+    from message_model import TYPE_VIDEO
+
+    before = media_handles.accounting.materialized
+    loaded = qwen_chat.load_attachment(str(media_files["clip.mp4"]))
+    message = qwen_chat.build_user_message("概述这个视频", attachments=loaded)
+
+    # 只引用文件，不生成完整的base64字符串
+    assert loaded[0]["media"].data is None
+    assert message.parts[0].type == TYPE_VIDEO and not isinstance(message.parts[0].value, str)
+    assert media_handles.accounting.materialized == before
+    assert qwen_chat.load_attachment(str(tmp_path / "missing.png")) is None
+    assert "missing.png" in capsys.readouterr().out
@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+
+from audio_dsp import PolyphaseResampler, SilenceTrimmer, LoudnessNormalizer, OutputDsp, dbfs_to_amplitude
+
+
+def noise(count, seed=0):
+    return (np.random.default_rng(seed).uniform(-0.5, 0.5, count)).astype(np.float32)
+
+
+def run_in_chunks(processor, samples, sizes):
+    outputs = []
+    start = 0
+    index = 0
+    while start < len(samples):
+        size = sizes[index % len(sizes)]
+        outputs.append(processor.process(samples[start:start + size]))
+        start += size
+        index += 1
+    return np.concatenate(outputs)
+
+
+@pytest.mark.parametrize("out_rate", [16000, 44100, 48000])
+def test_resampler_output_does_not_depend_on_chunking(out_rate):
+    samples = noise(24000)
+    whole = PolyphaseResampler(24000, out_rate).process(samples)
+
+    for sizes in ([1], [7, 480, 13], [2400], [24000]):
+        chunked = run_in_chunks(PolyphaseResampler(24000, out_rate), samples, sizes)
+        assert len(chunked) == len(whole)
+        np.testing.assert_allclose(chunked, whole, atol=1e-6)
+    assert abs(len(whole) - 24000 * out_rate // 24000) <= 1
+
+
+def test_resampler_keeps_the_tone_frequency():
+    rate = 24000
+    tone = np.sin(2 * np.pi * 1000 * np.arange(rate) / rate).astype(np.float32) * 0.5
+    out = PolyphaseResampler(rate, 48000).process(tone)
+    spectrum = np.abs(np.fft.rfft(out[1000:]))
+    peak = np.argmax(spectrum) * 48000 / len(out[1000:])
+    assert abs(peak - 1000) < 5
+
+
+def test_silence_trimmer_keeps_padding_before_onset():
+    rate = 24000
+    trimmer = SilenceTrimmer(rate, padding_ms=20)
+    silence = np.zeros(rate // 10, dtype=np.float32)
+    voice = np.full(100, 0.5, dtype=np.float32)
+
+    assert len(trimmer.process(silence)) == 0
+    out = trimmer.process(np.concatenate((np.zeros(5, dtype=np.float32), voice)))
+    # 起音前保留20毫秒的余量，其中一部分来自上一块的静音
+    assert len(out) == rate * 20 // 1000 + len(voice)
+    assert not trimmer.active
+    assert len(trimmer.process(silence)) == len(silence)
+
+
+def test_silence_trimmer_gives_up_after_max_trim():
+    trimmer = SilenceTrimmer(1000, max_trim_seconds=0.5, padding_ms=0)
+    out = run_in_chunks(trimmer, np.zeros(1000, dtype=np.float32), [100])
+    assert len(out) == 500
+
+
+def test_normalizer_boosts_quiet_speech_up_to_max_gain():
+    rate = 24000
+    normalizer = LoudnessNormalizer(rate, target_dbfs=-20.0, max_gain_db=12.0)
+    quiet = np.full(rate, dbfs_to_amplitude(-26.0), dtype=np.float32)
+    out = run_in_chunks(normalizer, quiet, [2400])
+    assert np.sqrt(np.mean(out[-2400:] ** 2)) == pytest.approx(dbfs_to_amplitude(-20.0), rel=0.01)
+
+    very_quiet = np.full(rate, dbfs_to_amplitude(-45.0), dtype=np.float32)
+    out = run_in_chunks(LoudnessNormalizer(rate, max_gain_db=12.0), very_quiet, [2400])
+    assert out[-1] == pytest.approx(very_quiet[-1] * dbfs_to_amplitude(12.0), rel=0.01)
+
+
+def test_output_dsp_converts_pcm_bytes():
+    pcm = (noise(2400) * 32767).astype(np.int16).tobytes()
+    dsp = OutputDsp(24000, 48000, {"trim_silence": False, "normalize": False})
+    out = dsp.process(pcm)
+    assert dsp.out_rate == 48000
+    assert len(out) == 2 * 4800
+
+    passthrough = OutputDsp(24000, None, {"trim_silence": False, "normalize": False})
+    assert passthrough.resampler is None
+    assert passthrough.process(pcm) == pcm
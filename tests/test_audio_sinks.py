@@ -0,0 +1,116 @@
+import wave
+import base64
+import threading
+
+from audio_sinks import AudioTee, AudioSink, BufferSink, WavFileSink, decode_pcm
+
+
+class GatedSink(BufferSink):
+    """gate打开前写入一直等待，模拟跟不上的输出"""
+
+    def __init__(self, name="gated", lossless=True, queue_size=2):
+        super().__init__()
+        self.name = name
+        self.lossless = lossless
+        self.queue_size = queue_size
+        self.gate = threading.Event()
+
+    def write(self, pcm):
+        self.gate.wait(5.0)
+        super().write(pcm)
+
+
+class FailingSink(AudioSink):
+    name = "failing"
+
+    def write(self, pcm):
+        raise OSError("disk full")
+
+
+def pcm_chunks(count, size=480):
+    return [bytes([index % 256]) * size for index in range(count)]
+
+
+def test_every_sink_receives_all_audio_and_text(tmp_path):
+    first, second = BufferSink(), BufferSink()
+    path = tmp_path / "reply.wav"
+    chunks = pcm_chunks(20)
+
+    with AudioTee([first, second, WavFileSink(path)]) as tee:
+        for index, chunk in enumerate(chunks):
+            tee.write(chunk)
+            tee.write_text(str(index))
+
+    for sink in (first, second):
+        assert sink.getvalue() == b"".join(chunks)
+        assert sink.gettext() == "".join(str(index) for index in range(20))
+    with wave.open(str(path), "rb") as file:
+        assert file.getframerate() == 24000
+        assert file.readframes(file.getnframes()) == b"".join(chunks)
+    assert tee.stats()["bytes"] == sum(len(chunk) for chunk in chunks)
+
+
+def test_lossy_sink_drops_chunks_without_holding_back_others():
+    slow = GatedSink("slow", lossless=False)
+    fast = BufferSink()
+    chunks = pcm_chunks(50)
+
+    tee = AudioTee([slow, fast])
+    for chunk in chunks:
+        tee.write(chunk)
+    slow.gate.set()
+    tee.close()
+
+    assert fast.getvalue() == b"".join(chunks)
+    dropped = tee.stats()["dropped"]
+    assert dropped["slow"] > 0 and dropped["buffer"] == 0
+    assert len(slow.getvalue()) == (len(chunks) - dropped["slow"]) * 480
+
+
+def test_failing_sink_does_not_stop_other_sinks():
+    fast = BufferSink()
+    with AudioTee([FailingSink(), fast]) as tee:
+        tee.write(b"\x01\x00" * 100)
+        tee.write(b"\x02\x00" * 100)
+    assert fast.getvalue() == b"\x01\x00" * 100 + b"\x02\x00" * 100
+    assert isinstance(tee.outputs[0].error, OSError)
+
+
+def test_base64_chunks_are_decoded_once_for_all_sinks():
+    first, second = BufferSink(), BufferSink()
+    pcm = bytes(range(256)) * 4
+    with AudioTee([first, second]) as tee:
+        tee.write_base64(base64.b64encode(pcm).decode("ascii"))
+        tee.write(b"")
+    assert first.getvalue() == second.getvalue() == pcm
+
+
+def test_decode_pcm_matches_b64decode():
+    pcm = bytes(range(256)) * 9 + b"\x01"
+    encoded = base64.b64encode(pcm).decode("ascii")
+    decoded = decode_pcm(encoded)
+    assert isinstance(decoded, bytes)
+    assert decoded == base64.b64decode(encoded) == pcm
+
+
+def test_slow_lossless_sink_spills_in_order_without_blocking_the_writer():
+    slow = GatedSink("slow", lossless=True, queue_size=2)
+    fast = BufferSink()
+    chunks = pcm_chunks(200)
+
+    tee = AudioTee([slow, fast])
+    for index, chunk in enumerate(chunks):
+        tee.write(chunk)
+        tee.write_text(f"{index},")
+    # 慢的输出在等待，写入方没有被阻塞；多出的数据暂存到临时文件
+    assert not slow.gate.is_set()
+    assert tee.outputs[0].spilled > 0
+    slow.gate.set()
+    tee.close()
+
+    # 不丢数据，也不改变音频和文字的顺序
+    for sink in (slow, fast):
+        assert sink.getvalue() == b"".join(chunks)
+        assert sink.gettext() == "".join(f"{index}," for index in range(200))
+    assert tee.stats()["dropped"] == {"slow": 0, "buffer": 0}
+    assert tee.outputs[0].spill_file.closed
@@ -0,0 +1,17 @@
+from batch_runner import safe_filename
+
+
+def test_plain_ids_are_kept():
+    assert safe_filename("turn-001_a") == "turn-001_a"
+
+
+def test_path_components_are_removed():
+    for turn_id in ("../../etc/passwd", "a/b", "a\\b", "..", "C:evil"):
+        name = safe_filename(turn_id)
+        assert "/" not in name and "\\" not in name and ".." not in name and ":" not in name
+
+
+def test_different_ids_do_not_collide():
+    assert safe_filename("a/b") != safe_filename("a_b")
+    assert safe_filename("a/b") != safe_filename("a\\b")
+    assert len(safe_filename("x" * 500)) <= 80 + 9
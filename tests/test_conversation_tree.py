@@ -0,0 +1,123 @@
+import json
+
+from streaming_body import JSON_OPTIONS, materialize, iter_json
+from media_handles import MediaHandle
+from message_model import Message, ContentPart, to_wire_messages
+from conversation_tree import ConversationTree, format_history
+
+
+def turn(tree, text, reply):
+    tree.commit(tree.head, Message.user(text), Message.assistant(reply))
+
+
+def texts(tree):
+    return [message.text for message in tree.history()]
+
+
+def test_history_follows_the_current_branch():
+    tree = ConversationTree()
+    turn(tree, "问题1", "回答1")
+    turn(tree, "问题2", "回答2")
+
+    assert len(tree) == 4
+    assert texts(tree) == ["问题1", "回答1", "问题2", "回答2"]
+    assert format_history(tree.history()) == "你: 问题1\n助手: 回答1\n你: 问题2\n助手: 回答2\n"
+
+
+def test_user_turn_keeps_full_request_but_history_only_text():
+    tree = ConversationTree()
+    media = MediaHandle.from_bytes("image", b"\x89PNG" + bytes(20), "png")
+    request = Message.user("看图", [ContentPart.media("image", media, "png")])
+    tree.commit(tree.head, request, Message.assistant("一张图"))
+
+    user_turn = tree.regenerate()
+    assert not user_turn.message.has_media
+    assert tree.request_for(user_turn) is request
+    assert texts(tree) == ["看图", "一张图"]
+
+
+def test_regenerate_adds_a_sibling_reply_and_switches_between_them():
+    tree = ConversationTree()
+    turn(tree, "问题", "回答A")
+    first_reply = tree.head
+
+    user_turn = tree.regenerate()
+    tree.commit(user_turn.parent, None, Message.assistant("回答B"), user_turn=user_turn)
+
+    assert texts(tree) == ["问题", "回答B"]
+    assert tree.siblings() == ([first_reply, tree.head], 1)
+    assert tree.switch_branch(-1) == (0, 2)
+    assert texts(tree) == ["问题", "回答A"]
+    assert tree.switch_branch() == (1, 2)
+    assert texts(tree) == ["问题", "回答B"]
+
+
+def test_edit_branches_from_the_previous_turn_and_keeps_the_old_branch():
+    tree = ConversationTree()
+    turn(tree, "问题1", "回答1")
+    turn(tree, "问题2", "回答2")
+    turn(tree, "问题3", "回答3")
+
+    original = tree.edit_last()
+    assert original.message.text == "问题3"
+    assert texts(tree) == ["问题1", "回答1", "问题2", "回答2"]
+    turn(tree, "改过的问题3", "新回答3")
+    turn(tree, "问题4", "回答4")
+
+    # 切换回原分支时回到该分支的最新位置，再切回来也是
+    assert tree.switch_branch() == (0, 2)
+    assert texts(tree)[-2:] == ["问题3", "回答3"]
+    assert tree.switch_branch() == (1, 2)
+    assert texts(tree)[-2:] == ["问题4", "回答4"]
+
+
+def test_branches_share_prefix_messages_and_their_serialization():
+    tree = ConversationTree()
+    turn(tree, "问题1", "回答1")
+    fork = tree.fork()
+    turn(tree, "问题2", "回答2")
+    turn(fork, "另一个问题2", "另一个回答2")
+
+    left, right = tree.history(), fork.history()
+    # 公共前缀是同一批消息对象，各分支共用它们缓存的JSON片段
+    assert left[0] is right[0] and left[1] is right[1]
+    for history in (left, right):
+        args = {"model": "qwen-omni-turbo", "messages": history}
+        expected = json.dumps({"model": "qwen-omni-turbo", "messages": to_wire_messages(history)},
+                              **JSON_OPTIONS).encode("utf-8")
+        assert b"".join(iter_json(args)) == expected
+        assert json.dumps(materialize(args), **JSON_OPTIONS).encode("utf-8") == expected
+    assert left[0]._fragment is not None
+
+
+def test_clear_starts_a_new_conversation():
+    tree = ConversationTree()
+    turn(tree, "问题", "回答")
+    tree.clear()
+    assert len(tree) == 0 and tree.history() == []
+    assert tree.regenerate() is None and tree.edit_last() is None
+
+
+def test_only_the_latest_in_memory_request_is_kept(tmp_path):
+    path = tmp_path / "clip.mp4"
+    path.write_bytes(bytes(300))
+    tree = ConversationTree()
+
+    def recording(text):
+        media = MediaHandle.from_bytes("audio", b"RIFF" + bytes(40), "wav")
+        return Message.user(text, [ContentPart.media("audio", media, "wav")])
+
+    tree.commit(tree.head, recording("录音1"), Message.assistant("回答1"))
+    first = tree.last_user_turn()
+    video = Message.user("视频", [ContentPart.media("video", MediaHandle.from_file("video", path, "mp4"), "mp4")])
+    tree.commit(tree.head, video, Message.assistant("回答2"))
+    video_turn = tree.last_user_turn()
+    tree.commit(tree.head, recording("录音2"), Message.assistant("回答3"))
+    last = tree.last_user_turn()
+    turn(tree, "文字", "回答4")
+
+    # 更早的录音只保留文字，只引用文件的视频和最近一条录音保留完整内容
+    assert first.request is None and tree.request_for(first) is first.message
+    assert tree.request_for(video_turn) is video
+    assert last.request is not None and tree.memory_turn is last
+    assert tree.last_user_turn().request is None
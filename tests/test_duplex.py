@@ -0,0 +1,117 @@
+import time
+
+import pytest
+
+import streaming_body
+from duplex_voice import DuplexSession, MockCompletionServer, LISTENING, RESPONDING
+from audio_playback import PlaybackService, NullBackend
+from conversation_tree import ConversationTree
+from tracing import TraceExporter
+
+
+class Events:
+    """收集会话事件"""
+
+    def __init__(self):
+        self.items = []
+
+    def __call__(self, name, **fields):
+        self.items.append((name, fields))
+
+    def names(self):
+        return [name for name, _ in self.items]
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@pytest.fixture
+def make_session(tmp_path):
+    """make_session(server)：连接到模拟接口、按实时速度“播放”的全双工会话"""
+    created = []
+
+    def make(server):
+        def complete(args, trace, cancel):
+            return streaming_body.create_chat_completion(server.url, "mock", args, cancel=cancel)
+
+        playback = PlaybackService(NullBackend(realtime=True))
+        events = Events()
+        session = DuplexSession(complete=complete, playback=playback, conversation=ConversationTree(),
+                                model="mock", on_event=events,
+                                exporter=TraceExporter({"path": str(tmp_path / "traces.jsonl")}))
+        created.append((server, playback))
+        return session, events
+
+    yield make
+    for server, playback in created:
+        playback.shutdown()
+        server.stop()
+
+
+def speak(session, seconds=0.5):
+    """模拟一句话结束：发送一段静音PCM"""
+    now = time.monotonic()
+    session.dispatch(bytes(int(session.config["rate"] * seconds) * 2), now - seconds, now)
+    return session.current
+
+
+def test_barge_in_before_first_byte_cancels_immediately(make_session):
+    server = MockCompletionServer(first_byte_delay=5.0).start()
+    session, events = make_session(server)
+
+    reply = speak(session)
+    assert wait_until(lambda: server.requests)
+    started = time.monotonic()
+    session.barge_in()
+    reply.thread.join(2.0)
+
+    # 不用等到首个数据（5秒）才结束
+    assert not reply.thread.is_alive()
+    assert time.monotonic() - started < 1.0
+    assert reply.interrupted and reply.cancel.cancelled
+    assert session.state == LISTENING
+    assert "barge_in" in events.names()
+    # 还没有回复就被打断的一句话不写入对话记录
+    assert len(session.conversation) == 0
+
+
+def test_barge_in_during_playback_stops_reply_and_keeps_partial_text(make_session):
+    server = MockCompletionServer(first_byte_delay=0.05, reply_seconds=5.0, generate_speed=2.0).start()
+    session, events = make_session(server)
+
+    reply = speak(session)
+    assert wait_until(lambda: session.state == RESPONDING)
+    session.barge_in()
+    reply.thread.join(2.0)
+
+    assert not reply.thread.is_alive()
+    assert reply.interrupted
+    assert session.state == LISTENING
+    assert events.names().count("barge_in") == 1
+    # 已生成的部分写入对话记录，回复在打断后不再继续
+    history = session.conversation.history()
+    assert [message.role for message in history] == ["user", "assistant"]
+    assert history[1].text and history[1].text != "好的，我听到了你的问题。"
+    turn = [fields for name, fields in events.items if name == "turn"][0]
+    assert turn["interrupted"]
+
+
+def test_next_utterance_after_barge_in_continues_the_conversation(make_session):
+    server = MockCompletionServer(first_byte_delay=0.05, reply_seconds=0.3, generate_speed=20.0).start()
+    session, events = make_session(server)
+
+    first = speak(session)
+    first.thread.join(5.0)
+    second = speak(session)
+    second.thread.join(5.0)
+
+    assert not first.interrupted and not second.interrupted
+    assert len(session.conversation) == 4
+    # 第二句话的请求带上了第一轮的对话记录
+    assert [message["role"] for message in server.requests[1]["messages"]] == ["user", "assistant", "user"]
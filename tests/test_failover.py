@@ -0,0 +1,132 @@
+import socket
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+import qwen_chat
+from media_handles import MediaHandle
+from message_model import Message, ContentPart
+
+
+def unused_url():
+    """没有服务在监听的地址（连接被拒绝）"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    return f"http://127.0.0.1:{port}/v1"
+
+
+class ErrorServer:
+    """对所有请求返回固定状态码的接口"""
+
+    def __init__(self, status):
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                server.requests += 1
+                self._read_body()
+                body = b'{"error": {"message": "mock error"}}'
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _read_body(self):
+                # 读完请求体（含分块上传）再返回错误，客户端不会因连接被提前关闭而当作连接失败
+                if self.headers.get("Transfer-Encoding", "").lower() != "chunked":
+                    self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                    return
+                while True:
+                    size = int(self.rfile.readline().split(b";")[0], 16)
+                    self.rfile.read(size)
+                    self.rfile.readline()
+                    if size == 0:
+                        return
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}/v1"
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def completion_args(lazy):
+    """lazy为True时附带媒体句柄，经由streaming_body发送；否则经由OpenAI SDK发送"""
+    parts = [ContentPart.media("audio", MediaHandle.from_bytes("audio", b"RIFF" + bytes(64), "wav"), "wav")] \
+        if lazy else ()
+    return {
+        "model": "qwen-omni-turbo",
+        "messages": [Message.user("你好", parts)],
+        "modalities": ["text"],
+        "stream": True,
+    }
+
+
+def reply_transcript(chunks):
+    """模拟接口只返回语音，按语音的文字稿拼接回复（新版SDK把audio解析为对象，不是字典）"""
+    transcript = ""
+    for chunk in chunks:
+        if chunk.choices:
+            audio = getattr(chunk.choices[0].delta, "audio", None)
+            if isinstance(audio, dict):
+                transcript += audio.get("transcript", "")
+            elif audio is not None:
+                transcript += getattr(audio, "transcript", None) or ""
+    return transcript
+
+
+@pytest.mark.parametrize("lazy", [False, True], ids=["sdk", "streaming_body"])
+def test_connection_refused_fails_over_to_next_endpoint(mock_server, endpoints, lazy):
+    dead = unused_url()
+    pool = endpoints([dead, mock_server.url])
+
+    text = reply_transcript(qwen_chat.stream_completion(completion_args(lazy)))
+
+    assert text
+    assert len(mock_server.requests) == 1
+    states = {state["url"]: state for state in pool.snapshot()}
+    assert states[dead.rstrip("/")]["failures"] == 1
+    assert states[mock_server.url]["requests"] == 1
+    assert states[mock_server.url]["failures"] == 0
+
+
+@pytest.mark.parametrize("lazy", [False, True], ids=["sdk", "streaming_body"])
+def test_server_error_fails_over_to_next_endpoint(mock_server, endpoints, lazy):
+    broken = ErrorServer(503)
+    try:
+        endpoints([broken.url, mock_server.url])
+        text = reply_transcript(qwen_chat.stream_completion(completion_args(lazy)))
+    finally:
+        broken.stop()
+
+    assert text
+    assert broken.requests >= 1
+    assert len(mock_server.requests) == 1
+
+
+def test_client_error_is_not_retried_on_other_endpoints(mock_server, endpoints):
+    rejecting = ErrorServer(400)
+    try:
+        endpoints([rejecting.url, mock_server.url])
+        with pytest.raises(Exception) as error:
+            list(qwen_chat.stream_completion(completion_args(lazy=True)))
+    finally:
+        rejecting.stop()
+
+    assert getattr(error.value, "status_code", None) == 400
+    assert rejecting.requests == 1
+    assert mock_server.requests == []
@@ -0,0 +1,166 @@
+import io
+import os
+import json
+import time
+import base64
+import socket
+import struct
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+import gateway_server
+from gateway_server import (WebSocketConnection, MessageTooBigError, SlowClientError, Gateway, GatewayHandler,
+                            unmask, OP_CONTINUATION, OP_TEXT, OP_BINARY, OP_PING)
+
+
+def client_frame(opcode, payload, fin=True, mask=b"\x12\x34\x56\x78"):
+    """客户端发出的帧（带掩码）"""
+    header = bytes([(0x80 if fin else 0) | opcode])
+    length = len(payload)
+    if length < 126:
+        header += bytes([0x80 | length])
+    elif length < 65536:
+        header += bytes([0x80 | 126]) + struct.pack("!H", length)
+    else:
+        header += bytes([0x80 | 127]) + struct.pack("!Q", length)
+    masked = bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload))
+    return header + mask + masked
+
+
+def connection(data, max_message_bytes=None):
+    return WebSocketConnection(None, io.BytesIO(data), max_message_bytes)
+
+
+@pytest.mark.parametrize("length", [0, 1, 3, 4, 5, 125, 4099])
+def test_unmask_matches_bytewise_xor(length):
+    payload = os.urandom(length)
+    mask = os.urandom(4)
+    expected = bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload))
+    assert unmask(payload, mask) == expected
+    assert unmask(expected, mask) == payload
+
+
+def test_reads_masked_frames_of_every_length_encoding():
+    payloads = [b"x" * 125, b"y" * 126, os.urandom(70000)]
+    reader = connection(b"".join(client_frame(OP_BINARY, payload) for payload in payloads))
+    for payload in payloads:
+        assert reader.read_message() == (OP_BINARY, payload)
+
+
+def test_ping_between_fragments_keeps_the_partial_message():
+    data = (client_frame(OP_TEXT, "你好，".encode("utf-8"), fin=False)
+            + client_frame(OP_PING, b"ping")
+            + client_frame(OP_CONTINUATION, "世界".encode("utf-8")))
+    reader = connection(data)
+
+    assert reader.read_message() == (OP_PING, b"ping")
+    assert reader.read_message() == (OP_TEXT, "你好，世界".encode("utf-8"))
+
+
+def test_oversized_frame_is_rejected_before_reading_its_payload():
+    data = client_frame(OP_BINARY, bytes(2000))
+    stream = io.BytesIO(data)
+    reader = WebSocketConnection(None, stream, max_message_bytes=1000)
+
+    with pytest.raises(MessageTooBigError):
+        reader.read_message()
+    # 只读取了帧头（2字节+2字节长度），没有读取掩码和数据
+    assert stream.tell() == 4
+
+
+def test_oversized_fragmented_message_is_rejected():
+    data = b"".join(client_frame(OP_TEXT if index == 0 else OP_CONTINUATION, bytes(400), fin=False)
+                    for index in range(3))
+    with pytest.raises(MessageTooBigError):
+        connection(data, max_message_bytes=1000).read_message()
+
+
+def test_fragment_without_start_is_an_error():
+    with pytest.raises(ConnectionError):
+        connection(client_frame(OP_CONTINUATION, b"abc")).read_message()
+
+
+def test_send_frame_round_trips_through_a_socket():
+    server, client = socket.socketpair()
+    try:
+        sender = WebSocketConnection(server, None)
+        payloads = [b"", b"a" * 126, os.urandom(70000)]
+        for payload in payloads:
+            sender.send_frame(OP_BINARY, payload)
+        server.shutdown(socket.SHUT_WR)
+        reader = WebSocketConnection(None, client.makefile("rb"))
+        for payload in payloads:
+            assert reader.read_message() == (OP_BINARY, payload)
+    finally:
+        server.close()
+        client.close()
+
+
+@pytest.fixture
+def slow_client_gateway(monkeypatch):
+    """发送队列很小、慢客户端超时很短的网关；每轮对话不停地发送大事件，直到客户端被判定过慢"""
+    errors = []
+    finished = threading.Event()
+
+    def run_turn(session, request, send_event, send_pcm=None):
+        try:
+            for _ in range(10000):
+                send_event({"type": "text", "delta": "x" * 65536})
+        except Exception as e:
+            errors.append(e)
+            raise
+
+    handler_finish = GatewayHandler.finish
+
+    def finish(self):
+        handler_finish(self)
+        finished.set()
+
+    monkeypatch.setattr(gateway_server, "run_turn", run_turn)
+    monkeypatch.setattr(GatewayHandler, "finish", finish)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), GatewayHandler)
+    server.daemon_threads = True
+    server.gateway = Gateway({"send_queue_size": 4, "slow_client_timeout": 0.5})
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server, errors, finished
+    server.shutdown()
+    server.server_close()
+
+
+def connect_without_reading(server):
+    sock = socket.create_connection(server.server_address)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    return sock
+
+
+def test_slow_sse_client_is_disconnected(slow_client_gateway):
+    server, errors, finished = slow_client_gateway
+    sock = connect_without_reading(server)
+    try:
+        body = json.dumps({"text": "你好"}).encode("utf-8")
+        sock.sendall(b"POST /v1/chat HTTP/1.1\r\nHost: test\r\nContent-Type: application/json\r\n"
+                     b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+        # 客户端一直不读取：处理线程在超时后断开连接并结束，不会卡在关闭发送线程上
+        assert finished.wait(10.0)
+        assert isinstance(errors[0], (SlowClientError, ConnectionError))
+    finally:
+        sock.close()
+
+
+def test_slow_websocket_client_is_disconnected(slow_client_gateway):
+    server, errors, finished = slow_client_gateway
+    sock = connect_without_reading(server)
+    try:
+        key = base64.b64encode(os.urandom(16)).decode("ascii")
+        sock.sendall(f"GET /v1/ws HTTP/1.1\r\nHost: test\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                     f"Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n".encode("ascii"))
+        sock.sendall(client_frame(OP_TEXT, json.dumps({"text": "你好"}).encode("utf-8")))
+        started = time.monotonic()
+        assert finished.wait(10.0)
+        assert time.monotonic() - started < 5.0
+        assert isinstance(errors[0], (SlowClientError, ConnectionError))
+        assert server.gateway.connections == 0
+    finally:
+        sock.close()
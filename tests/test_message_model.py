@@ -0,0 +1,103 @@
+import json
+
+import pytest
+
+from streaming_body import JSON_OPTIONS, materialize, iter_json, uses_streaming_body
+from media_handles import MediaHandle
+from message_model import Message, ContentPart, ROLE_USER, to_wire_messages
+
+
+def dumps(value):
+    return json.dumps(materialize(value), **JSON_OPTIONS).encode("utf-8")
+
+
+def test_text_message_serializes_like_a_dict():
+    message = Message.user("带\"引号\"、\n换行和表情😀的问题")
+    wire = {"role": "user", "content": "带\"引号\"、\n换行和表情😀的问题"}
+
+    assert message.to_wire() == wire
+    assert message["content"] == wire["content"] and message.get("role") == "user"
+    assert message.role is ROLE_USER
+    assert b"".join(message.iter_json()) == dumps(wire)
+
+
+def test_serialized_fragment_is_cached():
+    message = Message.user("你好", [ContentPart.media("image", "aGVsbG8=", "png")])
+    first = b"".join(message.iter_json())
+    fragment = message._fragment
+    assert fragment == first == dumps(message.to_wire())
+    # 再次序列化直接使用缓存的片段
+    assert list(message.iter_json()) == [fragment]
+    assert list(message.iter_json())[0] is fragment
+
+
+def test_lazy_media_is_encoded_on_every_send_and_not_cached():
+    media = MediaHandle.from_bytes("audio", b"RIFF" + bytes(100), "wav")
+    message = Message.user("听一下", [ContentPart.media("audio", media, "wav")])
+
+    expected = dumps(message.to_wire())
+    assert b"".join(message.iter_json(3)) == expected
+    assert b"".join(message.iter_json()) == expected
+    assert message._fragment is None
+    assert json.loads(expected)["content"][0]["input_audio"]["data"].startswith("data:;base64,")
+
+
+def test_history_of_messages_matches_json_dumps():
+    history = [Message.system("系统提示"), Message.user("问题"), Message.assistant("回答")]
+    args = {"model": "qwen-omni-turbo", "messages": history, "stream": True}
+    expected = json.dumps({"model": "qwen-omni-turbo", "messages": to_wire_messages(history), "stream": True},
+                          **JSON_OPTIONS).encode("utf-8")
+    assert b"".join(iter_json(args)) == expected
+    assert b"".join(iter_json(args)) == expected
+
+
+def test_from_wire_round_trip():
+    wire = {"role": "user", "content": [
+        {"type": "input_audio", "input_audio": {"data": "data:;base64,AAAA", "format": "wav"}},
+        {"type": "image_url", "image_url": {"url": "data:image/png;base64,BBBB"}},
+        {"type": "text", "text": "描述一下"},
+    ]}
+    message = Message.from_wire(wire)
+
+    assert message.to_wire() == wire
+    assert message.text == "描述一下" and message.has_media
+    assert Message.from_wire(message) is message
+    assert Message.from_wire({"role": "assistant", "content": "好的"}).to_wire() == \
+        {"role": "assistant", "content": "好的"}
+
+
+def test_text_only_drops_media():
+    message = Message.user("看图", [ContentPart.media("image", "aGVsbG8=", "jpeg")])
+    text_only = message.text_only()
+    assert text_only.to_wire() == {"role": "user", "content": "看图"}
+    assert not text_only.has_media
+    plain = Message.assistant("回答")
+    assert plain.text_only() is plain
+
+
+def test_unknown_role_is_rejected():
+    with pytest.raises(ValueError):
+        Message("tool", "结果")
+
+
+def test_messages_have_no_instance_dict():
+    message = Message.user("你好", [ContentPart.media("image", "aGVsbG8=", "png")])
+    for value in (message, message.parts[0]):
+        assert not hasattr(value, "__dict__")
+        with pytest.raises(AttributeError):
+            value.extra = 1
+
+
+def test_only_lazy_media_needs_the_streaming_body(tmp_path):
+    path = tmp_path / "clip.mp4"
+    path.write_bytes(bytes(300))
+    plain = [Message.user("问题"), Message.assistant("回答"),
+             Message.user("看图", [ContentPart.media("image", "aGVsbG8=", "png")])]
+    assert not uses_streaming_body({"messages": plain})
+
+    recording = Message.user("", [ContentPart.media("audio", MediaHandle.from_bytes("audio", bytes(30), "wav"))])
+    video = Message.user("", [ContentPart.media("video", MediaHandle.from_file("video", path, "mp4"), "mp4")])
+    assert uses_streaming_body({"messages": plain + [recording]})
+    assert recording.is_lazy and not recording.file_backed
+    assert video.is_lazy and video.file_backed
+    assert plain[0].file_backed and not plain[2].is_lazy
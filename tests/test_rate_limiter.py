@@ -0,0 +1,110 @@
+import time
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from rate_limiter import TokenBucket, RateLimiter, RateLimitTimeout, is_rate_limit_error
+
+
+def make_limiter(**config):
+    return RateLimiter(dict({"enabled": True}, **config))
+
+
+def test_token_bucket_refills_up_to_capacity():
+    bucket = TokenBucket(10, 2)
+    bucket.take(10)
+    start = bucket.updated
+    bucket.refill(start + 2)
+    assert bucket.tokens == pytest.approx(4)
+    assert bucket.time_until(6) == pytest.approx(1)
+    bucket.refill(start + 100)
+    assert bucket.tokens == 10
+    # 超过容量的请求按容量计算，不会永远等待
+    assert bucket.time_until(50) == 0
+
+
+def test_token_bucket_can_go_negative_for_reconciliation():
+    bucket = TokenBucket(10, 1)
+    bucket.take(15)
+    assert bucket.tokens == -5
+    assert bucket.time_until(1) == pytest.approx(6)
+
+
+def test_requests_beyond_rpm_wait_and_time_out():
+    limiter = make_limiter(rpm=2, tpm=100000)
+    assert limiter.acquire("a", 10) < 0.1
+    assert limiter.acquire("a", 10) < 0.1
+    with pytest.raises(RateLimitTimeout):
+        limiter.acquire("a", 10, max_wait=0.2)
+    assert limiter.metrics()["granted"] == 2
+    assert limiter.metrics()["timeouts"] == 1
+
+
+def test_tokens_beyond_tpm_wait():
+    limiter = make_limiter(rpm=1000, tpm=1000)
+    limiter.acquire("a", 900)
+    with pytest.raises(RateLimitTimeout):
+        limiter.acquire("a", 900, max_wait=0.2)
+
+
+def test_reconcile_charges_actual_usage():
+    limiter = make_limiter(rpm=1000, tpm=1000)
+    limiter.acquire("a", 100)
+    before = limiter.token_bucket.tokens
+    limiter.reconcile(50, 100, SimpleNamespace(prompt_tokens=100, completion_tokens=50))
+    assert limiter.token_bucket.tokens == pytest.approx(before - 50, abs=1)
+    # 实际prompt tokens是估算值的两倍，估算比例向2靠拢
+    assert limiter.estimate_ratio > 1.0
+
+
+def test_throttling_backs_off_exponentially_and_decreases_rate():
+    limiter = make_limiter(backoff_initial=1.0, backoff_max=3.0, decrease_factor=0.5, min_rate_scale=0.2)
+    limiter.record_throttled()
+    assert limiter.backoff == 1.0 and limiter.rate_scale == 0.5
+    limiter.record_throttled()
+    assert limiter.backoff == 2.0 and limiter.rate_scale == 0.25
+    limiter.record_throttled()
+    assert limiter.backoff == 3.0 and limiter.rate_scale == 0.2
+    # 退避期间不放行
+    with pytest.raises(RateLimitTimeout):
+        limiter.acquire("a", 1, max_wait=0.2)
+
+
+def test_success_recovers_rate_additively():
+    limiter = make_limiter(decrease_factor=0.5, increase_step=0.1)
+    limiter.record_throttled()
+    limiter.record_success()
+    assert limiter.backoff == 0.0
+    assert limiter.rate_scale == pytest.approx(0.6)
+    for _ in range(10):
+        limiter.record_success()
+    assert limiter.rate_scale == 1.0
+
+
+def test_sessions_are_served_round_robin():
+    limiter = make_limiter(rpm=600, tpm=10 ** 9)
+    # 清空请求桶，之后每0.1秒放行一个
+    limiter.request_bucket.take(limiter.request_bucket.tokens)
+    order = []
+
+    def request(session_id):
+        limiter.acquire(session_id, 1, max_wait=5)
+        order.append(session_id)
+
+    threads = []
+    for session_id in ["a", "a", "a", "b"]:
+        thread = threading.Thread(target=request, args=(session_id,))
+        thread.start()
+        threads.append(thread)
+        time.sleep(0.01)
+    for thread in threads:
+        thread.join()
+    # b不用等a的三个请求都放行
+    assert order.index("b") == 1
+
+
+def test_is_rate_limit_error():
+    assert is_rate_limit_error(SimpleNamespace(status_code=429))
+    assert not is_rate_limit_error(SimpleNamespace(status_code=500))
+    assert not is_rate_limit_error(ValueError())
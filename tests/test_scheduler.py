@@ -0,0 +1,90 @@
+import time
+import threading
+
+import pytest
+
+from scheduler import PriorityScheduler, SchedulerTimeout
+
+
+def make_scheduler(**config):
+    return PriorityScheduler(dict({"enabled": True, "max_concurrent": 1, "reserved_interactive": 0}, **config))
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+def grant_order(scheduler, requests):
+    """占住唯一的名额，按顺序排入(会话, 类别)请求，放开后返回它们获得名额的顺序"""
+    holder = scheduler.acquire("holder")
+    order = []
+    threads = []
+    for index, (session_id, priority_class) in enumerate(requests):
+        def run(session_id=session_id, priority_class=priority_class):
+            ticket = scheduler.acquire(session_id, priority_class)
+            order.append((session_id, priority_class))
+            scheduler.release(ticket)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        threads.append(thread)
+        assert wait_until(lambda: len(scheduler.queue) == index + 1)
+    scheduler.release(holder)
+    for thread in threads:
+        thread.join(5.0)
+    return order
+
+
+def test_higher_priority_class_overtakes_queued_batch():
+    order = grant_order(make_scheduler(), [("s", "batch"), ("s", "text"), ("s", "voice")])
+    assert [priority_class for _, priority_class in order] == ["voice", "text", "batch"]
+
+
+def test_weighted_fair_queueing_within_a_class():
+    # a的权重是b的两倍：a的虚拟完成时间为0.5, 1, 1.5, 2，b为1, 2
+    scheduler = make_scheduler(session_weights={"a": 2.0, "b": 1.0})
+    order = grant_order(scheduler, [("a", "text")] * 4 + [("b", "text")] * 2)
+    assert [session_id for session_id, _ in order] == ["a", "a", "b", "a", "a", "b"]
+
+
+def test_equal_weights_alternate_between_sessions():
+    order = grant_order(make_scheduler(), [("a", "text")] * 3 + [("b", "text")] * 3)
+    assert [session_id for session_id, _ in order] == ["a", "b", "a", "b", "a", "b"]
+
+
+def test_batch_cannot_use_reserved_interactive_slot():
+    scheduler = make_scheduler(max_concurrent=2, reserved_interactive=1, max_queue_wait=0.1)
+    batch = scheduler.acquire("job", "batch")
+    with pytest.raises(SchedulerTimeout):
+        scheduler.acquire("job", "batch")
+    # 保留的名额仍可供交互式请求使用
+    text = scheduler.acquire("user", "text")
+    assert scheduler.metrics()["running"] == 2
+    scheduler.release(text)
+    scheduler.release(batch)
+
+
+def test_unknown_priority_class_is_rejected():
+    with pytest.raises(ValueError):
+        make_scheduler().acquire("s", "urgent")
+
+
+def test_idle_sessions_are_evicted():
+    scheduler = make_scheduler(max_queue_wait=0.1)
+    for index in range(100):
+        scheduler.release(scheduler.acquire(f"session-{index}"))
+    assert scheduler.metrics()["sessions"] == 0
+    assert scheduler.session_finish == {}
+
+    # 排队超时放弃的请求同样不留下状态
+    holder = scheduler.acquire("holder")
+    with pytest.raises(SchedulerTimeout):
+        scheduler.acquire("waiting")
+    assert list(scheduler.session_active) == [("text", "holder")]
+    scheduler.release(holder)
+    assert scheduler.metrics()["sessions"] == 0
@@ -0,0 +1,147 @@
+import threading
+
+import pytest
+
+from single_flight import SingleFlight, canonical_request_key
+from streaming_body import CancelToken
+
+
+class Upstream:
+    """先返回第一个数据块，等待gate打开后返回其余数据块（error不为None时随后抛出）
+
+    被取消时gate随之打开，cancelled记录上游是否被取消。
+    """
+
+    def __init__(self, chunks, error=None):
+        self.chunks = chunks
+        self.error = error
+        self.gate = threading.Event()
+        self.calls = 0
+        self.cancel = None
+        self.finished = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self.cancel is not None and self.cancel.cancelled
+
+    def __call__(self, cancel):
+        self.calls += 1
+        self.cancel = cancel
+        cancel.register(self.gate.set)
+        return self._run()
+
+    def _run(self):
+        try:
+            yield self.chunks[0]
+            self.gate.wait(5.0)
+            if self.cancelled:
+                return
+            yield from self.chunks[1:]
+        finally:
+            self.finished.set()
+        if self.error is not None:
+            raise self.error
+
+
+def test_request_key_ignores_dict_order():
+    first = {"model": "m", "messages": [{"role": "user", "content": "你好"}]}
+    second = {"messages": [{"content": "你好", "role": "user"}], "model": "m"}
+    assert canonical_request_key(first) == canonical_request_key(second)
+    assert canonical_request_key(first) != canonical_request_key(dict(first, model="other"))
+
+
+def test_identical_requests_share_one_upstream_call_and_replay():
+    flight = SingleFlight({"enabled": True})
+    upstream = Upstream([1, 2, 3])
+
+    first = flight.stream("key", upstream)
+    assert next(first) == 1
+    # 中途加入的订阅者先回放已经收到的数据块
+    second = flight.stream("key", upstream)
+    upstream.gate.set()
+
+    assert list(first) == [2, 3]
+    assert list(second) == [1, 2, 3]
+    assert upstream.calls == 1
+    assert flight.metrics() == {"in_flight": 0, "upstream_calls": 1, "coalesced": 1}
+
+
+def test_upstream_error_reaches_every_subscriber():
+    flight = SingleFlight({"enabled": True})
+    upstream = Upstream([1, 2], error=RuntimeError("upstream failed"))
+
+    first = flight.stream("key", upstream)
+    second = flight.stream("key", upstream)
+    upstream.gate.set()
+
+    for subscriber in (first, second):
+        received = []
+        with pytest.raises(RuntimeError):
+            for chunk in subscriber:
+                received.append(chunk)
+        assert received == [1, 2]
+
+
+def test_finished_request_is_not_reused():
+    flight = SingleFlight({"enabled": True})
+    upstream = Upstream([1])
+    upstream.gate.set()
+
+    assert list(flight.stream("key", upstream)) == [1]
+    assert list(flight.stream("key", upstream)) == [1]
+    assert upstream.calls == 2
+    assert flight.metrics()["coalesced"] == 0
+
+
+def test_last_subscriber_leaving_cancels_upstream():
+    flight = SingleFlight({"enabled": True})
+    upstream = Upstream([1, 2])
+
+    first = flight.stream("key", upstream)
+    second = flight.stream("key", upstream)
+    assert next(first) == 1
+    first.close()
+    # 还有订阅者在读取，上游请求继续
+    assert not upstream.cancelled
+
+    second.close()
+    assert upstream.cancelled
+    assert upstream.finished.wait(2.0)
+    assert flight.metrics()["in_flight"] == 0
+    # 之后的相同请求重新发起上游调用，不加入已取消的请求
+    retry = Upstream([3])
+    retry.gate.set()
+    assert list(flight.stream("key", retry)) == [3]
+
+
+def test_closing_an_unread_subscription_releases_it():
+    flight = SingleFlight({"enabled": True})
+    upstream = Upstream([1, 2])
+
+    subscription = flight.stream("key", upstream)
+    subscription.close()
+
+    assert upstream.finished.wait(2.0)
+    assert upstream.cancelled
+    assert list(subscription) == []
+
+
+def test_cancelled_subscriber_stops_without_waiting_for_upstream():
+    flight = SingleFlight({"enabled": True})
+    upstream = Upstream([1, 2])
+    cancel = CancelToken()
+    waiting = flight.stream("key", upstream, cancel)
+    other = flight.stream("key", upstream)
+    assert next(waiting) == 1
+
+    received = []
+    reader = threading.Thread(target=lambda: received.extend(waiting))
+    reader.start()
+    cancel.cancel()
+    reader.join(2.0)
+
+    # 被取消的订阅者立即结束，不抛出异常；其他订阅者继续读取
+    assert not reader.is_alive() and received == []
+    assert not upstream.cancelled
+    upstream.gate.set()
+    assert list(other) == [1, 2]
@@ -0,0 +1,122 @@
+import os
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+import streaming_body
+from streaming_body import JSON_OPTIONS, materialize, iter_json
+from media_handles import MediaHandle
+from message_model import Message, ContentPart
+
+
+class RecordingServer:
+    """记录原始请求体和分块情况的接口，返回一条简短的流式回复"""
+
+    def __init__(self):
+        self.uploads = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                chunked = self.headers.get("Transfer-Encoding", "").lower() == "chunked"
+                sizes = []
+                if chunked:
+                    parts = []
+                    while True:
+                        size = int(self.rfile.readline().split(b";")[0], 16)
+                        parts.append(self.rfile.read(size))
+                        self.rfile.readline()
+                        if size == 0:
+                            break
+                        sizes.append(size)
+                    body = b"".join(parts)
+                else:
+                    body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                server.uploads.append({"chunked": chunked, "sizes": sizes, "body": body,
+                                       "content_length": self.headers.get("Content-Length")})
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                event = {"choices": [{"index": 0, "delta": {"content": "ok"}}]}
+                self.wfile.write(f"data: {json.dumps(event)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}/v1"
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def recording_server():
+    server = RecordingServer()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def video_file(tmp_path):
+    # 长度不是3的倍数，检查最后一块的base64填充
+    path = tmp_path / "clip.mp4"
+    path.write_bytes(os.urandom(3 * 1024 * 1024 + 2))
+    return path
+
+
+def video_args(path):
+    media = MediaHandle.from_file("video", path, "mp4")
+    history = [Message.user("第一个问题"), Message.assistant("第一个回答，带\"引号\"和\n换行")]
+    return {
+        "model": "qwen-omni-turbo",
+        "messages": history + [Message.user("概述这个视频", [ContentPart.media("video", media, "mp4")])],
+        "modalities": ["text"],
+        "stream": True,
+    }
+
+
+def test_upload_is_chunked_and_byte_identical(recording_server, video_file):
+    args = video_args(video_file)
+    config = {"chunk_bytes": 3 * 64 * 1024}
+
+    chunks = list(streaming_body.create_chat_completion(recording_server.url, "mock", args, config))
+
+    assert [chunk.choices[0].delta.content for chunk in chunks] == ["ok"]
+    upload = recording_server.uploads[0]
+    assert upload["chunked"] and upload["content_length"] is None
+    # 3MB文件的base64约4MB，按chunk_bytes分成多块上传，不是一次发送完整的请求体
+    assert len(upload["sizes"]) > 10
+    assert upload["body"] == json.dumps(materialize(args), **JSON_OPTIONS).encode("utf-8")
+    assert json.loads(upload["body"])["messages"][-1]["content"][0]["video_url"]["url"].startswith(
+        "data:video/mp4;base64,")
+
+
+def test_iter_json_matches_json_dumps_for_any_chunk_size(video_file):
+    args = video_args(video_file)
+    expected = json.dumps(materialize(args), **JSON_OPTIONS).encode("utf-8")
+    for chunk_bytes in (3, 3 * 1000, 3 * 1024 * 1024):
+        assert b"".join(iter_json(args, chunk_bytes)) == expected
+    # 消息缓存了JSON片段后再次序列化，结果不变
+    assert b"".join(iter_json(args)) == expected
+
+
+def test_file_backed_handle_is_not_kept_in_memory(video_file):
+    media = MediaHandle.from_file("video", video_file, "mp4")
+    assert media.data is None
+    assert len(media) == (os.path.getsize(video_file) + 2) // 3 * 4
+    assert b"".join(media.iter_chunks()) == str(media).encode("ascii")
+
+
+def test_plain_messages_do_not_use_streaming_body():
+    args = {"model": "qwen-omni-turbo", "messages": [Message.user("你好")], "stream": True}
+    assert not streaming_body.uses_streaming_body(args)
+    assert materialize(args)["messages"] == [{"role": "user", "content": "你好"}]
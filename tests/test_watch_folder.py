@@ -0,0 +1,51 @@
+import os
+import errno
+from pathlib import Path
+
+import pytest
+
+import qwen_chat
+import watch_folder
+from watch_folder import FolderWatcher
+
+
+@pytest.fixture
+def folder(tmp_path):
+    directory = tmp_path / "inbox"
+    directory.mkdir()
+    return FolderWatcher(directory, model="mock")
+
+
+def test_candidates_follow_attachment_media_kinds(folder):
+    for name in ("photo.webp", "clip.mkv", "voice.mp3", "photo.JPG"):
+        assert folder._is_candidate(Path(name))
+    for name in ("notes.txt", "photo.png.qwen.txt", ".hidden.png"):
+        assert not folder._is_candidate(Path(name))
+
+
+def test_audio_reply_is_moved_across_filesystems(folder, tmp_path, monkeypatch):
+    audio = tmp_path / "response.wav"
+    audio.write_bytes(b"RIFF" + bytes(64))
+    media = folder.directory / "clip.mp4"
+
+    # 模拟跨文件系统：rename失败时shutil.move改为复制后删除
+    def cross_device(src, dst):
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+    monkeypatch.setattr(os, "rename", cross_device)
+    monkeypatch.setattr(os, "replace", cross_device)
+
+    folder._write_result(media, {"text": "ok", "audio_path": str(audio)})
+
+    assert (folder.directory / "clip.mp4.qwen.txt").read_text(encoding="utf-8") == "ok"
+    assert (folder.directory / "clip.mp4.qwen.wav").read_bytes() == b"RIFF" + bytes(64)
+    assert not audio.exists()
+
+
+def test_missing_api_key_fails_instead_of_prompting(folder, monkeypatch, capsys):
+    monkeypatch.setattr(qwen_chat, "key_pool", None)
+    monkeypatch.setattr(qwen_chat, "load_api_keys", lambda: [])
+    monkeypatch.setattr("builtins.input", lambda *args: pytest.fail("不应请求输入"))
+    monkeypatch.setattr(watch_folder, "PollingWatcher", lambda *args: pytest.fail("不应开始监听"))
+
+    assert folder.run() == 1
+    assert "API密钥" in capsys.readouterr().out
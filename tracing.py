@@ -0,0 +1,383 @@
+import os
+import sys
+import json
+import time
+import secrets
+import argparse
+import threading
+from pathlib import Path
+
+from message_model import TYPE_TEXT, TYPE_AUDIO, TYPE_IMAGE, TYPE_VIDEO
+
+# 默认配置
+DEFAULT_TRACING_CONFIG = {
+    "enabled": True,
+    # 跟踪记录文件（OTLP/JSON，每行一个ExportTraceServiceRequest）
+    "path": "traces/traces.jsonl",
+    "service_name": "qwen-omni-chat",
+    # 文件超过该大小时改名为.1备份（只保留一个备份）
+    "max_file_bytes": 10 * 1024 * 1024,
+}
+
+# 一轮对话的各阶段：(span名称, 父span, 起点标记, 终点标记)
+# 起点有多个候选时取第一个已记录的（如没有经过调度器时"send"阶段从发起请求算起）
+STAGES = (
+    ("record", None, ("record_start",), "record_end"),
+    ("vad", None, ("record_end",), "vad_end"),
+    ("encode", None, ("vad_end", "record_end"), "encoded"),
+    ("request", None, ("send",), "response_end"),
+    ("queue", "request", ("send",), "admitted"),
+    ("send", "request", ("admitted", "send"), "response_start"),
+    ("first_byte", "request", ("response_start", "admitted", "send"), "first_byte"),
+    ("first_text", "request", ("first_byte",), "first_text"),
+    ("first_audio", "request", ("first_byte",), "first_audio"),
+    ("playback", None, ("playback_start",), "playback_end"),
+)
+
+# 录音和播放的时长取决于说话和回复的长短，查找最慢的阶段时只比较其余的等待阶段
+WAIT_STAGES = ("vad", "encode", "queue", "send", "first_byte", "first_text", "first_audio")
+
+# 命令行报告中的阶段名称（相对停止录音的耗时）
+REPORT_LABELS = {
+    "encoded": "编码完成", "send": "开始发送", "first_byte": "首个数据", "first_text": "首段文字",
+    "first_audio": "首段音频", "playback_start": "开始播放",
+}
+
+MODALITY_NAMES = {TYPE_TEXT: "text", TYPE_AUDIO: "audio", TYPE_IMAGE: "image", TYPE_VIDEO: "video"}
+
+# OTLP中的span类型和状态码
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_CLIENT = 3
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+
+def message_attributes(message):
+    """用户消息的输入模态和字节数（文字为UTF-8字节数，媒体为data URI的长度，不生成媒体内容）"""
+    parts = getattr(message, "parts", None)
+    if parts is None:
+        content = message.get("content")
+        if not isinstance(content, str):
+            return {}
+        return {"chat.input_modalities": ["text"], "chat.payload_bytes": len(content.encode("utf-8"))}
+    modalities = []
+    payload_bytes = 0
+    for part in parts:
+        name = MODALITY_NAMES.get(part.type, part.type)
+        if name not in modalities:
+            modalities.append(name)
+        payload_bytes += len(part.value) if part.is_media else len(part.value.encode("utf-8"))
+    return {"chat.input_modalities": modalities, "chat.payload_bytes": payload_bytes}
+
+
+class TurnTrace:
+    """一轮对话的跟踪记录：各阶段打上时间标记，结束时换算为OpenTelemetry的span并导出
+
+    标记使用time.monotonic()的时间，同一标记只记录第一次（如首个数据块）。
+    标记可以在多个线程中记录（录音线程、请求线程、播放线程）。
+    """
+
+    def __init__(self, name, exporter=None, attributes=None):
+        self.name = name
+        self.exporter = exporter
+        self.attributes = dict(attributes or {})
+        self.marks = {}
+        self.trace_id = secrets.token_hex(16)
+        self.error = None
+        self.ended = False
+        self.ended_at = None
+        self.started_at = time.monotonic()
+        # 单调时钟与系统时钟的差，用于把标记换算为Unix时间
+        self.wall_offset_ns = time.time_ns() - time.monotonic_ns()
+        self.lock = threading.Lock()
+
+    @property
+    def short_id(self):
+        return self.trace_id[:8]
+
+    def mark(self, name, at=None):
+        if name not in self.marks:
+            self.marks[name] = time.monotonic() if at is None else at
+
+    def set(self, key, value):
+        if value is not None:
+            self.attributes[key] = value
+
+    def set_request(self, completion_args):
+        """记录请求的模型、输出模态和本轮用户消息的输入模态、字节数"""
+        messages = completion_args.get("messages") or []
+        self.set("gen_ai.request.model", completion_args.get("model"))
+        self.set("chat.output_modalities", list(completion_args.get("modalities") or ["text"]))
+        self.set("chat.history_messages", len(messages))
+        if messages:
+            self.attributes.update(message_attributes(messages[-1]))
+
+    def set_usage(self, usage):
+        self.set("gen_ai.usage.input_tokens", getattr(usage, "prompt_tokens", None))
+        self.set("gen_ai.usage.output_tokens", getattr(usage, "completion_tokens", None))
+
+    def observe(self, chunk):
+        """记录流式响应数据块：首个数据、首段文字、首段音频和tokens用量"""
+        self.mark("first_byte")
+        usage = getattr(chunk, "usage", None)
+        if usage:
+            self.set_usage(usage)
+        if not chunk.choices:
+            return
+        delta = chunk.choices[0].delta
+        audio = getattr(delta, "audio", None)
+        if not isinstance(audio, dict):
+            audio = {}
+        if delta.content or audio.get("transcript"):
+            self.mark("first_text")
+        if audio.get("data"):
+            self.mark("first_audio")
+
+    def fail(self, error):
+        if self.error is None:
+            self.error = error
+
+    def offsets(self, origin="record_end"):
+        """各标记相对origin的耗时(毫秒)，没有origin标记时返回空字典"""
+        start = self.marks.get(origin)
+        if start is None:
+            return {}
+        return {name: round((value - start) * 1000) for name, value in self.marks.items() if name != origin}
+
+    def report(self):
+        offsets = self.offsets()
+        parts = [f"{label} {offsets[name]}ms" for name, label in REPORT_LABELS.items() if name in offsets]
+        return f"[语音轮次耗时(自停止录音起): {', '.join(parts)} | 跟踪ID {self.short_id}]"
+
+    def end_playback(self, finished):
+        """回复播放完毕（finished为False表示被停止）后结束跟踪记录，可作为播放服务的回调"""
+        if finished and "playback_start" in self.marks:
+            self.mark("playback_end")
+        elif "playback_start" in self.marks:
+            self.set("chat.playback_interrupted", True)
+        self.end()
+
+    def end(self):
+        """结束这一轮并导出（只导出一次）"""
+        with self.lock:
+            if self.ended:
+                return
+            self.ended = True
+            self.ended_at = time.monotonic()
+        if self.exporter is not None:
+            self.exporter.export(self)
+
+    def _unix_ns(self, value):
+        return int(value * 1_000_000_000) + self.wall_offset_ns
+
+    def spans(self):
+        """换算为OTLP/JSON格式的span列表，第一个是整轮的根span"""
+        marks = dict(self.marks)
+        end = self.ended_at or time.monotonic()
+        root_id = secrets.token_hex(8)
+        root = {
+            "traceId": self.trace_id,
+            "spanId": root_id,
+            "parentSpanId": "",
+            "name": self.name,
+            "kind": SPAN_KIND_INTERNAL,
+            "startTimeUnixNano": str(self._unix_ns(min([self.started_at] + list(marks.values())))),
+            "endTimeUnixNano": str(self._unix_ns(max([end] + list(marks.values())))),
+            "attributes": otlp_attributes(self.attributes),
+            "events": [{"timeUnixNano": str(self._unix_ns(value)), "name": name}
+                       for name, value in sorted(marks.items(), key=lambda item: item[1])],
+            "status": {"code": STATUS_OK},
+        }
+        if self.error is not None:
+            root["status"] = {"code": STATUS_ERROR, "message": str(self.error)}
+            root["events"].append({"timeUnixNano": str(self._unix_ns(end)), "name": "exception",
+                                   "attributes": otlp_attributes({"exception.type": type(self.error).__name__,
+                                                                  "exception.message": str(self.error)})})
+        spans = [root]
+        span_ids = {}
+        for name, parent, starts, finish in STAGES:
+            start = next((marks[mark] for mark in starts if mark in marks), None)
+            if start is None or finish not in marks:
+                continue
+            span_ids[name] = secrets.token_hex(8)
+            spans.append({
+                "traceId": self.trace_id,
+                "spanId": span_ids[name],
+                "parentSpanId": span_ids.get(parent, root_id),
+                "name": name,
+                "kind": SPAN_KIND_CLIENT if name == "request" else SPAN_KIND_INTERNAL,
+                "startTimeUnixNano": str(self._unix_ns(start)),
+                "endTimeUnixNano": str(self._unix_ns(max(start, marks[finish]))),
+                "attributes": [],
+                "status": {"code": STATUS_OK},
+            })
+        return spans
+
+
+def otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    if isinstance(value, (list, tuple)):
+        return {"arrayValue": {"values": [otlp_value(item) for item in value]}}
+    return {"stringValue": str(value)}
+
+
+def otlp_attributes(attributes):
+    return [{"key": key, "value": otlp_value(value)} for key, value in attributes.items()]
+
+
+def plain_value(value):
+    """otlp_value的逆转换"""
+    if "arrayValue" in value:
+        return [plain_value(item) for item in value["arrayValue"].get("values", [])]
+    if "intValue" in value:
+        return int(value["intValue"])
+    for key in ("stringValue", "boolValue", "doubleValue"):
+        if key in value:
+            return value[key]
+    return None
+
+
+class TraceExporter:
+    """把每轮的span以OTLP/JSON格式追加写入本地文件，不需要Collector
+
+    文件每行是一个ExportTraceServiceRequest，与OpenTelemetry Collector的file exporter
+    输出格式相同，可以导入支持OTLP的查看器，或用本模块转换为Chrome跟踪格式。
+    """
+
+    def __init__(self, config=None):
+        self.config = dict(DEFAULT_TRACING_CONFIG, **(config or {}))
+        self.enabled = self.config["enabled"]
+        self.path = Path(self.config["path"])
+        self.lock = threading.Lock()
+        self.exported = 0
+
+    def export(self, trace):
+        if not self.enabled:
+            return
+        request = {"resourceSpans": [{
+            "resource": {"attributes": otlp_attributes({"service.name": self.config["service_name"]})},
+            "scopeSpans": [{"scope": {"name": "qwen_omni_chat.tracing"}, "spans": trace.spans()}],
+        }]}
+        line = json.dumps(request, ensure_ascii=False, separators=(",", ":")) + "\n"
+        try:
+            with self.lock:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                if self.path.exists() and self.path.stat().st_size > self.config["max_file_bytes"]:
+                    os.replace(self.path, self.path.with_name(self.path.name + ".1"))
+                with open(self.path, "a", encoding="utf-8") as output:
+                    output.write(line)
+                self.exported += 1
+        except OSError as e:
+            print(f"[警告] 写入跟踪记录失败: {e}", file=sys.stderr)
+
+
+def traced(chunks, trace):
+    """逐个转交流式响应的数据块，同时记录到trace；调用方提前结束时关闭上游数据流"""
+    try:
+        for chunk in chunks:
+            trace.observe(chunk)
+            yield chunk
+    except GeneratorExit:
+        trace.set("chat.cancelled", True)
+        raise
+    except Exception as e:
+        trace.fail(e)
+        raise
+    finally:
+        trace.mark("response_end")
+        close = getattr(chunks, "close", None)
+        if close:
+            close()
+
+
+def load_traces(path):
+    """读取跟踪记录文件，按记录顺序返回每轮的span列表（根span在前）"""
+    traces = {}
+    try:
+        with open(path, encoding="utf-8") as source:
+            for line in source:
+                if not line.strip():
+                    continue
+                for resource_spans in json.loads(line).get("resourceSpans", []):
+                    for scope_spans in resource_spans.get("scopeSpans", []):
+                        for span in scope_spans.get("spans", []):
+                            traces.setdefault(span["traceId"], []).append(span)
+    except FileNotFoundError:
+        return []
+    return [sorted(spans, key=lambda span: bool(span.get("parentSpanId"))) for spans in traces.values()]
+
+
+def span_ms(span):
+    return (int(span["endTimeUnixNano"]) - int(span["startTimeUnixNano"])) / 1_000_000
+
+
+def describe_trace(spans, verbose=False):
+    """一轮的摘要：时间、模型、总耗时和各阶段耗时，最慢的阶段加上标记"""
+    root = spans[0]
+    attributes = {item["key"]: plain_value(item["value"]) for item in root.get("attributes", [])}
+    started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(int(root["startTimeUnixNano"]) / 1e9))
+    stages = [span for span in spans[1:] if span["name"] in WAIT_STAGES]
+    slowest = max(stages, key=span_ms)["name"] if stages else None
+    request_ids = {span["spanId"] for span in spans if span["name"] == "request"}
+    status = root.get("status", {})
+    lines = [f"{started} {root['traceId'][:8]} {root['name']} 模型={attributes.get('gen_ai.request.model', '-')} "
+             f"总耗时={span_ms(root):.0f}ms" + (f" 错误: {status.get('message')}" if status.get("code") == STATUS_ERROR else "")]
+    for span in spans[1:]:
+        indent = "    " if span.get("parentSpanId") in request_ids else "  "
+        flag = "  <- 最慢" if span["name"] == slowest else ""
+        lines.append(f"{indent}{span['name']:<12} {span_ms(span):>8.0f}ms{flag}")
+    if verbose:
+        for key, value in attributes.items():
+            lines.append(f"  {key} = {value}")
+    return "\n".join(lines)
+
+
+def to_chrome_trace(traces):
+    """转换为Chrome跟踪格式（可在chrome://tracing或ui.perfetto.dev中打开），每轮占一行"""
+    events = []
+    for row, spans in enumerate(traces, start=1):
+        root = spans[0]
+        events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": row,
+                       "args": {"name": f"{root['name']} {root['traceId'][:8]}"}})
+        for span in spans:
+            start = int(span["startTimeUnixNano"]) / 1000
+            events.append({
+                "name": span["name"], "ph": "X", "pid": 1, "tid": row, "ts": start,
+                "dur": int(span["endTimeUnixNano"]) / 1000 - start,
+                "args": {item["key"]: plain_value(item["value"]) for item in span.get("attributes", [])},
+            })
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="查看每轮对话的跟踪记录")
+    parser.add_argument("path", nargs="?", default=DEFAULT_TRACING_CONFIG["path"], help="跟踪记录文件")
+    parser.add_argument("-n", "--last", type=int, default=10, help="显示最近几轮 (默认: 10)")
+    parser.add_argument("-t", "--trace", help="只显示该跟踪ID（可以只写前几位）的一轮，并列出全部属性")
+    parser.add_argument("--chrome", metavar="OUTPUT", help="另外转换为Chrome跟踪格式的JSON文件")
+    args = parser.parse_args(argv)
+
+    traces = load_traces(args.path)
+    if args.trace:
+        traces = [spans for spans in traces if spans[0]["traceId"].startswith(args.trace)]
+    else:
+        traces = traces[-args.last:]
+    if not traces:
+        print(f"没有找到跟踪记录: {args.path}")
+        return 1
+    for spans in traces:
+        print(describe_trace(spans, verbose=bool(args.trace)))
+    if args.chrome:
+        with open(args.chrome, "w", encoding="utf-8") as output:
+            json.dump(to_chrome_trace(traces), output, ensure_ascii=False)
+        print(f"已写入 {args.chrome}（在ui.perfetto.dev或chrome://tracing中打开）")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
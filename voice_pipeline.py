@@ -0,0 +1,264 @@
+import os
+import sys
+import time
+import struct
+import hashlib
+import binascii
+import tempfile
+import threading
+
+import streaming_body
+from streaming_body import LazyPayload, DEFAULT_STREAMING_BODY_CONFIG
+
+# PCM格式WAV文件头的长度；再加上4字节PCM数据正好是3的倍数，之后的数据可以逐帧编码
+WAV_HEADER_BYTES = 44
+HEAD_PCM_BYTES = 4
+
+
+def wav_header(data_bytes, rate, channels=1, sampwidth=2):
+    """与wave模块写出的PCM格式WAV文件头一致"""
+    return struct.pack("<4sI4s4sIHHIIHH4sI", b"RIFF", 36 + data_bytes, b"WAVE", b"fmt ", 16, 1,
+                       channels, rate, rate * channels * sampwidth, channels * sampwidth, sampwidth * 8,
+                       b"data", data_bytes)
+
+
+class CapturedAudio(LazyPayload):
+    """录音时逐帧编码为base64的WAV音频
+
+    WAV文件头中的数据长度要到录音结束才知道，所以文件头和紧随其后的4字节PCM数据
+    （共48字节，正好是3的倍数）留到finish()时编码；其余数据每凑够3字节的倍数就编码，
+    不足的部分留到下一帧。录音结束时只剩文件头和最后不到3字节需要编码。
+    编码结果逐帧追加到临时文件，内存占用与录音时长无关；不再需要时调用release()删除。
+    """
+
+    def __init__(self, rate=16000, channels=1, sampwidth=2):
+        self.rate = rate
+        self.channels = channels
+        self.sampwidth = sampwidth
+        self.lock = threading.Lock()
+        self.head = bytearray()
+        self.pending = b""
+        self.spool = tempfile.TemporaryFile(prefix="capture-")
+        self.spool_bytes = 0
+        self.released = False
+        self.data_bytes = 0
+        self.digest = hashlib.sha256()
+        self.head_chunk = None
+        self.tail_chunk = None
+        self.encode_seconds = 0.0
+        # 收到第一帧、停止录音和编码完成的时间(time.monotonic())，用于跟踪记录
+        self.started_at = None
+        self.stopped_at = None
+        self.finished_at = None
+
+    def write(self, frame):
+        """录音线程每读到一帧调用一次"""
+        start = time.monotonic()
+        with self.lock:
+            if self.head_chunk is not None:
+                raise ValueError("录音已结束")
+            if self.started_at is None:
+                self.started_at = start
+            self.data_bytes += len(frame)
+            self.digest.update(frame)
+            need = HEAD_PCM_BYTES - len(self.head)
+            if need > 0:
+                self.head += frame[:need]
+                frame = frame[need:]
+            data = self.pending + bytes(frame) if self.pending else bytes(frame)
+            cut = len(data) - len(data) % 3
+            if cut:
+                encoded = binascii.b2a_base64(data[:cut], newline=False)
+                self.spool.write(encoded)
+                self.spool_bytes += len(encoded)
+            self.pending = data[cut:]
+            self.encode_seconds += time.monotonic() - start
+
+    def finish(self):
+        """录音结束：编码文件头和剩余的字节"""
+        with self.lock:
+            if self.head_chunk is None:
+                self.stopped_at = time.monotonic()
+                header = wav_header(self.data_bytes, self.rate, self.channels, self.sampwidth)
+                self.head_chunk = binascii.b2a_base64(header + bytes(self.head), newline=False)
+                self.tail_chunk = binascii.b2a_base64(self.pending, newline=False)
+                self.pending = b""
+                self.finished_at = time.monotonic()
+        return self
+
+    @property
+    def finished(self):
+        return self.head_chunk is not None
+
+    @property
+    def duration(self):
+        return self.data_bytes / (self.rate * self.channels * self.sampwidth)
+
+    def __len__(self):
+        return (WAV_HEADER_BYTES + self.data_bytes + 2) // 3 * 4
+
+    def iter_chunks(self, chunk_bytes=DEFAULT_STREAMING_BODY_CONFIG["chunk_bytes"]):
+        if not self.finished:
+            raise ValueError("录音尚未结束，不能发送")
+        if self.released:
+            raise ValueError("录音已释放，不能再次发送")
+        yield self.head_chunk
+        # 从临时文件按块读回（每块对应chunk_bytes字节原始数据的base64长度）
+        read_size = chunk_bytes // 3 * 4
+        offset = 0
+        while offset < self.spool_bytes:
+            with self.lock:
+                self.spool.seek(offset)
+                chunk = self.spool.read(min(read_size, self.spool_bytes - offset))
+            if not chunk:
+                raise OSError("录音临时文件读取失败")
+            offset += len(chunk)
+            yield chunk
+        if self.tail_chunk:
+            yield self.tail_chunk
+
+    def identity(self):
+        return f"pcm-sha256:{self.digest.hexdigest()}:{self.rate}"
+
+    def wav_bytes(self):
+        """完整的WAV文件内容（用于校验）"""
+        return binascii.a2b_base64(str(self))
+
+    def release(self):
+        """删除临时文件（发送完成且不再重新发送时调用）"""
+        with self.lock:
+            if not self.released:
+                self.released = True
+                self.spool.close()
+
+    def __del__(self):
+        try:
+            self.release()
+        except Exception:
+            pass
+
+
+class ConnectionWarmer:
+    """录音期间在后台预先连接接口地址，并在连接可能过期前重新连接
+
+    录音结束发送请求时直接使用已完成TCP和TLS握手的连接（见streaming_body.prewarm）。
+    """
+
+    def __init__(self, base_url, config=None):
+        self.base_url = base_url
+        self.config = dict(DEFAULT_STREAMING_BODY_CONFIG, **(config or {}))
+        self.stopped = threading.Event()
+        self.connect_seconds = None
+        self.thread = threading.Thread(target=self._run, name="connection-warmer", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def _run(self):
+        interval = max(1.0, self.config["warm_max_age"] / 2)
+        while not self.stopped.is_set():
+            start = time.perf_counter()
+            if streaming_body.prewarm(self.base_url, self.config) and self.connect_seconds is None:
+                self.connect_seconds = time.perf_counter() - start
+            self.stopped.wait(interval)
+
+
+def _simulated_frames(seconds, rate=16000, frame_samples=1024):
+    data = os.urandom(int(seconds * rate) * 2)
+    frame_bytes = frame_samples * 2
+    return [data[offset:offset + frame_bytes] for offset in range(0, len(data), frame_bytes)]
+
+
+def _first_chunk(url, message):
+    completion = streaming_body.create_chat_completion(url, "benchmark", {
+        "model": "mock", "messages": [message], "modalities": ["text"], "stream": True})
+    try:
+        next(completion)
+    finally:
+        completion.close()
+
+
+def _sequential_turn(url, frames, rate, temp_dir):
+    """原来的做法：录音结束后写WAV文件、读回编码、构建消息、新建连接发送"""
+    import wave
+    import parallel_b64
+    from message_model import Message, ContentPart
+
+    timings = {}
+    start = time.perf_counter()
+    path = os.path.join(temp_dir, "record.wav")
+    with wave.open(path, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(rate)
+        wav_file.writeframes(b"".join(frames))
+    timings["wav"] = time.perf_counter() - start
+    encoded = parallel_b64.encode_file(path)
+    timings["encode"] = time.perf_counter() - start
+    message = Message.user("benchmark", [ContentPart.media("audio", encoded)])
+    timings["build"] = time.perf_counter() - start
+    _first_chunk(url, message)
+    timings["first_chunk"] = time.perf_counter() - start
+    return timings
+
+
+def _pipelined_turn(url, frames, rate):
+    """流水线：录音期间逐帧编码、预先连接，录音结束时只编码文件头后立即发送"""
+    from message_model import Message, ContentPart
+
+    capture = CapturedAudio(rate)
+    warmer = ConnectionWarmer(url).start()
+    for frame in frames:
+        capture.write(frame)
+    while warmer.connect_seconds is None:
+        time.sleep(0.001)
+    warmer.stop()
+
+    timings = {}
+    start = time.perf_counter()
+    capture.finish()
+    timings["encode"] = time.perf_counter() - start
+    message = Message.user("benchmark", [ContentPart.media("audio", capture)])
+    timings["build"] = time.perf_counter() - start
+    _first_chunk(url, message)
+    timings["first_chunk"] = time.perf_counter() - start
+    return timings
+
+
+def benchmark(durations=(5, 30, 60), rounds=3, rate=16000, endpoint=None):
+    """比较顺序执行与流水线两种做法从停止录音到收到首个数据的耗时（本地模拟接口）
+
+    endpoint为真实的接口地址时，另外测量建立连接（TCP和TLS握手）的耗时，
+    流水线中这部分在录音期间完成。
+    """
+    from duplex_voice import MockCompletionServer
+
+    server = MockCompletionServer(first_byte_delay=0.0, reply_seconds=0.1).start()
+    print(f"{'录音时长':>8} {'顺序: 写文件':>12} {'编码':>8} {'首个数据':>10} {'流水线: 编码':>12} {'首个数据':>10}")
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for seconds in durations:
+                frames = _simulated_frames(seconds, rate)
+                sequential = min((_sequential_turn(server.url, frames, rate, temp_dir) for _ in range(rounds)),
+                                 key=lambda t: t["first_chunk"])
+                pipelined = min((_pipelined_turn(server.url, frames, rate) for _ in range(rounds)),
+                                key=lambda t: t["first_chunk"])
+                print(f"{seconds:>6}秒 {sequential['wav'] * 1000:>10.1f}ms {sequential['encode'] * 1000:>6.1f}ms "
+                      f"{sequential['first_chunk'] * 1000:>8.1f}ms {pipelined['encode'] * 1000:>10.2f}ms "
+                      f"{pipelined['first_chunk'] * 1000:>8.1f}ms")
+    finally:
+        server.stop()
+    if endpoint:
+        start = time.perf_counter()
+        if streaming_body.prewarm(endpoint):
+            print(f"连接{endpoint}耗时: {(time.perf_counter() - start) * 1000:.0f}ms（流水线中在录音期间完成）")
+        else:
+            print(f"无法连接{endpoint}")
+
+
+if __name__ == "__main__":
+    benchmark(endpoint=sys.argv[1] if len(sys.argv) > 1 else None)
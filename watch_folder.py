@@ -0,0 +1,325 @@
+import os
+import sys
+import json
+import time
+import shutil
+import struct
+import select
+import ctypes
+import ctypes.util
+import argparse
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import qwen_chat
+import batch_runner
+from attachments import media_kind
+from key_pool import NoKeyAvailable
+
+# 写在媒体文件旁边的回复文件会带上这个标记，监听时忽略
+RESPONSE_MARK = ".qwen."
+
+# inotify事件掩码
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+
+class InotifyWatcher:
+    """基于inotify的目录监听（仅Linux）"""
+
+    def __init__(self, directory):
+        libc_name = ctypes.util.find_library("c")
+        if not sys.platform.startswith("linux") or not libc_name:
+            raise OSError("inotify仅在Linux上可用")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1失败")
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if self.libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, f"无法监听目录: {directory}")
+        self.directory = Path(directory)
+
+    def poll(self, timeout):
+        """等待事件，返回有变化的文件路径列表"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        paths = []
+        offset = 0
+        while offset + 16 <= len(data):
+            _, _, _, name_length = struct.unpack_from("iIII", data, offset)
+            name = data[offset + 16:offset + 16 + name_length].rstrip(b"\0")
+            offset += 16 + name_length
+            if name:
+                paths.append(self.directory / os.fsdecode(name))
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """轮询方式的目录监听（inotify不可用或监听网络共享目录时使用）"""
+
+    def __init__(self, directory, interval=2.0):
+        self.directory = Path(directory)
+        self.interval = interval
+        self.known = {}
+
+    def poll(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        changed = []
+        current = {}
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            current[entry.path] = (stat.st_size, stat.st_mtime_ns)
+            if self.known.get(entry.path) != current[entry.path]:
+                changed.append(Path(entry.path))
+        self.known = current
+        return changed
+
+    def close(self):
+        pass
+
+
+class ProcessedIndex:
+    """已处理文件的持久化索引（JSONL），按路径、大小和修改时间识别文件"""
+
+    def __init__(self, index_path):
+        self.index_path = Path(index_path)
+        self.lock = threading.Lock()
+        self.entries = {}
+        if self.index_path.exists():
+            with open(self.index_path, "r", encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    # 处理失败的文件在重启后重试
+                    if entry.get("error"):
+                        self.entries.pop(entry["path"], None)
+                    else:
+                        self.entries[entry["path"]] = (entry["size"], entry["mtime_ns"])
+
+    @staticmethod
+    def _signature(path):
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def is_processed(self, path):
+        try:
+            return self.entries.get(str(path)) == self._signature(path)
+        except OSError:
+            return False
+
+    def mark(self, path, record):
+        size, mtime_ns = self._signature(path)
+        entry = {"path": str(path), "size": size, "mtime_ns": mtime_ns,
+                 "processed_at": time.time(), "error": record.get("error")}
+        with self.lock:
+            self.entries[str(path)] = (size, mtime_ns)
+            with open(self.index_path, "a", encoding="utf-8") as file:
+                file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+class FolderWatcher:
+    """监听目录中的新媒体文件，文件写完后送入模型处理并保存回复"""
+
+    def __init__(self, directory, prompts=None, model=None, modalities=None, workers=2,
+                 settle_seconds=2.0, results_path=None, index_path=None, use_polling=False):
+        self.directory = Path(directory).resolve()
+        self.prompts = dict(batch_runner.DEFAULT_PROMPTS)
+        self.prompts.update(prompts or {})
+        self.model = model or qwen_chat.get_selected_model()
+        self.modalities = modalities or ["text"]
+        self.workers = workers
+        self.settle_seconds = settle_seconds
+        self.results_path = Path(results_path) if results_path else None
+        self.index = ProcessedIndex(index_path or self.directory / ".qwen_processed.jsonl")
+        self.use_polling = use_polling
+        self.pending = {}      # 路径 -> (大小, 修改时间, 最后一次变化的时间)
+        self.in_progress = set()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        # 限制排队中的任务数，避免一次性提交大量文件
+        self.slots = threading.Semaphore(workers * 2)
+
+    def _is_candidate(self, path):
+        return (media_kind(path) is not None
+                and RESPONSE_MARK not in path.name
+                and not path.name.startswith("."))
+
+    def _create_watcher(self):
+        if not self.use_polling:
+            try:
+                return InotifyWatcher(self.directory)
+            except OSError as e:
+                print(f"[inotify不可用，改用轮询方式: {e}]")
+        return PollingWatcher(self.directory)
+
+    def _note_changed(self, path):
+        """记录有变化的文件，等待写入完成"""
+        if not self._is_candidate(path):
+            return
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        with self.lock:
+            if str(path) in self.in_progress:
+                return
+            previous = self.pending.get(str(path))
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if previous is None or previous[:2] != signature:
+                self.pending[str(path)] = signature + (time.monotonic(),)
+
+    def _collect_settled(self):
+        """大小和修改时间在settle_seconds内都没有变化的文件视为写入完成"""
+        now = time.monotonic()
+        settled = []
+        with self.lock:
+            for path, (size, mtime_ns, changed_at) in list(self.pending.items()):
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    del self.pending[path]
+                    continue
+                if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+                    self.pending[path] = (stat.st_size, stat.st_mtime_ns, now)
+                elif now - changed_at >= self.settle_seconds and stat.st_size > 0:
+                    del self.pending[path]
+                    settled.append(Path(path))
+        return settled
+
+    def _write_result(self, path, record):
+        """把回复写到结果文件，或写在媒体文件旁边"""
+        if self.results_path:
+            with self.lock:
+                with open(self.results_path, "a", encoding="utf-8") as file:
+                    file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            return
+        response_base = path.with_name(path.name + RESPONSE_MARK.rstrip("."))
+        if record.get("error"):
+            Path(f"{response_base}.error.txt").write_text(record["error"], encoding="utf-8")
+            return
+        Path(f"{response_base}.txt").write_text(record.get("text", ""), encoding="utf-8")
+        if record.get("audio_path"):
+            # 语音回复先保存在audio_output目录，与监听目录（如网络共享目录）不在同一文件系统上时os.replace会失败
+            shutil.move(record["audio_path"], f"{response_base}.wav")
+
+    def _process(self, path):
+        try:
+            kind = media_kind(path)
+            turn = {
+                "id": str(path.relative_to(self.directory)),
+                "prompt": self.prompts.get(kind),
+                kind: str(path),
+                "model": self.model,
+                "modalities": self.modalities,
+            }
+            record = batch_runner.run_turn(turn, self.directory, self.model, None)
+            record["path"] = str(path)
+            self._write_result(path, record)
+            self.index.mark(path, record)
+            status = f"失败: {record['error']}" if record.get("error") else f"{record['latency']:.1f}秒"
+            print(f"[已处理] {path.name} {status}")
+        except Exception as e:
+            print(f"[处理 {path.name} 时出错: {e}]")
+        finally:
+            with self.lock:
+                self.in_progress.discard(str(path))
+            self.slots.release()
+
+    def run(self):
+        """开始监听，直到stop()被调用或按Ctrl+C；没有配置API密钥时返回1"""
+        # 后台运行时没有人输入密钥，不请求输入
+        try:
+            qwen_chat.get_key_pool(interactive=False)
+        except NoKeyAvailable as e:
+            print(f"[错误] {e}")
+            return 1
+        watcher = self._create_watcher()
+        print(f"[开始监听目录: {self.directory}，工作线程: {self.workers}，"
+              f"方式: {'inotify' if isinstance(watcher, InotifyWatcher) else '轮询'}]")
+
+        # 启动时先处理目录中尚未处理过的文件
+        for entry in os.scandir(self.directory):
+            path = Path(entry.path)
+            if entry.is_file() and self._is_candidate(path) and not self.index.is_processed(path):
+                self._note_changed(path)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            try:
+                while not self.stop_event.is_set():
+                    for path in watcher.poll(timeout=0.5):
+                        self._note_changed(path)
+                    for path in self._collect_settled():
+                        if self.index.is_processed(path):
+                            continue
+                        if not self.slots.acquire(blocking=False):
+                            # 工作线程都在忙，稍后再提交
+                            self._note_changed(path)
+                            continue
+                        with self.lock:
+                            self.in_progress.add(str(path))
+                        executor.submit(self._process, path)
+            except KeyboardInterrupt:
+                print("\n[停止监听，等待进行中的任务完成...]")
+            finally:
+                watcher.close()
+        return 0
+
+    def stop(self):
+        self.stop_event.set()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="监听目录，自动用Qwen Omni处理新的图片、音频和视频")
+    parser.add_argument("directory", help="要监听的目录")
+    parser.add_argument("--prompt", help="所有媒体类型共用的提示词")
+    parser.add_argument("--image-prompt", help="图片的提示词")
+    parser.add_argument("--audio-prompt", help="音频的提示词")
+    parser.add_argument("--video-prompt", help="视频的提示词")
+    parser.add_argument("-m", "--model", help="使用的模型 (默认: 配置文件中选择的模型)")
+    parser.add_argument("--output-audio", action="store_true", help="同时生成语音回复")
+    parser.add_argument("-w", "--workers", type=int, default=2, help="工作线程数 (默认: 2)")
+    parser.add_argument("--settle", type=float, default=2.0, help="文件多久没有变化视为写入完成(秒) (默认: 2)")
+    parser.add_argument("--results", help="把结果写入该JSONL文件，而不是写在媒体文件旁边")
+    parser.add_argument("--index", help="已处理文件索引的路径 (默认: <目录>/.qwen_processed.jsonl)")
+    parser.add_argument("--poll", action="store_true", help="使用轮询而不是inotify（如网络共享目录）")
+    args = parser.parse_args(argv)
+
+    prompts = {}
+    for kind in ("image", "audio", "video"):
+        prompt = getattr(args, f"{kind}_prompt") or args.prompt
+        if prompt:
+            prompts[kind] = prompt
+
+    watcher = FolderWatcher(
+        args.directory,
+        prompts=prompts,
+        model=args.model,
+        modalities=["text", "audio"] if args.output_audio else ["text"],
+        workers=max(1, args.workers),
+        settle_seconds=args.settle,
+        results_path=args.results,
+        index_path=args.index,
+        use_polling=args.poll,
+    )
+    return watcher.run()
+
+
+if __name__ == "__main__":
+    sys.exit(main())